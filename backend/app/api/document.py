@@ -13,6 +13,8 @@ import uuid
 
 from app.db import SessionLocal
 from app.services.document_service import DocumentService
+from app.services.embedding_stats_service import EmbeddingStatsService
+from app.services.search_cache import bump_corpus_version
 from app.models import Content, Chunk, ContentCategory
 
 router = APIRouter()
@@ -320,7 +322,7 @@ def delete_document(content_id: str, db: Session = Depends(get_db)):
         categories_count = db.query(ContentCategory).filter(ContentCategory.content_id == content_uuid).count()
         
         # 删除相关的chunks（包含向量数据）
-        db.query(Chunk).filter(Chunk.content_id == content_uuid).delete()
+        EmbeddingStatsService(db).delete_chunks(Chunk.content_id == content_uuid)
         logger.info(f"Deleted {chunks_count} chunks for document {content_id}")
         
         # 删除相关的分类关联
@@ -332,6 +334,7 @@ def delete_document(content_id: str, db: Session = Depends(get_db)):
         
         # 提交事务
         db.commit()
+        bump_corpus_version()
         
         logger.info(f"Successfully deleted document: {title} (ID: {content_id})")
         
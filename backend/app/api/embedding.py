@@ -3,16 +3,33 @@ Embedding 测试和管理 API
 提供 embedding 服务的测试、信息查询等接口
 """
 
-from fastapi import APIRouter, HTTPException, Query
+from fastapi import APIRouter, HTTPException, Query, Depends
 from pydantic import BaseModel
+from sqlalchemy.orm import Session
 from typing import List, Optional, Dict, Any
 import logging
 
+from app.db import SessionLocal
 from app.services.embedding_service import EmbeddingService
+from app.services.embedding_stats_service import EmbeddingStatsService
+from app.services.query_embedding_cache import query_embedding_cache
+from app.services.embedding_store import EmbeddingStore
+from app.services.embedding_scheduler import get_pending_stats
+from app.services.embedding_migration import EmbeddingMigrationService
+from app.services.local_embedding import get_local_engine
+from app.services.similarity import to_matrix, top_k_similar
+from app.services.embedding_guard import embedding_guard
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
+def get_db():
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
 class EmbeddingRequest(BaseModel):
     text: str
     dimensions: Optional[int] = None
@@ -20,6 +37,9 @@ class EmbeddingRequest(BaseModel):
 class BatchEmbeddingRequest(BaseModel):
     texts: List[str]
 
+class EmbeddingMigrationRequest(BaseModel):
+    target_model: str
+
 class SimilarityRequest(BaseModel):
     text1: str
     text2: str
@@ -41,6 +61,21 @@ class SimilarityResponse(BaseModel):
     similarity: Optional[float] = None
     error: Optional[str] = None
 
+class BatchSimilarityRequest(BaseModel):
+    texts: List[str]
+    queries: Optional[List[str]] = None  # 为空时 texts 两两比较（排除自身），用于查重
+    top_k: int = 5
+    min_score: Optional[float] = None
+
+class SimilarityMatch(BaseModel):
+    index: int
+    similarity: float
+
+class BatchSimilarityResponse(BaseModel):
+    success: bool
+    results: List[List[SimilarityMatch]] = []
+    error: Optional[str] = None
+
 @router.get("/info")
 def get_embedding_info():
     """
@@ -187,6 +222,62 @@ def calculate_similarity(request: SimilarityRequest):
         logger.error(f"Error calculating similarity: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.post("/similarity/batch", response_model=BatchSimilarityResponse)
+def calculate_batch_similarity(request: BatchSimilarityRequest):
+    """
+    批量计算相似度：一个或多个查询文本对多个候选文本，返回每个查询的 top-k 匹配
+    
+    Args:
+        request: 候选文本、查询文本（可选）、top_k 与最低相似度
+        
+    Returns:
+        每个查询的匹配列表（候选文本下标与相似度，按相似度降序）
+    """
+    try:
+        service = EmbeddingService()
+        
+        if not service.is_enabled():
+            raise HTTPException(status_code=503, detail="Embedding service not available")
+        
+        queries = request.queries or []
+        if not request.texts:
+            raise HTTPException(status_code=400, detail="texts must not be empty")
+        if len(request.texts) + len(queries) > 500:  # 限制批量大小
+            raise HTTPException(status_code=400, detail="Too many texts (max 500)")
+        if request.top_k < 1:
+            raise HTTPException(status_code=400, detail="top_k must be positive")
+        
+        embeddings = service.batch_get_embeddings(queries + request.texts)
+        if any(emb is None for emb in embeddings):
+            return BatchSimilarityResponse(
+                success=False,
+                error="Failed to generate embeddings for one or more texts"
+            )
+        
+        matrix = to_matrix(embeddings)
+        candidates = matrix[len(queries):]
+        matches = top_k_similar(
+            matrix[:len(queries)] if queries else candidates,
+            candidates,
+            k=request.top_k,
+            min_score=request.min_score,
+            exclude_self=not queries
+        )
+        
+        return BatchSimilarityResponse(
+            success=True,
+            results=[
+                [SimilarityMatch(index=index, similarity=score) for index, score in row]
+                for row in matches
+            ]
+        )
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error calculating batch similarity: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @router.get("/models")
 def get_supported_models():
     """
@@ -225,6 +316,16 @@ def embedding_health_check():
                 "message": "Embedding service is not enabled"
             }
         
+        guard = embedding_guard.stats()
+        
+        # 熔断打开时不发测试请求，搜索已退化为关键词检索
+        if embedding_guard.is_open():
+            return {
+                "status": "degraded",
+                "message": "Embedding circuit breaker is open, search falls back to keyword only",
+                "guard": guard
+            }
+        
         # 尝试一个简单的 embedding 请求
         test_embedding = service.get_embedding("health check")
         
@@ -232,12 +333,14 @@ def embedding_health_check():
             return {
                 "status": "healthy",
                 "message": "Embedding service is working properly",
-                "dimension": len(test_embedding)
+                "dimension": len(test_embedding),
+                "guard": guard
             }
         else:
             return {
                 "status": "unhealthy",
-                "message": "Embedding service failed to generate test embedding"
+                "message": "Embedding service failed to generate test embedding",
+                "guard": embedding_guard.stats()
             }
             
     except Exception as e:
@@ -246,3 +349,230 @@ def embedding_health_check():
             "status": "error",
             "message": f"Health check error: {str(e)}"
         }
+
+
+@router.get("/coverage")
+def get_embedding_coverage(
+    exact: bool = Query(False, description="是否精确统计（全表 COUNT，并校准计数器）"),
+    db: Session = Depends(get_db)
+):
+    """
+    获取向量覆盖率统计（运维监控）
+    
+    Returns:
+        已生成向量的 chunk 数量、chunk 总数及覆盖率
+    """
+    try:
+        return EmbeddingStatsService(db).get_coverage(exact=exact)
+    except Exception as e:
+        logger.error(f"Error getting embedding coverage: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/cache/stats")
+def get_query_embedding_cache_stats():
+    """
+    获取查询向量缓存命中统计（进程内 LRU + Redis）
+    """
+    return query_embedding_cache.stats()
+
+
+@router.delete("/cache")
+def clear_query_embedding_cache():
+    """
+    清空当前进程的查询向量缓存（Redis 中的条目按 TTL 过期）
+    """
+    query_embedding_cache.clear()
+    return {"success": True}
+
+
+@router.get("/store/stats")
+def get_embedding_store_stats(db: Session = Depends(get_db)):
+    """
+    获取内容寻址向量存储的规模与复用统计
+    """
+    try:
+        return EmbeddingStore(db).get_stats()
+    except Exception as e:
+        logger.error(f"Error getting embedding store stats: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/pending")
+def get_pending_embeddings():
+    """
+    获取合并调度待生成向量的 chunk 队列深度
+    """
+    try:
+        return get_pending_stats()
+    except Exception as e:
+        logger.error(f"Error getting pending embedding stats: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/local/stats")
+def get_local_embedding_stats():
+    """
+    获取本地 CPU 向量引擎的批处理与吞吐统计
+    """
+    engine = get_local_engine()
+    if engine is None:
+        return {"enabled": False}
+    return {"enabled": True, **engine.stats()}
+
+
+@router.post("/local/benchmark")
+def benchmark_local_embedding(
+    num_texts: int = Query(256, ge=1, le=10000, description="文本总数"),
+    text_length: int = Query(200, ge=1, le=8000, description="每条文本的字符数"),
+    concurrency: int = Query(8, ge=1, le=64, description="并发请求数")
+):
+    """
+    测量本地 CPU 向量引擎在并发请求下的整体吞吐
+    """
+    engine = get_local_engine()
+    if engine is None:
+        raise HTTPException(status_code=400, detail="Local embedding is not enabled")
+    try:
+        return engine.benchmark(num_texts=num_texts, text_length=text_length, concurrency=concurrency)
+    except Exception as e:
+        logger.error(f"Error benchmarking local embedding: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+def _dispatch_migration(migration_id: str) -> None:
+    from app.workers.tasks import run_embedding_migration
+    run_embedding_migration.delay(migration_id)
+
+
+def _get_migration_or_404(service: EmbeddingMigrationService, migration_id: str):
+    migration = service.get(migration_id)
+    if not migration:
+        raise HTTPException(status_code=404, detail="Embedding migration not found")
+    return migration
+
+
+@router.get("/migrations")
+def list_embedding_migrations(
+    limit: int = Query(20, ge=1, le=100),
+    db: Session = Depends(get_db)
+):
+    """
+    获取向量模型迁移记录及进度
+    """
+    try:
+        return {"migrations": EmbeddingMigrationService(db).list_migrations(limit)}
+    except Exception as e:
+        logger.error(f"Error listing embedding migrations: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/migrations")
+def start_embedding_migration(request: EmbeddingMigrationRequest, db: Session = Depends(get_db)):
+    """
+    开始向量模型迁移：用目标模型为全部 chunk 生成向量写入影子列，完成后调用 switch 切换
+    """
+    try:
+        result = EmbeddingMigrationService(db).start(request.target_model)
+        if result.get("success"):
+            _dispatch_migration(result["id"])
+        return result
+    except Exception as e:
+        logger.error(f"Error starting embedding migration: {e}")
+        db.rollback()
+        return {"success": False, "error": str(e)}
+
+
+@router.get("/migrations/{migration_id}")
+def get_embedding_migration(migration_id: str, db: Session = Depends(get_db)):
+    """
+    获取迁移进度（剩余数量、吞吐与预计剩余时间）
+    """
+    service = EmbeddingMigrationService(db)
+    return service.get_progress(_get_migration_or_404(service, migration_id))
+
+
+@router.post("/migrations/{migration_id}/pause")
+def pause_embedding_migration(migration_id: str, db: Session = Depends(get_db)):
+    """
+    暂停回填（当前批次完成后生效）
+    """
+    service = EmbeddingMigrationService(db)
+    return service.pause(_get_migration_or_404(service, migration_id))
+
+
+@router.post("/migrations/{migration_id}/resume")
+def resume_embedding_migration(migration_id: str, db: Session = Depends(get_db)):
+    """
+    从检查点继续回填（暂停、失败或执行中断的迁移）
+    """
+    service = EmbeddingMigrationService(db)
+    result = service.resume(_get_migration_or_404(service, migration_id))
+    if result.pop("dispatch", False):
+        _dispatch_migration(migration_id)
+    return result
+
+
+@router.post("/migrations/{migration_id}/cancel")
+def cancel_embedding_migration(migration_id: str, db: Session = Depends(get_db)):
+    """
+    取消迁移并删除影子列
+    """
+    service = EmbeddingMigrationService(db)
+    try:
+        return service.cancel(_get_migration_or_404(service, migration_id))
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error cancelling embedding migration: {e}")
+        db.rollback()
+        return {"success": False, "error": str(e)}
+
+
+@router.post("/migrations/{migration_id}/switch")
+def switch_embedding_migration(
+    migration_id: str,
+    force: bool = Query(False, description="仍有 chunk 缺少新向量时也切换（切换后为其重新生成向量）"),
+    db: Session = Depends(get_db)
+):
+    """
+    原子切换搜索到新模型的向量，原向量保留以便回滚
+    """
+    service = EmbeddingMigrationService(db)
+    try:
+        return service.switch(_get_migration_or_404(service, migration_id), force=force)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error switching embedding migration: {e}")
+        db.rollback()
+        return {"success": False, "error": str(e)}
+
+
+@router.post("/migrations/{migration_id}/rollback")
+def rollback_embedding_migration(migration_id: str, db: Session = Depends(get_db)):
+    """
+    回滚到切换前的向量与模型
+    """
+    service = EmbeddingMigrationService(db)
+    try:
+        return service.rollback(_get_migration_or_404(service, migration_id))
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error rolling back embedding migration: {e}")
+        db.rollback()
+        return {"success": False, "error": str(e)}
+
+
+@router.delete("/migrations/previous")
+def drop_previous_embeddings(db: Session = Depends(get_db)):
+    """
+    删除切换前保留的旧向量列（删除后无法回滚）
+    """
+    try:
+        return EmbeddingMigrationService(db).drop_previous()
+    except Exception as e:
+        logger.error(f"Error dropping previous embeddings: {e}")
+        db.rollback()
+        return {"success": False, "error": str(e)}
@@ -15,6 +15,8 @@ import time
 from sqlalchemy.orm import Session
 from app.db import SessionLocal
 from app.models import Content, Chunk, ContentCategory
+from app.services.embedding_stats_service import EmbeddingStatsService
+from app.services.search_cache import bump_corpus_version
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
@@ -644,11 +646,8 @@ async def reset_database(confirm: bool = False, db: Session = Depends(get_db)):
         
         # 删除相关的chunks和分类关联
         for content in webui_contents:
-            # 删除chunks
-            chunks = db.query(Chunk).filter(Chunk.content_id == content.id).all()
-            chunk_count += len(chunks)
-            for chunk in chunks:
-                db.delete(chunk)
+            # 删除chunks（扣减向量覆盖率计数）
+            chunk_count += EmbeddingStatsService(db).delete_chunks(Chunk.content_id == content.id)
             
             # 删除分类关联
             categories = db.query(ContentCategory).filter(ContentCategory.content_id == content.id).all()
@@ -661,6 +660,7 @@ async def reset_database(confirm: bool = False, db: Session = Depends(get_db)):
         
         # 提交删除
         db.commit()
+        bump_corpus_version()
         
         return {
             "success": True,
@@ -1,27 +1,51 @@
-from fastapi import APIRouter, Depends, UploadFile, File, HTTPException
+from fastapi import APIRouter, Depends, UploadFile, File, HTTPException, Query
 from fastapi.responses import JSONResponse
 from sqlalchemy.orm import Session
 from app.db import SessionLocal
 from app.models import Content, Chunk
 from app.adapters import webdav
 from pydantic import BaseModel
-from typing import List
+from typing import List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import asyncio
 import logging
 import os
 import uuid
+from datetime import datetime
 from pathlib import Path
-from app.workers.tasks import ingest_file as ingest_task, generate_embeddings, simple_chunk, classify_content
+from app.workers.tasks import (
+    ingest_file as ingest_task, classify_content, process_uploaded_file, parse_uploaded_content,
+    process_uploaded_batch, parse_uploaded_batch,
+)
+from starlette.concurrency import run_in_threadpool
 from app.parsers.document_processor import DocumentProcessor
+from app.services.embedding_stats_service import EmbeddingStatsService
+from app.services.search_cache import bump_corpus_version
+from app.services.embedding_scheduler import schedule_embeddings
+from app.services.chunk_store import ChunkStore
+from app.services.chunking import chunk_text, benchmark as benchmark_chunking
 
 router = APIRouter()
 log = logging.getLogger(__name__)
 
+# 上传文件分块写盘的块大小（字节）
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+# 上传文件的解析方式：celery（ingest 队列，worker 需要共享 /app/uploads；任务在 worker 崩溃或重启后重新投递）|
+# thread（API 进程内线程池，仅用于没有共享存储的单机调试，进程重启会丢失进行中的解析）
+UPLOAD_PARSE_EXECUTOR = os.getenv("UPLOAD_PARSE_EXECUTOR", "celery").lower()
+UPLOAD_PARSE_WORKERS = int(os.getenv("UPLOAD_PARSE_WORKERS", "2"))
+# 多文件上传时同时写盘的文件数
+UPLOAD_BATCH_CONCURRENCY = int(os.getenv("UPLOAD_BATCH_CONCURRENCY", "4"))
+
+_parse_executor = None
+
 def get_db():
     db = SessionLocal()
     try: yield db
     finally: db.close()
 
-# simple_chunk 函数已移动到 workers/tasks.py 中
+# 切片统一使用 services/chunking.py 的 chunk_text
 
 @router.post("/memo")
 def ingest_memo(item: dict, db: Session = Depends(get_db)):
@@ -41,29 +65,22 @@ def ingest_memo(item: dict, db: Session = Depends(get_db)):
         source_uri=item.get("source_uri"), 
         created_by="memo.api"
     )
-    db.add(content); db.commit(); db.refresh(content)
+    db.add(content); db.flush()
+    content_id = str(content.id)
 
-    # 切片并入库
-    seq = 0
-    chunk_ids = []
-    for t in simple_chunk(text):
-        chunk = Chunk(content_id=content.id, seq=seq, text=t, meta={"source_uri": content.source_uri})
-        db.add(chunk)
-        seq += 1
+    # 切片并批量入库，与 content 同一事务提交
+    chunk_ids = ChunkStore(db).insert(content.id, chunk_text(text, meta), meta={"source_uri": content.source_uri})
     db.commit()
-    
-    # 获取新创建的 chunk IDs
-    db.refresh(content)
-    chunk_ids = [str(chunk.id) for chunk in content.chunks]
+    bump_corpus_version()
     
     # 异步生成 embeddings
     if chunk_ids:
-        generate_embeddings.delay(chunk_ids)
+        schedule_embeddings(chunk_ids)
     
     # 立即进行快速分类（异步，最高优先级）
     from app.workers.quick_tasks import quick_classify_content
     quick_classify_content.apply_async(
-        args=[str(content.id)], 
+        args=[content_id], 
         queue="quick", 
         priority=10,  # 提高优先级确保先执行
         countdown=1
@@ -73,42 +90,42 @@ def ingest_memo(item: dict, db: Session = Depends(get_db)):
     try:
         from app.services.collection_matching_service import CollectionMatchingService
         matching_service = CollectionMatchingService(db)
-        matched = matching_service.match_document_to_collections(str(content.id))
-        log.info(f"Synchronously matched content {content.id} to {len(matched)} collections")
+        matched = matching_service.match_document_to_collections(content_id)
+        log.info(f"Synchronously matched content {content_id} to {len(matched)} collections")
         
         # 异步任务作为备份（如果同步执行成功，这个任务会快速跳过）
         from app.workers.quick_tasks import match_document_to_collections
         match_document_to_collections.apply_async(
-            args=[str(content.id)],
+            args=[content_id],
             queue="quick",
             priority=8,
             countdown=8   # 作为备份，延迟8秒执行
         )
         
     except Exception as e:
-        log.error(f"Synchronous collection matching failed for {content.id}: {e}")
+        log.error(f"Synchronous collection matching failed for {content_id}: {e}")
         # 如果同步失败，依赖异步任务
         try:
             from app.workers.quick_tasks import match_document_to_collections
             match_document_to_collections.apply_async(
-                args=[str(content.id)],
+                args=[content_id],
                 queue="quick",
                 priority=9,
                 countdown=2  # 更短的延迟
             )
-            log.info(f"Fallback: Scheduled async collection matching for content {content.id}")
+            log.info(f"Fallback: Scheduled async collection matching for content {content_id}")
         except Exception as async_e:
             log.error(f"Both sync and async collection matching failed: {async_e}")
     
     # 异步进行精确AI分类（最后执行，覆盖快速分类）
     classify_content.apply_async(
-        args=[str(content.id)], 
+        args=[content_id], 
         queue="classify", 
         priority=5,
         countdown=6   # 延迟6秒，确保前面的任务都完成
     )
     
-    return {"status":"ok","content_id":str(content.id),"chunks":seq}
+    return {"status":"ok","content_id":content_id,"chunks":len(chunk_ids)}
 
 @router.post("/scan")
 def ingest_scan(db: Session = Depends(get_db)):
@@ -118,8 +135,10 @@ def ingest_scan(db: Session = Depends(get_db)):
     docs = webdav.scan_inbox()
     total_chunks = 0
     all_chunk_ids = []
-    new_content_ids = []
+    image_content_ids = []
+    text_content_ids = []
     new_files = 0
+    updated_files = 0
     skipped_files = 0
     deleted_files = 0
     
@@ -142,10 +161,8 @@ def ingest_scan(db: Session = Depends(get_db)):
                 ContentCategory.content_id == existing_content.id
             ).delete()
             
-            # 删除相关的 chunks（会自动删除 embeddings）
-            db.query(Chunk).filter(
-                Chunk.content_id == existing_content.id
-            ).delete()
+            # 删除相关的 chunks（会自动删除 embeddings，并扣减向量覆盖率计数）
+            EmbeddingStatsService(db).delete_chunks(Chunk.content_id == existing_content.id)
             
             # 删除内容记录
             db.delete(existing_content)
@@ -161,8 +178,29 @@ def ingest_scan(db: Session = Depends(get_db)):
         ).first()
         
         if existing_content:
-            log.info(f"File already exists, skipping: {d['title']}")
-            skipped_files += 1
+            # 图片由 process_image_content 解析，扫描得到的只是占位文本；文本未变化时跳过
+            if existing_content.modality == 'image' or existing_content.text == d["text"]:
+                log.info(f"File already exists, skipping: {d['title']}")
+                skipped_files += 1
+                continue
+            
+            # 文件内容变化：与已有 chunks 比对，只写入新增或修改的 chunk，未变化的 chunk 保留向量
+            existing_content.text = d["text"]
+            existing_content.meta = {**(existing_content.meta or {}), **d.get("metadata", {})}
+            existing_content.updated_at = datetime.utcnow()
+            sync = ChunkStore(db).sync(
+                existing_content.id, chunk_text(d["text"], d.get("metadata")),
+                meta={"source_uri": existing_content.source_uri}
+            )
+            db.commit()
+            updated_files += 1
+            text_content_ids.append(str(existing_content.id))
+            all_chunk_ids.extend(sync["embed_ids"])
+            total_chunks += sync["inserted"]
+            log.info(
+                f"Updated changed file: {d['title']} "
+                f"({sync['inserted']} inserted, {sync['kept']} kept, {sync['deleted']} deleted chunks)"
+            )
             continue
         
         # 检查是否是用户主动删除的文件（通过删除记录检查）
@@ -195,49 +233,31 @@ def ingest_scan(db: Session = Depends(get_db)):
             created_by="webdav.scan"
         )
         db.add(content)
-        db.commit()
-        db.refresh(content)
-        new_files += 1
-        new_content_ids.append(str(content.id))
+        db.flush()
+        content_id = str(content.id)
+        if modality == 'image' and (content.meta or {}).get("processing_status") == "pending":
+            image_content_ids.append(content_id)
+        else:
+            text_content_ids.append(content_id)
 
-        # 文本分块
-        seq = 0
-        for t in simple_chunk(d["text"]):
-            chunk = Chunk(
-                content_id=content.id, 
-                seq=seq, 
-                text=t, 
-                meta={"source_uri": content.source_uri}
-            )
-            db.add(chunk)
-            seq += 1
+        # 文本分块并批量入库，与 content 同一事务提交
+        chunk_ids = ChunkStore(db).insert(content.id, chunk_text(d["text"], d.get("metadata")), meta={"source_uri": content.source_uri})
         db.commit()
-        
-        # 收集新创建的 chunk IDs
-        db.refresh(content)
-        chunk_ids = [str(chunk.id) for chunk in content.chunks]
+        new_files += 1
         all_chunk_ids.extend(chunk_ids)
-        total_chunks += seq
+        total_chunks += len(chunk_ids)
         
-        log.info(f"Processed new file: {d['title']} ({seq} chunks)")
+        log.info(f"Processed new file: {d['title']} ({len(chunk_ids)} chunks)")
     
-    # 异步生成 embeddings（仅为新文档）
+    # 异步生成 embeddings（新文档，以及变化文档中新增或修改的 chunk）
     if all_chunk_ids:
-        generate_embeddings.delay(all_chunk_ids)
+        schedule_embeddings(all_chunk_ids)
     
-    # 处理新文档的分类和图片处理
-    if new_content_ids:
-        # 分离图片和非图片内容
-        image_content_ids = []
-        text_content_ids = []
-        
-        for content_id in new_content_ids:
-            content = db.query(Content).filter(Content.id == content_id).first()
-            if content and content.modality == 'image' and content.meta.get("processing_status") == "pending":
-                image_content_ids.append(content_id)
-            else:
-                text_content_ids.append(content_id)
-        
+    if deleted_files or new_files or updated_files:
+        bump_corpus_version()
+    
+    # 处理新文档的分类和图片处理（图片与非图片内容在创建时已区分）
+    if image_content_ids or text_content_ids:
         # 立即批量快速分类非图片文档
         if text_content_ids:
             from app.workers.quick_tasks import batch_quick_classify
@@ -271,6 +291,7 @@ def ingest_scan(db: Session = Depends(get_db)):
         "status": "ok",
         "files_scanned": len(docs),
         "new_files": new_files,
+        "updated_files": updated_files,
         "skipped_files": skipped_files,
         "deleted_files": deleted_files,
         "new_chunks": total_chunks
@@ -281,13 +302,16 @@ class IngestRequest(BaseModel):
 
 @router.post("/upload")
 async def upload_file(file: UploadFile = File(...), db: Session = Depends(get_db)):
-    """单文件上传接口"""
-    return await _process_single_file(file, db)
+    """单文件上传接口（202：文件已保存，后台处理中，可通过 /status/{content_id} 查询进度）"""
+    return JSONResponse(content=await _process_single_file(file, db), status_code=202)
 
 @router.post("/upload-multiple")
 async def upload_multiple_files(files: List[UploadFile] = File(...), db: Session = Depends(get_db)):
     """
     多文件批量上传接口
+
+    文件并发写盘（UPLOAD_BATCH_CONCURRENCY），Content 记录在同一事务中创建，
+    整批文件的解析、分块和分类作为一个后台批量任务处理
     """
     try:
         results = []
@@ -308,24 +332,52 @@ async def upload_multiple_files(files: List[UploadFile] = File(...), db: Session
                 detail=f"文件总大小不能超过500MB，当前：{total_size / 1024 / 1024:.1f}MB"
             )
         
-        # 处理每个文件
-        for i, file in enumerate(files):
+        # 并发流式保存所有文件（有界并发，单个文件失败不影响其他文件）
+        semaphore = asyncio.Semaphore(UPLOAD_BATCH_CONCURRENCY)
+        
+        async def save(file: UploadFile):
+            async with semaphore:
+                return await _save_upload_file(file)
+        
+        saved = await asyncio.gather(*(save(file) for file in files), return_exceptions=True)
+        
+        # 所有成功保存的文件在同一事务中创建 Content 记录
+        records = {}
+        content_ids = {}
+        for i, (file, item) in enumerate(zip(files, saved)):
+            if isinstance(item, BaseException):
+                error = item.detail if isinstance(item, HTTPException) else str(item)
+                log.error(f"Failed to process file {file.filename}: {error}")
+                results.append({"index": i, "filename": file.filename, "status": "error", "error": error})
+            else:
+                records[i] = (file, item, _new_upload_content(file.filename, *item))
+        
+        if records:
             try:
-                result = await _process_single_file(file, db)
-                results.append({
-                    "index": i,
-                    "filename": file.filename,
-                    "status": "success",
-                    "result": result
-                })
+                db.add_all([content for _, _, content in records.values()])
+                db.flush()
+                content_ids = {i: str(content.id) for i, (_, _, content) in records.items()}
+                db.commit()
             except Exception as e:
-                log.error(f"Failed to process file {file.filename}: {e}")
-                results.append({
-                    "index": i,
-                    "filename": file.filename,
-                    "status": "error",
-                    "error": str(e)
-                })
+                db.rollback()
+                log.error(f"Failed to create content records for batch upload: {e}")
+                for i, (file, (path, _, _), _) in records.items():
+                    path.unlink(missing_ok=True)
+                    results.append({"index": i, "filename": file.filename, "status": "error", "error": str(e)})
+                records, content_ids = {}, {}
+        
+        for i, (file, (_, file_size, file_hash), _) in records.items():
+            results.append({
+                "index": i,
+                "filename": file.filename,
+                "status": "success",
+                "result": _upload_result(content_ids[i], file.filename, file_size, file_hash)
+            })
+        results.sort(key=lambda r: r["index"])
+        
+        # 整批解析、分块和分类作为一个后台任务投递
+        if content_ids:
+            _dispatch_upload_batch(list(content_ids.values()))
         
         # 统计结果
         success_count = len([r for r in results if r["status"] == "success"])
@@ -346,137 +398,112 @@ async def upload_multiple_files(files: List[UploadFile] = File(...), db: Session
         log.error(f"Batch upload error: {e}")
         raise HTTPException(status_code=500, detail=f"批量上传失败: {str(e)}")
 
+def _write_block(buffer, digest, block: bytes) -> None:
+    digest.update(block)
+    buffer.write(block)
+
+async def _save_upload(file: UploadFile, path: Path) -> Tuple[int, str]:
+    """按固定大小分块把上传文件写入磁盘，同时计算 sha256，不在内存中缓存整个文件"""
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(path, "wb") as buffer:
+            while True:
+                block = await file.read(UPLOAD_CHUNK_SIZE)
+                if not block:
+                    break
+                size += len(block)
+                await run_in_threadpool(_write_block, buffer, digest, block)
+    except Exception:
+        path.unlink(missing_ok=True)
+        raise
+    return size, digest.hexdigest()
+
+def _get_parse_executor() -> ThreadPoolExecutor:
+    global _parse_executor
+    if _parse_executor is None:
+        _parse_executor = ThreadPoolExecutor(max_workers=UPLOAD_PARSE_WORKERS, thread_name_prefix="upload-parse")
+    return _parse_executor
+
+def _dispatch_upload_batch(content_ids: List[str]) -> None:
+    """一次多文件上传的所有文件作为一个批量解析任务投递"""
+    if UPLOAD_PARSE_EXECUTOR == "celery":
+        process_uploaded_batch.apply_async(args=[content_ids], queue="ingest")
+    else:
+        _get_parse_executor().submit(parse_uploaded_batch, content_ids)
+
+def _dispatch_upload_parse(content_id: str) -> None:
+    """把上传文件的解析交给 Celery ingest 队列或 API 进程内的线程池"""
+    if UPLOAD_PARSE_EXECUTOR == "celery":
+        process_uploaded_file.apply_async(args=[content_id], queue="ingest")
+    else:
+        _get_parse_executor().submit(parse_uploaded_content, content_id)
+
+async def _save_upload_file(file: UploadFile) -> Tuple[Path, int, str]:
+    """校验文件类型并保存到持久化目录，返回 (路径, 大小, sha256)"""
+    if not DocumentProcessor().is_supported(file.filename):
+        raise HTTPException(
+            status_code=400, 
+            detail=f"不支持的文件类型: {file.filename}"
+        )
+    
+    upload_dir = Path("/app/uploads")
+    upload_dir.mkdir(parents=True, exist_ok=True)
+    
+    file_id = str(uuid.uuid4())
+    file_extension = Path(file.filename).suffix
+    temp_file_path = upload_dir / f"{file_id}{file_extension}"
+    file_size, file_hash = await _save_upload(file, temp_file_path)
+    return temp_file_path, file_size, file_hash
+
+def _new_upload_content(filename: str, file_path: Path, file_size: int, file_hash: str) -> Content:
+    """上传文件的 Content 记录（processing状态，文本在后台解析后写入）"""
+    return Content(
+        title=filename,
+        text="",
+        modality='text',
+        meta={
+            "source_type": "webui",
+            "processing_status": "processing",
+            "file_size": file_size,
+            "sha256": file_hash,
+            "file_path": str(file_path),  # 保存实际文件路径
+            "upload_timestamp": str(uuid.uuid4())  # 临时用作唯一标识
+        },
+        source_uri=f"webui://{filename}",
+        created_by="webui.upload"
+    )
+
+def _upload_result(content_id: str, filename: str, file_size: int, file_hash: str) -> dict:
+    return {
+        "status": "success",
+        "content_id": content_id,
+        "title": filename,
+        "processing_status": "processing",
+        "chunks_created": 0,
+        "file_size": file_size,
+        "sha256": file_hash,
+        "message": "文件上传成功，正在后台解析和分类..."
+    }
+
 async def _process_single_file(file: UploadFile, db: Session):
     """
-    WebUI文件上传接口 - 立即入库，异步处理
+    WebUI文件上传接口 - 流式落盘并创建 Content 记录后立即返回，解析、分块和分类在后台执行
     """
     try:
-        # 1. 验证文件类型
-        processor = DocumentProcessor()
-        if not processor.is_supported(file.filename):
-            raise HTTPException(
-                status_code=400, 
-                detail=f"不支持的文件类型: {file.filename}"
-            )
-        
-        # 2. 保存文件到持久化目录
-        upload_dir = Path("/app/uploads")
-        upload_dir.mkdir(parents=True, exist_ok=True)
-        
-        file_id = str(uuid.uuid4())
-        file_extension = Path(file.filename).suffix
-        temp_file_path = upload_dir / f"{file_id}{file_extension}"
-        
-        # 保存上传的文件
-        with open(temp_file_path, "wb") as buffer:
-            content = await file.read()
-            buffer.write(content)
-        
-        # 2.5. 如果是图片文件，立即预生成缩略图
-        try:
-            from app.api.files import pregenerate_thumbnail_if_image
-            if pregenerate_thumbnail_if_image(temp_file_path):
-                log.info(f"Pre-generated thumbnail for uploaded image: {file.filename}")
-        except Exception as e:
-            log.warning(f"Failed to pre-generate thumbnail for {file.filename}: {e}")
-        
-        # 3. 立即解析文件内容
-        try:
-            parsed_result = processor.process_file(str(temp_file_path))
-            file_text = parsed_result.get("text", "")
-            file_metadata = parsed_result.get("metadata", {})
-        except Exception as e:
-            log.error(f"文件解析失败: {e}")
-            file_text = ""
-            file_metadata = {"parse_error": str(e)}
-        
-        # 4. 立即创建Content记录（processing状态）
-        content_record = Content(
-            title=file.filename,
-            text=file_text,
-            modality='image' if file_metadata.get('detected_type') == 'image' else 'text',
-            meta={
-                **file_metadata,
-                "source_type": "webui",
-                "processing_status": "processing",
-                "file_size": len(content),
-                "file_path": str(temp_file_path),  # 保存实际文件路径
-                "upload_timestamp": str(uuid.uuid4())  # 临时用作唯一标识
-            },
-            source_uri=f"webui://{file.filename}",
-            created_by="webui.upload"
-        )
+        # 1. 验证文件类型并保存到持久化目录（分块写入并计算哈希）
+        file_path, file_size, file_hash = await _save_upload_file(file)
         
+        # 2. 创建Content记录
+        content_record = _new_upload_content(file.filename, file_path, file_size, file_hash)
         db.add(content_record)
         db.commit()
-        db.refresh(content_record)
-        
-        # 5. 立即进行文本分块
-        chunk_ids = []
-        if file_text:
-            seq = 0
-            for chunk_text in simple_chunk(file_text):
-                chunk = Chunk(
-                    content_id=content_record.id,
-                    seq=seq,
-                    text=chunk_text,
-                    meta={"source_uri": content_record.source_uri}
-                )
-                db.add(chunk)
-                seq += 1
-            
-            db.commit()
-            db.refresh(content_record)
-            chunk_ids = [str(chunk.id) for chunk in content_record.chunks]
-        
-        # 6. 异步处理任务（高优先级）
-        # 生成向量embeddings
-        if chunk_ids:
-            generate_embeddings.apply_async(
-                args=[chunk_ids],
-                queue="heavy",
-                priority=8
-            )
-        
-        # 快速分类（立即执行，最高优先级）
-        from app.workers.quick_tasks import quick_classify_content
-        quick_classify_content.apply_async(
-            args=[str(content_record.id)],
-            queue="quick",
-            priority=10,  # 最高优先级
-            countdown=1   # 1秒后执行
-        )
-        
-        # 智能合集匹配（在快速分类之后执行）
-        from app.workers.quick_tasks import match_document_to_collections
-        match_document_to_collections.apply_async(
-            args=[str(content_record.id)],
-            queue="quick",
-            priority=9,   # 次高优先级
-            countdown=3   # 3秒后执行，确保快速分类完成
-        )
+        content_id = str(content_record.id)
         
-        # AI精确分类（最后执行，覆盖快速分类）
-        classify_content.apply_async(
-            args=[str(content_record.id)],
-            queue="classify",
-            priority=7,
-            countdown=5   # 5秒后执行，足够等待快速分类和合集匹配完成
-        )
+        # 3. 后台解析、分块、生成向量并分类（文件保留在持久化目录中）
+        _dispatch_upload_parse(content_id)
         
-        # 7. 保留文件（持久化存储，不删除）
-        # 文件现在保存在持久化目录中，不需要删除
-        
-        # 8. 返回结果
-        return {
-            "status": "success",
-            "content_id": str(content_record.id),
-            "title": file.filename,
-            "processing_status": "processing",
-            "chunks_created": len(chunk_ids),
-            "file_size": len(content),
-            "message": "文件上传成功，正在后台处理分类..."
-        }
+        return _upload_result(content_id, file.filename, file_size, file_hash)
         
     except HTTPException:
         raise
@@ -537,3 +564,16 @@ async def ingest_file_endpoint(req: IngestRequest):
     payload = {"task_id": str(result.id), "message": f"File {req.path} scheduled for ingest"}
     return JSONResponse(content=payload, status_code=202)
 
+
+@router.post("/chunking/benchmark")
+def benchmark_chunking_endpoint(
+    repeat: int = Query(3, ge=1, le=20, description="每种分块方式重复次数")
+):
+    """
+    用合成文档对比结构化分块与旧版 simple_chunk 的吞吐和块大小分布
+    """
+    try:
+        return benchmark_chunking(repeat=repeat)
+    except Exception as e:
+        log.error(f"分块基准测试失败: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
@@ -37,7 +37,7 @@ class ReportRequest(BaseModel):
     date_range: Optional[str] = "today"  # today, this_week, this_month
 
 @router.post("/ask")
-async def ask_question(
+def ask_question(
     request: QARequest,
     db: Session = Depends(get_db)
 ):
@@ -58,7 +58,7 @@ async def ask_question(
     return result
 
 @router.post("/generate-report")
-async def generate_report(
+def generate_report(
     request: ReportRequest,
     db: Session = Depends(get_db)
 ):
@@ -150,7 +150,7 @@ async def generate_report(
         return {"error": f"生成日报失败: {str(e)}"}
 
 @router.get("/history")
-async def get_qa_history(
+def get_qa_history(
     session_id: Optional[str] = None,
     limit: int = 20,
     db: Session = Depends(get_db)
@@ -166,7 +166,7 @@ async def get_qa_history(
     }
 
 @router.post("/feedback")
-async def update_feedback(
+def update_feedback(
     request: FeedbackRequest,
     db: Session = Depends(get_db)
 ):
@@ -181,7 +181,7 @@ async def update_feedback(
     }
 
 @router.get("/sessions")
-async def get_active_sessions(
+def get_active_sessions(
     limit: int = 10,
     db: Session = Depends(get_db)
 ):
@@ -193,7 +193,7 @@ async def get_active_sessions(
     }
 
 @router.get("/test")
-async def test_qa_service(db: Session = Depends(get_db)):
+def test_qa_service(db: Session = Depends(get_db)):
     """测试 QA 服务配置和 Turing API 连接"""
     qa_service = QAService(db)
     
@@ -2,6 +2,11 @@ from fastapi import APIRouter, Query, Depends
 from app.db import SessionLocal
 from app.models import Content, Chunk
 from app.services.search_service import SearchService
+from app.services.vector_index_service import VectorIndexService
+from app.services.keyword_index import KeywordIndex
+from app.services.search_fusion import FUSION_STRATEGIES
+from app.services.search_evaluation import SearchEvaluationService
+from app.services.search_cache import search_result_cache
 from sqlalchemy.orm import Session
 from typing import Optional
 import re
@@ -20,12 +25,20 @@ def get_db():
         db.close()
 
 @router.get("/")
-async def search(
+def search(
     query: str = Query(None, alias="q", description="搜索查询"),
     top_k: int = Query(8, description="返回结果数量"),
     search_type: str = Query("hybrid", description="搜索类型: keyword, semantic, hybrid"),
     modality: Optional[str] = Query(None, description="内容类型过滤"),
     category: Optional[str] = Query(None, description="分类过滤"),
+    collection_id: Optional[str] = Query(None, description="合集过滤"),
+    date_from: Optional[str] = Query(None, description="创建时间下限，如 2024-01-01"),
+    date_to: Optional[str] = Query(None, description="创建时间上限，如 2024-12-31"),
+    ef_search: Optional[int] = Query(None, ge=1, le=1000, description="HNSW 索引搜索参数 ef_search"),
+    probes: Optional[int] = Query(None, ge=1, le=1000, description="IVFFlat 索引搜索参数 probes"),
+    fusion: Optional[str] = Query(None, description="混合搜索融合策略: weighted, rrf, weighted_rrf, linear"),
+    candidate_depth: Optional[int] = Query(None, ge=1, le=200, description="混合搜索每一路的候选数量，默认等于 top_k"),
+    supporting_chunks: int = Query(0, ge=0, le=20, description="每个文档额外返回的命中 chunk ID 数量"),
     db: Session = Depends(get_db)
 ):
     """
@@ -37,6 +50,18 @@ async def search(
         filters["modality"] = modality
     if category:
         filters["category"] = category
+    if collection_id:
+        filters["collection_id"] = collection_id
+    if date_from:
+        filters["date_from"] = date_from
+    if date_to:
+        filters["date_to"] = date_to
+    if ef_search:
+        filters["ef_search"] = ef_search
+    if probes:
+        filters["probes"] = probes
+    if supporting_chunks:
+        filters["supporting_chunks"] = supporting_chunks
     
     try:
         # URL解码查询参数
@@ -52,9 +77,23 @@ async def search(
                 "error": "Query parameter is required"
             }
 
+        if fusion and fusion not in FUSION_STRATEGIES:
+            return {
+                "query": decoded_query,
+                "results": [],
+                "total": 0,
+                "response_time": 0,
+                "search_type": search_type,
+                "embedding_enabled": True,
+                "error": f"Unknown fusion strategy: {fusion}"
+            }
+
         # 使用搜索服务
         search_service = SearchService(db)
-        results = search_service.search(decoded_query, top_k, search_type, filters)
+        results = search_service.search(
+            decoded_query, top_k, search_type, filters,
+            fusion=fusion, candidate_depth=candidate_depth
+        )
         
         # 确保返回有效的JSON
         if not isinstance(results, dict):
@@ -82,7 +121,7 @@ async def search(
         }
 
 @router.get("/suggestions")
-async def get_search_suggestions(
+def get_search_suggestions(
     q: str = Query(..., description="部分查询"),
     limit: int = Query(5, description="建议数量"),
     db: Session = Depends(get_db)
@@ -99,7 +138,7 @@ async def get_search_suggestions(
     }
 
 @router.get("/category/{category_id}")
-async def search_by_category(
+def search_by_category(
     category_id: str,
     q: Optional[str] = Query(None, description="搜索查询"),
     top_k: int = Query(20, description="返回结果数量"),
@@ -133,7 +172,7 @@ async def search_by_category(
         }
 
 @router.get("/categories/stats")
-async def get_category_search_stats(db: Session = Depends(get_db)):
+def get_category_search_stats(db: Session = Depends(get_db)):
     """
     获取分类统计信息用于搜索筛选
     """
@@ -141,3 +180,116 @@ async def get_category_search_stats(db: Session = Depends(get_db)):
     stats = search_service.get_category_stats()
     
     return stats
+
+
+@router.get("/index/status")
+def get_vector_index_status(db: Session = Depends(get_db)):
+    """
+    获取向量 ANN 索引状态
+    """
+    try:
+        return VectorIndexService(db).get_index_status()
+    except Exception as e:
+        logger.error(f"Vector index status error: {e}")
+        return {"error": str(e)}
+
+@router.post("/index/build")
+def build_vector_index(
+    method: Optional[str] = Query(None, description="索引类型: hnsw, ivfflat"),
+    m: Optional[int] = Query(None, ge=2, le=100, description="HNSW m"),
+    ef_construction: Optional[int] = Query(None, ge=4, le=1000, description="HNSW ef_construction"),
+    lists: Optional[int] = Query(None, ge=1, description="IVFFlat lists"),
+    db: Session = Depends(get_db)
+):
+    """
+    构建或重建向量 ANN 索引（在线重建，不阻塞写入）
+    """
+    return VectorIndexService(db).build_index(
+        method=method, m=m, ef_construction=ef_construction, lists=lists
+    )
+
+@router.get("/index/recall")
+def evaluate_vector_index_recall(
+    sample_size: int = Query(20, ge=1, le=200, description="查询样本数量"),
+    top_k: int = Query(10, ge=1, le=100, description="评估的 k 值"),
+    ef_search: Optional[str] = Query(None, description="待评估的 ef_search 列表，逗号分隔，如 40,80,160"),
+    probes: Optional[str] = Query(None, description="待评估的 probes 列表，逗号分隔，如 1,10,20"),
+    rerank_factor: Optional[str] = Query(None, description="压缩索引下待评估的重排候选倍数列表，逗号分隔，如 1,2,4,8"),
+    db: Session = Depends(get_db)
+):
+    """
+    ANN 索引召回率/延迟报告（对比精确搜索；压缩索引按完整向量重排后计算召回率）
+    """
+    def _parse_values(value: Optional[str]):
+        if not value:
+            return None
+        return [int(v) for v in value.split(",") if v.strip().isdigit()]
+
+    try:
+        return VectorIndexService(db).evaluate_recall(
+            sample_size=sample_size,
+            top_k=top_k,
+            ef_search_values=_parse_values(ef_search),
+            probes_values=_parse_values(probes),
+            rerank_factors=_parse_values(rerank_factor)
+        )
+    except Exception as e:
+        logger.error(f"Vector index recall evaluation error: {e}")
+        return {"success": False, "error": str(e)}
+
+@router.get("/keyword-index/status")
+def get_keyword_index_status(db: Session = Depends(get_db)):
+    """
+    关键词倒排索引覆盖情况
+    """
+    try:
+        return KeywordIndex(db).get_status()
+    except Exception as e:
+        logger.error(f"Keyword index status error: {e}")
+        return {"success": False, "error": str(e)}
+
+@router.post("/keyword-index/backfill")
+def backfill_keyword_index(
+    batch_size: int = Query(500, ge=10, le=5000, description="每批处理数量"),
+    rebuild: bool = Query(False, description="是否全部重建（分词规则变化后使用）"),
+    db: Session = Depends(get_db)
+):
+    """
+    补全或重建关键词倒排索引
+    """
+    try:
+        return {"success": True, **KeywordIndex(db).backfill(batch_size=batch_size, rebuild=rebuild)}
+    except Exception as e:
+        logger.error(f"Keyword index backfill error: {e}")
+        return {"success": False, "error": str(e)}
+
+@router.get("/fusion/evaluate")
+def evaluate_fusion(
+    strategies: Optional[str] = Query(None, description="待评估的融合策略，逗号分隔，默认全部"),
+    depths: Optional[str] = Query(None, description="待评估的候选深度，逗号分隔，如 5,10,20"),
+    top_k: int = Query(5, ge=1, le=50, description="评估的最终结果数量"),
+    limit: int = Query(200, ge=1, le=2000, description="回放的问答记录数量"),
+    include_unrated: bool = Query(True, description="是否包含未评价的问答记录"),
+    db: Session = Depends(get_db)
+):
+    """
+    基于问答历史的融合策略 / 候选深度离线评估
+    """
+    try:
+        return SearchEvaluationService(db).evaluate(
+            strategies=[s.strip() for s in strategies.split(",") if s.strip()] if strategies else None,
+            depths=[int(d) for d in depths.split(",") if d.strip().isdigit()] if depths else None,
+            top_k=top_k,
+            limit=limit,
+            include_unrated=include_unrated
+        )
+    except Exception as e:
+        logger.error(f"Fusion evaluation error: {e}")
+        return {"success": False, "error": str(e)}
+
+@router.get("/cache/stats")
+def get_search_cache_stats():
+    """
+    搜索结果缓存统计（当前进程）
+    """
+    return search_result_cache.stats()
@@ -4,9 +4,15 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import RedirectResponse
 from app.db import engine, Base
 from app.models import Content, Chunk, QAHistory, AgentTask, MCPTool, OpsLog, Category, ContentCategory, Collection
+from app.services.vector_index_service import ensure_vector_index
+from app.services.keyword_index import ensure_keyword_index, ensure_keyword_columns
+from app.services.openai_clients import openai_clients
+import threading
 
 # 创建数据库表结构
 Base.metadata.create_all(bind=engine)
+# 已有表补充 ORM 映射的新列（必须在处理请求之前完成）
+ensure_keyword_columns()
 
 app = FastAPI(
         title="PKB-backend",
@@ -44,6 +50,16 @@ app.include_router(collection.router, prefix="/api/collection", tags=["collectio
 app.include_router(files.router, prefix="/api/files", tags=["files"])
 app.include_router(operator.router, prefix="/api/operator", tags=["operator"])
 
+@app.on_event("startup")
+def ensure_indexes():
+    # 后台确保向量 ANN 索引与关键词倒排索引存在，避免大表建索引阻塞启动
+    threading.Thread(target=ensure_vector_index, daemon=True).start()
+    threading.Thread(target=ensure_keyword_index, daemon=True).start()
+
+@app.on_event("shutdown")
+def close_openai_clients():
+    openai_clients.close()
+
 @app.get("/", include_in_schema=False)
 def root():
     response = RedirectResponse(url="/api/docs")
@@ -57,3 +73,9 @@ def root():
 @app.get("/api/health")
 def health():
     return {"status": "ok"}
+
+
+@app.get("/api/health/openai")
+def openai_client_health():
+    # 共享 OpenAI 客户端的连接池状态与各用途请求统计
+    return openai_clients.stats()
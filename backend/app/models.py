@@ -1,5 +1,5 @@
 from sqlalchemy import Column, String, Text, JSON, TIMESTAMP, Integer, ForeignKey, Float, Boolean
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.dialects.postgresql import UUID, TSVECTOR
 from sqlalchemy.orm import relationship
 from pgvector.sqlalchemy import Vector
 import uuid
@@ -16,6 +16,7 @@ class Content(Base):
     tags       = Column(JSON, nullable=True)        # AI 生成的标签
     category   = Column(String, nullable=True)      # AI 生成的分类
     meta       = Column(JSON, nullable=True)        # {people, project, topics, ...}
+    search_vector = Column(TSVECTOR, nullable=True) # 标题/关键词倒排词项（见 keyword_index）
     
     # 统计信息
     access_count = Column(Integer, default=0)
@@ -45,12 +46,54 @@ class Chunk(Base):
     chunk_type = Column(String, default="paragraph") # paragraph|title|list|code|table
     token_count = Column(Integer, nullable=True)
     char_count = Column(Integer, nullable=True)
+    search_vector = Column(TSVECTOR, nullable=True) # 正文倒排词项（见 keyword_index）
     
     created_at = Column(TIMESTAMP, server_default="now()")
     
     # 关系
     content = relationship("Content", back_populates="chunks")
 
+class EmbeddingStat(Base):
+    """向量覆盖率统计（单行表，由 generate_embeddings 增量累加，删除 chunk 时扣减，向量列切换后标记为过期）"""
+    __tablename__ = "embedding_stats"
+    id = Column(Integer, primary_key=True, default=1)
+    embedded_chunks = Column(Integer, default=0)     # 已生成向量的 chunk 数量
+    is_stale = Column(Boolean, default=True)         # 是否需要重新全量统计
+    refreshed_at = Column(TIMESTAMP, nullable=True)  # 上次全量统计时间
+    updated_at = Column(TIMESTAMP, server_default="now()")
+
+class EmbeddingStoreEntry(Base):
+    """内容寻址向量存储（按 模型 + 规范化文本 sha256 去重，相同文本不再重复调用 embedding API）"""
+    __tablename__ = "embedding_store"
+    model = Column(String, primary_key=True)
+    text_hash = Column(String(64), primary_key=True)   # sha256(规范化文本)
+    embedding = Column(Vector(), nullable=False)       # 不限定维度，可同时保存不同模型的向量
+    hit_count = Column(Integer, default=0)             # 被复用次数
+    created_at = Column(TIMESTAMP, server_default="now()")
+    last_used_at = Column(TIMESTAMP, server_default="now()")
+
+class EmbeddingMigration(Base):
+    """向量模型迁移任务（影子列回填 + keyset 检查点，见 embedding_migration）"""
+    __tablename__ = "embedding_migrations"
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    source_model = Column(String, nullable=True)
+    target_model = Column(String, nullable=False)
+    dimension = Column(Integer, nullable=False)
+    status = Column(String, default="pending")         # pending|running|paused|backfilled|switched|rolled_back|cancelled|failed
+    checkpoint_id = Column(UUID(as_uuid=True), nullable=True)  # 本轮已处理到的最大 chunk id
+    pass_number = Column(Integer, default=1)           # 第几轮遍历（后续轮次补齐新增和失败的 chunk）
+    total_chunks = Column(Integer, default=0)
+    processed_chunks = Column(Integer, default=0)
+    failed_chunks = Column(Integer, default=0)
+    batch_delay = Column(Float, default=0)             # 当前批次间隔（秒），遇到限流时自动拉长
+    rows_per_sec = Column(Float, nullable=True)        # 回填吞吐（指数滑动平均）
+    lease_owner = Column(String, nullable=True)        # 持有执行租约的任务 ID
+    lease_until = Column(TIMESTAMP, nullable=True)
+    error = Column(Text, nullable=True)
+    created_at = Column(TIMESTAMP, server_default="now()")
+    updated_at = Column(TIMESTAMP, server_default="now()")
+    switched_at = Column(TIMESTAMP, nullable=True)
+
 class QAHistory(Base):
     """问答历史"""
     __tablename__ = "qa_history"
@@ -8,13 +8,7 @@ import logging
 from typing import Dict, Any, Optional
 from pathlib import Path
 
-# 导入 OpenAI 客户端
-try:
-    from openai import OpenAI
-    OPENAI_AVAILABLE = True
-except ImportError:
-    OpenAI = None
-    OPENAI_AVAILABLE = False
+from app.services.openai_clients import get_openai_client, OPENAI_AVAILABLE
 
 logger = logging.getLogger(__name__)
 
@@ -44,13 +38,10 @@ class ImageParser:
             return
         
         try:
-            # 创建 Turing API 客户端
-            self.openai_client = OpenAI(
-                api_key=self.turing_api_key,
-                base_url=self.turing_api_base
-            )
+            # 复用进程内共享的 Turing API 客户端
+            self.openai_client = get_openai_client("vision", self.turing_api_key, self.turing_api_base)
             self.openai_enabled = True
-            logger.info(f"Vision client initialized successfully with model: {self.vision_model}")
+            logger.debug(f"Vision client initialized successfully with model: {self.vision_model}")
         except Exception as e:
             logger.error(f"Failed to initialize GPT-4V client: {e}")
             self.openai_enabled = False
@@ -9,6 +9,8 @@ import logging
 from sqlalchemy import text
 from app.db import SessionLocal, engine, Base
 from app.models import Content, Chunk, QAHistory, AgentTask, MCPTool, OpsLog
+from app.services.vector_index_service import ensure_vector_index
+from app.services.keyword_index import ensure_keyword_index
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -32,7 +34,9 @@ def reset_database():
                 'mcp_tools',
                 'chunks',      # 有外键到 contents
                 'contents',
-                'ops_log'
+                'ops_log',
+                'embedding_stats',
+                'embedding_migrations'
             ]
             
             for table_name in tables_to_drop:
@@ -53,6 +57,12 @@ def reset_database():
         Base.metadata.create_all(bind=engine)
         logger.info("✅ All tables created successfully")
         
+        # 创建向量 ANN 索引
+        ensure_vector_index()
+        logger.info("✅ Vector index ensured")
+        ensure_keyword_index()
+        logger.info("✅ Keyword index ensured")
+        
         # 3. 验证表创建
         db = SessionLocal()
         try:
@@ -10,15 +10,10 @@ from sqlalchemy.orm import Session
 from sqlalchemy import func
 
 from app.models import Category, Content, ContentCategory
+from app.services.search_cache import bump_corpus_version
 import uuid
 
-# 导入 OpenAI 客户端
-try:
-    from openai import OpenAI
-    OPENAI_AVAILABLE = True
-except ImportError:
-    OpenAI = None
-    OPENAI_AVAILABLE = False
+from app.services.openai_clients import get_openai_client, OPENAI_AVAILABLE
 
 logger = logging.getLogger(__name__)
 
@@ -76,13 +71,10 @@ class CategoryService:
             return
         
         try:
-            # 创建 Turing API 客户端
-            self.openai_client = OpenAI(
-                api_key=self.turing_api_key,
-                base_url=self.turing_api_base
-            )
+            # 复用进程内共享的 Turing API 客户端
+            self.openai_client = get_openai_client("classification", self.turing_api_key, self.turing_api_base)
             self.openai_enabled = True
-            logger.info(f"Classification service initialized with model: {self.classification_model}")
+            logger.debug(f"Classification service initialized with model: {self.classification_model}")
         except Exception as e:
             logger.error(f"Failed to initialize classification client: {e}")
             self.openai_enabled = False
@@ -189,6 +181,7 @@ class CategoryService:
             
             self.db.add(content_category)
             self.db.commit()
+            bump_corpus_version()
             
             logger.info(f"Successfully classified content {content_id} as {category.name}")
             
@@ -0,0 +1,234 @@
+"""
+批量写入 chunks
+所有入库路径共用：chunk ID 在客户端生成，整批通过一条多行 INSERT（行数较多时使用 COPY）写入，
+不再逐个构造 ORM 对象、提交后 refresh 重新加载 content.chunks 取回 ID。
+Core 写入不会触发 ORM 的 before_insert 事件，search_vector、char_count、token_count 在这里直接计算。
+重新入库（文件内容变化、图片重新解析）时按 chunk 文本哈希与已有 chunks 比对，未变化的 chunk 连同向量保留
+"""
+import io
+import os
+import json
+import uuid
+import hashlib
+import logging
+from typing import Any, Dict, List, Optional, Sequence, Union
+
+from sqlalchemy import insert, update
+from sqlalchemy.orm import Session
+
+from app.models import Chunk
+from app.services.embedding_stats_service import EmbeddingStatsService
+from app.services.keyword_index import chunk_search_vector
+from app.services.vector_writer import estimate_token_count
+
+logger = logging.getLogger(__name__)
+
+# 行数达到该值时使用 COPY 写入（驱动不支持时退回多行 INSERT）
+CHUNK_COPY_MIN_ROWS = int(os.getenv("CHUNK_COPY_MIN_ROWS", "200"))
+
+COPY_COLUMNS = ("id", "content_id", "seq", "text", "meta", "chunk_type", "token_count", "char_count", "search_vector")
+
+ChunkInput = Union[str, Dict[str, Any]]
+
+
+def _copy_field(value: Any) -> str:
+    """按 COPY 文本格式转义单个字段"""
+    if value is None:
+        return "\\N"
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def chunk_hash(text: str) -> str:
+    """chunk 文本的 sha256（按原文比对，空白差异也视为修改）"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _normalize_items(
+    chunks: Sequence[ChunkInput],
+    meta: Optional[Dict[str, Any]],
+    start_seq: int,
+    with_position: bool,
+) -> List[Dict[str, Any]]:
+    """统一为 {"text", "chunk_type", "meta", "seq"}，meta 为合并后的最终元数据"""
+    items = []
+    total = len(chunks)
+    for i, item in enumerate(chunks):
+        if isinstance(item, str):
+            item = {"text": item}
+        seq = item.get("seq", start_seq + i)
+        row_meta = dict(meta or {})
+        if with_position:
+            row_meta.update({"chunk_index": seq, "total_chunks": total})
+        row_meta.update(item.get("meta") or {})
+        items.append({
+            "text": item["text"],
+            "chunk_type": item.get("chunk_type") or "paragraph",
+            "meta": row_meta,
+            "seq": seq,
+        })
+    return items
+
+
+class ChunkStore:
+    """chunks 的批量写入（与调用方共用数据库会话，调用方负责提交）"""
+
+    def __init__(self, db: Session):
+        self.db = db
+
+    def build_rows(
+        self,
+        content_id: Any,
+        chunks: Sequence[ChunkInput],
+        meta: Optional[Dict[str, Any]] = None,
+        start_seq: int = 0,
+        with_position: bool = False,
+    ) -> List[Dict[str, Any]]:
+        """
+        构造待写入的行
+
+        Args:
+            content_id: 所属 content ID
+            chunks: chunk 文本，或 {"text", "chunk_type", "meta", "seq"} 字典
+            meta: 每个 chunk 共用的元数据（如 source_uri），与条目自身的 meta 合并
+            start_seq: 起始序号（条目未指定 seq 时按顺序编号）
+            with_position: 在 meta 中写入 chunk_index / total_chunks
+
+        Returns:
+            行字典列表（id 为客户端生成的 UUID）
+        """
+        return [
+            self._row(content_id, item)
+            for item in _normalize_items(chunks, meta, start_seq, with_position)
+        ]
+
+    @staticmethod
+    def _row(content_id: Any, item: Dict[str, Any]) -> Dict[str, Any]:
+        text = item["text"]
+        return {
+            "id": uuid.uuid4(),
+            "content_id": content_id,
+            "seq": item["seq"],
+            "text": text,
+            "meta": item["meta"],
+            "chunk_type": item["chunk_type"],
+            "token_count": estimate_token_count(text),
+            "char_count": len(text),
+            "search_vector": chunk_search_vector(text) or "",
+        }
+
+    def insert(
+        self,
+        content_id: Any,
+        chunks: Sequence[ChunkInput],
+        meta: Optional[Dict[str, Any]] = None,
+        start_seq: int = 0,
+        with_position: bool = False,
+    ) -> List[str]:
+        """
+        批量写入一个 content 的 chunks（参数见 build_rows）
+
+        Returns:
+            新 chunk 的 ID 列表（按 seq 顺序）
+        """
+        rows = self.build_rows(content_id, chunks, meta, start_seq, with_position)
+        self.insert_rows(rows)
+        return [str(row["id"]) for row in rows]
+
+    def sync(
+        self,
+        content_id: Any,
+        chunks: Sequence[ChunkInput],
+        meta: Optional[Dict[str, Any]] = None,
+        with_position: bool = False,
+    ) -> Dict[str, Any]:
+        """
+        用新的切片结果增量更新一个 content 的 chunks
+
+        按文本哈希与已有 chunks 配对（相同文本出现多次时按出现顺序逐个配对）：
+        配对成功的 chunk 保留 ID 和向量，只在序号、类型或元数据变化时更新这些列；
+        未配对的旧 chunk 删除（按其中已有向量的数量扣减向量覆盖率计数），未配对的新 chunk 批量写入
+
+        Returns:
+            {"chunk_ids": 全部 chunk ID（按 seq 顺序）, "inserted", "kept", "deleted",
+             "embed_ids": 需要生成向量的 chunk ID（新写入的，以及保留但尚无向量的）}
+        """
+        items = _normalize_items(chunks, meta, 0, with_position)
+
+        existing: Dict[str, List[Any]] = {}
+        for row in (
+            self.db.query(Chunk.id, Chunk.seq, Chunk.meta, Chunk.chunk_type, Chunk.text, Chunk.embedding.is_(None))
+            .filter(Chunk.content_id == content_id)
+            .order_by(Chunk.seq)
+        ):
+            existing.setdefault(chunk_hash(row[4]), []).append(row)
+
+        chunk_ids: List[str] = []
+        embed_ids: List[str] = []
+        updates: List[Dict[str, Any]] = []
+        new_rows: List[Dict[str, Any]] = []
+        for item in items:
+            matches = existing.get(chunk_hash(item["text"]))
+            if matches:
+                chunk_id, seq, old_meta, chunk_type, _, missing_embedding = matches.pop(0)
+                if (seq, old_meta, chunk_type) != (item["seq"], item["meta"], item["chunk_type"]):
+                    updates.append({
+                        "id": chunk_id, "seq": item["seq"], "meta": item["meta"], "chunk_type": item["chunk_type"]
+                    })
+                if missing_embedding:
+                    embed_ids.append(str(chunk_id))
+                chunk_ids.append(str(chunk_id))
+            else:
+                row = self._row(content_id, item)
+                new_rows.append(row)
+                embed_ids.append(str(row["id"]))
+                chunk_ids.append(str(row["id"]))
+
+        stale = [row for rows in existing.values() for row in rows]
+        stale_ids = [row[0] for row in stale]
+        if stale_ids:
+            self.db.query(Chunk).filter(Chunk.id.in_(stale_ids)).delete(synchronize_session=False)
+            EmbeddingStatsService(self.db).record_deleted(sum(1 for row in stale if not row[5]))
+        if updates:
+            self.db.execute(update(Chunk), updates)
+        self.insert_rows(new_rows)
+
+        return {
+            "chunk_ids": chunk_ids,
+            "inserted": len(new_rows),
+            "kept": len(items) - len(new_rows),
+            "deleted": len(stale_ids),
+            "embed_ids": embed_ids,
+        }
+
+    def insert_rows(self, rows: List[Dict[str, Any]]) -> None:
+        """写入 build_rows 构造的行（可以包含多个 content 的 chunks）"""
+        if not rows:
+            return
+        # 会话未开启 autoflush：先把同一事务中新建的 content 写入数据库，保证外键可见
+        self.db.flush()
+        if len(rows) >= CHUNK_COPY_MIN_ROWS and self._copy_rows(rows):
+            return
+        # psycopg2 下 SQLAlchemy 把 executemany 合并为多行 VALUES 批量发送
+        self.db.execute(insert(Chunk.__table__), rows)
+
+    def _copy_rows(self, rows: List[Dict[str, Any]]) -> bool:
+        """COPY 写入，驱动不支持时返回 False"""
+        cursor = self.db.connection().connection.cursor()
+        try:
+            if not hasattr(cursor, "copy_expert"):
+                return False
+            buffer = io.StringIO()
+            for row in rows:
+                values = dict(row, meta=json.dumps(row["meta"], ensure_ascii=False))
+                buffer.write("\t".join(_copy_field(values[column]) for column in COPY_COLUMNS) + "\n")
+            buffer.seek(0)
+            cursor.copy_expert(f"COPY chunks ({', '.join(COPY_COLUMNS)}) FROM STDIN", buffer)
+            return True
+        finally:
+            cursor.close()
@@ -0,0 +1,331 @@
+"""
+结构感知的文档分块
+按 token 预算切分并在同一章节内保留重叠：Markdown 标题（含解析器提取的标题）与 PDF 分页标记
+（=== 第 N 页 ===）是硬边界，代码块、表格、列表尽量整块保留；超出预算的段落按中英文句子边界切开，
+单句仍超出时按字符切分。每个块只估算一次 token，累积过程为线性时间
+"""
+import os
+import re
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.services.embedding_batcher import estimate_tokens
+
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "400"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "50"))
+
+PAGE_MARKER_RE = re.compile(r"^=== 第 (\d+) 页 ===$")
+MD_HEADING_RE = re.compile(r"^(#{1,6})\s+(.+?)\s*#*$")
+FENCE_RE = re.compile(r"^(```|~~~)")
+LIST_ITEM_RE = re.compile(r"^\s*(?:[-*+•]\s+|\d+[.)、]\s*)")
+# 句子：中文句末标点（可跟引号/括号）或英文句末标点后接空白
+SENTENCE_RE = re.compile(r".+?(?:[。！？；…]+[”’」』）)\"']*|[.!?;]+(?:\s+|$)|\n|$)", re.S)
+MARKDOWN_INLINE_RE = re.compile(r"[*_`]")
+
+_LIST_MARKERS = frozenset("-*+•0123456789")
+
+# 块类型与 Chunk.chunk_type 一致：paragraph | title | list | code | table
+
+
+class _Unit:
+    """不超过预算的最小装箱单位：一个完整块或超长块切出的一段"""
+    __slots__ = ("text", "tokens", "kind", "sep")
+
+    def __init__(self, text: str, tokens: int, kind: str, sep: str):
+        self.text = text
+        self.tokens = tokens
+        self.kind = kind
+        self.sep = sep
+
+
+def _heading_levels(metadata: Optional[Dict[str, Any]]) -> Dict[str, int]:
+    """解析器（MarkdownParser）提取的标题；纯文本中标题行已去掉 # 和行内标记"""
+    headings = ((metadata or {}).get("structure") or {}).get("headings") or []
+    levels = {}
+    for heading in headings:
+        title = MARKDOWN_INLINE_RE.sub("", str(heading.get("title", ""))).strip()
+        if title:
+            levels.setdefault(title, int(heading.get("level") or 1))
+    return levels
+
+
+def parse_blocks(text: str, metadata: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """
+    把文本切分为结构块
+
+    Returns:
+        [{"kind": paragraph|title|list|code|table|page, "text", "level"?, "page"?}]
+    """
+    heading_levels = _heading_levels(metadata)
+    blocks: List[Dict[str, Any]] = []
+    current: Optional[Dict[str, Any]] = None
+    fence: Optional[str] = None
+
+    def close() -> None:
+        nonlocal current
+        if current is not None:
+            current["text"] = "\n".join(current.pop("lines")).strip("\n")
+            if current["text"].strip():
+                blocks.append(current)
+            current = None
+
+    for line in text.splitlines():
+        stripped = line.strip()
+
+        if fence is not None:
+            current["lines"].append(line)
+            if stripped.startswith(fence):
+                fence = None
+                close()
+            continue
+
+        if not stripped:
+            close()
+            continue
+
+        # 只对可能匹配的行执行正则（按首字符判断）
+        first = stripped[0]
+        fence_match = FENCE_RE.match(stripped) if first in "`~" else None
+        if fence_match:
+            close()
+            fence = fence_match.group(1)
+            current = {"kind": "code", "lines": [line]}
+            continue
+
+        page_match = PAGE_MARKER_RE.match(stripped) if first == "=" else None
+        if page_match:
+            close()
+            blocks.append({"kind": "page", "text": "", "page": int(page_match.group(1))})
+            continue
+
+        heading_match = MD_HEADING_RE.match(stripped) if first == "#" else None
+        if heading_match or stripped in heading_levels:
+            close()
+            level = len(heading_match.group(1)) if heading_match else heading_levels[stripped]
+            title = heading_match.group(2) if heading_match else stripped
+            blocks.append({"kind": "title", "text": stripped, "title": title, "level": level})
+            continue
+
+        if "|" in stripped and stripped.count("|") >= 2:
+            kind = "table"
+        elif first in _LIST_MARKERS and LIST_ITEM_RE.match(line):
+            kind = "list"
+        elif current is not None and current["kind"] == "list" and line[:1].isspace():
+            kind = "list"  # 列表项的缩进续行
+        else:
+            kind = "paragraph"
+
+        if current is None or current["kind"] != kind:
+            close()
+            current = {"kind": kind, "lines": []}
+        current["lines"].append(line)
+
+    close()
+    return blocks
+
+
+def _split_oversized(text: str, kind: str, block_tokens: int, max_tokens: int) -> List[Tuple[str, int, str]]:
+    """
+    把超出预算的块切成不超过预算的片段
+
+    片段的 token 数按字符数分摊整块的估算值（可加，且不必逐片段重新估算）
+
+    Returns:
+        [(片段, token 数, 与前一片段之间的分隔符)]
+    """
+    tokens_per_char = block_tokens / max(len(text), 1)
+
+    if kind in ("code", "table", "list"):
+        # 按行切分；代码与表格行内没有可靠的句子边界
+        pieces = [line + "\n" for line in text.split("\n")]
+        pieces[-1] = pieces[-1].rstrip("\n")
+    else:
+        pieces = SENTENCE_RE.findall(text)
+
+    result: List[Tuple[str, int, str]] = []
+    for piece in pieces:
+        if not piece.strip():
+            continue
+        tokens = max(round(len(piece) * tokens_per_char), 1)
+        if tokens <= max_tokens:
+            result.append((piece, tokens, ""))
+            continue
+        # 单句仍超出预算：按字符数比例硬切
+        step = max(int(max_tokens / tokens_per_char), 1)
+        for start in range(0, len(piece), step):
+            part = piece[start:start + step]
+            result.append((part, max(round(len(part) * tokens_per_char), 1), ""))
+    return result
+
+
+def _chunk_type(units: List[_Unit]) -> str:
+    """块类型取 token 占比最大的内容类型；只有标题时为 title"""
+    weights: Dict[str, int] = {}
+    for unit in units:
+        if unit.kind != "title":
+            weights[unit.kind] = weights.get(unit.kind, 0) + unit.tokens
+    if not weights:
+        return "title"
+    return max(weights, key=weights.get)
+
+
+def chunk_text(
+    text: str,
+    metadata: Optional[Dict[str, Any]] = None,
+    max_tokens: int = CHUNK_MAX_TOKENS,
+    overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+) -> List[Dict[str, Any]]:
+    """
+    结构感知、按 token 预算分块
+
+    Args:
+        text: 文档文本（解析器输出的纯文本或原始 Markdown）
+        metadata: 解析器元数据（使用其中 structure.headings 识别已去掉 # 的标题行）
+        max_tokens: 每块 token 上限
+        overlap_tokens: 同一章节内相邻块的重叠 token 数（标题和分页处不重叠）
+
+    Returns:
+        [{"text", "chunk_type", "meta": {"section"?, "page"?}}]，可直接交给 ChunkStore.insert
+    """
+    if not text or not text.strip():
+        return []
+
+    max_tokens = max(max_tokens, 1)
+    overlap_tokens = min(max(overlap_tokens, 0), max_tokens // 2)
+
+    chunks: List[Dict[str, Any]] = []
+    units: List[_Unit] = []
+    tokens = 0
+    fresh = 0  # 当前块中非重叠、非标题的单位数
+    headings: List[Tuple[int, str]] = []
+    page: Optional[int] = None
+
+    def emit(keep_overlap: bool) -> None:
+        nonlocal units, tokens, fresh
+        if units and (fresh or all(u.kind == "title" for u in units)):
+            body = units[0].text + "".join(u.sep + u.text for u in units[1:])
+            meta: Dict[str, Any] = {}
+            if headings:
+                meta["section"] = " / ".join(title for _, title in headings)
+            if page is not None:
+                meta["page"] = page
+            chunks.append({
+                "text": body.strip(),
+                "chunk_type": _chunk_type(units),
+                "meta": meta,
+            })
+
+        carried: List[_Unit] = []
+        if keep_overlap and overlap_tokens:
+            carried_tokens = 0
+            for unit in reversed(units):
+                if unit.kind == "title" or carried_tokens + unit.tokens > overlap_tokens:
+                    break
+                carried.insert(0, unit)
+                carried_tokens += unit.tokens
+        units = carried
+        tokens = sum(u.tokens for u in carried)
+        fresh = 0
+
+    def add(unit: _Unit) -> None:
+        nonlocal tokens, fresh
+        if units and tokens + unit.tokens > max_tokens:
+            emit(keep_overlap=True)
+            # 重叠部分加新单位仍超出预算时放弃重叠
+            if units and tokens + unit.tokens > max_tokens:
+                emit(keep_overlap=False)
+        if not units:
+            unit = _Unit(unit.text, unit.tokens, unit.kind, "")
+        units.append(unit)
+        tokens += unit.tokens
+        if unit.kind != "title":
+            fresh += 1
+
+    for block in parse_blocks(text, metadata):
+        kind = block["kind"]
+
+        if kind == "page":
+            emit(keep_overlap=False)
+            page = block["page"]
+            continue
+
+        if kind == "title":
+            # 新标题开始新的章节；连续标题（如一级标题后紧跟二级标题）合并在同一块
+            if fresh:
+                emit(keep_overlap=False)
+            level = block["level"]
+            headings = [h for h in headings if h[0] < level] + [(level, block["title"])]
+            add(_Unit(block["text"], estimate_tokens(block["text"]), "title", "\n"))
+            continue
+
+        block_tokens = estimate_tokens(block["text"])
+        if block_tokens <= max_tokens:
+            add(_Unit(block["text"], block_tokens, kind, "\n"))
+            continue
+
+        for i, (piece, piece_tokens, sep) in enumerate(_split_oversized(block["text"], kind, block_tokens, max_tokens)):
+            add(_Unit(piece, piece_tokens, kind, "\n" if i == 0 else sep))
+
+    emit(keep_overlap=False)
+    return chunks
+
+
+def _synthetic_document(sections: int = 40) -> str:
+    """基准测试用文档：标题、中英文段落、长单行、列表、表格、代码块与分页标记"""
+    zh = "知识库系统需要把文档切分为适合向量检索的片段，同时保留标题与段落结构。"
+    en = "Chunk boundaries should follow sentences so that retrieval returns coherent passages. "
+    parts = []
+    for i in range(sections):
+        parts.append(f"=== 第 {i + 1} 页 ===")
+        parts.append(f"# 第 {i + 1} 章 Chapter {i + 1}")
+        parts.append("\n".join([zh * 3, en * 3]))
+        parts.append("")
+        parts.append(zh * 60)  # 没有换行的长段落
+        parts.append("")
+        parts.extend(f"- 列表项 item {j}" for j in range(300))  # 大量短行
+        parts.append("")
+        parts.extend(f"| 字段 {j} | value {j} | 说明 |" for j in range(20))
+        parts.append("")
+        parts.append("```python\n" + "\n".join(f"print({j})" for j in range(30)) + "\n```")
+        parts.append("")
+    return "\n".join(parts)
+
+
+def benchmark(text: Optional[str] = None, repeat: int = 3) -> Dict[str, Any]:
+    """
+    与 simple_chunk 对比分块吞吐和块大小分布
+
+    Args:
+        text: 测试文本，缺省使用合成文档
+        repeat: 每种分块方式重复次数
+    """
+    from app.workers.tasks import simple_chunk
+
+    text = text or _synthetic_document()
+    size_mb = len(text.encode("utf-8")) / (1024 * 1024)
+    repeat = max(repeat, 1)
+    results: Dict[str, Any] = {"text_chars": len(text), "repeat": repeat}
+
+    for name, chunker in (("simple_chunk", simple_chunk), ("structured", chunk_text)):
+        started = time.perf_counter()
+        for _ in range(repeat):
+            chunks = chunker(text)
+        elapsed = (time.perf_counter() - started) / repeat
+        texts = [c if isinstance(c, str) else c["text"] for c in chunks]
+        token_counts = [estimate_tokens(t) for t in texts]
+        results[name] = {
+            "seconds": round(elapsed, 4),
+            "mb_per_sec": round(size_mb / elapsed, 2) if elapsed > 0 else None,
+            "chunks": len(texts),
+            "avg_chars": round(sum(map(len, texts)) / len(texts), 1) if texts else 0,
+            "max_chars": max(map(len, texts), default=0),
+            "max_tokens": max(token_counts, default=0),
+            "over_budget": sum(1 for t in token_counts if t > CHUNK_MAX_TOKENS),
+        }
+        if name == "structured":
+            types: Dict[str, int] = {}
+            for chunk in chunks:
+                types[chunk["chunk_type"]] = types.get(chunk["chunk_type"], 0) + 1
+            results[name]["chunk_types"] = types
+
+    return results
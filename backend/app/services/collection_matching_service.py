@@ -10,6 +10,7 @@ from sqlalchemy.orm import Session
 from sqlalchemy import func
 
 from app.models import Collection, Content, ContentCategory, Category
+from app.services.search_cache import bump_corpus_version
 
 logger = logging.getLogger(__name__)
 
@@ -179,6 +180,7 @@ class CollectionMatchingService:
             # 提交所有关联创建
             if matched_collections:
                 self.db.commit()
+                bump_corpus_version()
                 logger.info(f"Committed {len(matched_collections)} collection associations")
             
             return matched_collections
@@ -8,8 +8,12 @@ from typing import Dict, Any, List, Optional
 from sqlalchemy.orm import Session
 
 from app.parsers.document_processor import DocumentProcessor
-from app.models import Content, Chunk
-from app.workers.tasks import simple_chunk, generate_embeddings, classify_content
+from app.models import Content
+from app.workers.tasks import classify_content
+from app.services.chunking import chunk_text
+from app.services.embedding_scheduler import schedule_embeddings
+from app.services.chunk_store import ChunkStore
+from app.services.search_cache import bump_corpus_version
 
 logger = logging.getLogger(__name__)
 
@@ -118,45 +122,33 @@ class DocumentService:
             )
             
             self.db.add(content_obj)
-            self.db.commit()
-            self.db.refresh(content_obj)
-            
-            # 文本分块
-            chunks = simple_chunk(text_content)
-            chunk_ids = []
-            
-            for seq, chunk_text in enumerate(chunks):
-                chunk = Chunk(
-                    content_id=content_obj.id,
-                    seq=seq,
-                    text=chunk_text,
-                    meta={
-                        "source_uri": source_uri,
-                        "chunk_index": seq,
-                        "total_chunks": len(chunks)
-                    }
-                )
-                self.db.add(chunk)
-                chunk_ids.append(chunk.id)
+            self.db.flush()
+            content_id = str(content_obj.id)
+            
+            # 文本分块并批量入库，与 Content 记录同一事务提交
+            chunks = chunk_text(text_content, parse_result.get('metadata'))
+            chunk_ids = ChunkStore(self.db).insert(
+                content_obj.id, chunks, meta={"source_uri": source_uri}, with_position=True
+            )
             
             self.db.commit()
+            bump_corpus_version()
             
             # 立即进行快速分类（高优先级）
             from app.workers.quick_tasks import quick_classify_content
             quick_classify_content.apply_async(
-                args=[str(content_obj.id)], 
+                args=[content_id], 
                 queue="quick", 
                 priority=9
             )
             
             # 异步生成 embeddings
             if chunk_ids:
-                chunk_ids_str = [str(cid) for cid in chunk_ids]
-                generate_embeddings.delay(chunk_ids_str)
+                schedule_embeddings(chunk_ids)
             
             # 异步进行精确AI分类（较低优先级，会覆盖快速分类）
             classify_content.apply_async(
-                args=[str(content_obj.id)], 
+                args=[content_id], 
                 queue="classify", 
                 priority=5,
                 countdown=30  # 延迟30秒执行，让用户先看到快速分类结果
@@ -164,7 +156,7 @@ class DocumentService:
             
             result = {
                 "success": True,
-                "content_id": str(content_obj.id),
+                "content_id": content_id,
                 "title": title,
                 "chunks_created": len(chunks),
                 "text_length": len(text_content),
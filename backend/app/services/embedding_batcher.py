@@ -0,0 +1,164 @@
+"""
+Embedding 批处理引擎
+按条数和估算 token 数把输入切分为子批次，有界并发地请求 embedding API；
+重试与退避以子批次为单位，无法恢复的子批次二分定位出错的文本，单条坏数据不会让整批向量作废
+"""
+import os
+import re
+import time
+import random
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+from app.services.embedding_guard import EmbeddingUnavailableError
+
+# 可选导入 tiktoken（精确 token 计数），未安装时使用字符数估算
+try:
+    import tiktoken
+    TIKTOKEN_AVAILABLE = True
+except ImportError:
+    tiktoken = None
+    TIKTOKEN_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_BATCH_MAX_ITEMS = int(os.getenv("EMBEDDING_BATCH_MAX_ITEMS", "256"))
+EMBEDDING_BATCH_MAX_TOKENS = int(os.getenv("EMBEDDING_BATCH_MAX_TOKENS", "100000"))
+EMBEDDING_BATCH_CONCURRENCY = int(os.getenv("EMBEDDING_BATCH_CONCURRENCY", "4"))
+EMBEDDING_BATCH_MAX_RETRIES = int(os.getenv("EMBEDDING_BATCH_MAX_RETRIES", "3"))
+EMBEDDING_BATCH_BACKOFF = float(os.getenv("EMBEDDING_BATCH_BACKOFF", "1.0"))
+
+_CJK_RE = re.compile("[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]")
+
+_encoding = None
+
+
+def estimate_tokens(text: str) -> int:
+    """估算文本 token 数：有 tiktoken 时精确计数，否则中日韩字符按 1 token、其余字符按 4 字符 1 token 估算"""
+    global _encoding
+    if TIKTOKEN_AVAILABLE:
+        try:
+            if _encoding is None:
+                _encoding = tiktoken.get_encoding("cl100k_base")
+            return len(_encoding.encode(text))
+        except Exception:
+            pass
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4 + 1
+
+
+def plan_batches(texts: List[str], max_items: int = EMBEDDING_BATCH_MAX_ITEMS,
+                 max_tokens: int = EMBEDDING_BATCH_MAX_TOKENS) -> List[List[int]]:
+    """
+    按条数和 token 上限切分子批次
+
+    Returns:
+        子批次列表，每个子批次为输入下标列表（保持原顺序）
+    """
+    batches: List[List[int]] = []
+    current: List[int] = []
+    current_tokens = 0
+    for i, text in enumerate(texts):
+        tokens = estimate_tokens(text)
+        if current and (len(current) >= max_items or current_tokens + tokens > max_tokens):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(i)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _is_retryable(error: Exception) -> bool:
+    """限流、超时、连接错误和服务端错误可以重试；请求本身有问题（4xx）则不重试"""
+    status = getattr(error, "status_code", None)
+    if status is not None:
+        return status == 429 or status >= 500
+    return type(error).__name__ in {
+        "RateLimitError", "APIConnectionError", "APITimeoutError", "InternalServerError",
+        "ConnectError", "ReadTimeout", "TimeoutException",
+    }
+
+
+class EmbeddingBatcher:
+    """子批次切分 + 有界并发 + 子批次级重试的 embedding 请求执行器"""
+
+    def __init__(
+        self,
+        embed_fn: Callable[[List[str]], List[List[float]]],
+        max_items: int = EMBEDDING_BATCH_MAX_ITEMS,
+        max_tokens: int = EMBEDDING_BATCH_MAX_TOKENS,
+        concurrency: int = EMBEDDING_BATCH_CONCURRENCY,
+        max_retries: int = EMBEDDING_BATCH_MAX_RETRIES,
+        backoff: float = EMBEDDING_BATCH_BACKOFF,
+    ):
+        self.embed_fn = embed_fn
+        self.max_items = max_items
+        self.max_tokens = max_tokens
+        self.concurrency = max(concurrency, 1)
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+    def run(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """
+        批量获取向量
+
+        Returns:
+            与输入等长的向量列表，失败的条目为 None
+        """
+        if not texts:
+            return []
+
+        batches = plan_batches(texts, self.max_items, self.max_tokens)
+        results: List[Optional[List[float]]] = [None] * len(texts)
+
+        def run_batch(indices: List[int]) -> None:
+            embeddings = self._embed_batch([texts[i] for i in indices])
+            for i, embedding in zip(indices, embeddings):
+                results[i] = embedding
+
+        if len(batches) == 1:
+            run_batch(batches[0])
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.concurrency, len(batches)),
+                                    thread_name_prefix="embedding-batch") as executor:
+                list(executor.map(run_batch, batches))
+
+        failed = sum(1 for r in results if r is None)
+        logger.info(f"Embedded {len(texts) - failed}/{len(texts)} texts in {len(batches)} sub-batches")
+        return results
+
+    def _embed_batch(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """请求一个子批次；重试后仍失败时二分，只让真正出错的文本得到 None"""
+        try:
+            return self._call_with_retry(texts)
+        except EmbeddingUnavailableError as e:
+            # 熔断或限流拒绝与文本内容无关，不再二分
+            logger.warning(f"Embedding sub-batch of {len(texts)} skipped: {e}")
+            return [None] * len(texts)
+        except Exception as e:
+            if len(texts) == 1:
+                logger.error(f"Embedding failed for text ({len(texts[0])} chars): {e}")
+                return [None]
+            mid = len(texts) // 2
+            logger.warning(f"Embedding sub-batch of {len(texts)} failed, splitting: {e}")
+            return self._embed_batch(texts[:mid]) + self._embed_batch(texts[mid:])
+
+    def _call_with_retry(self, texts: List[str]) -> List[List[float]]:
+        attempt = 0
+        while True:
+            try:
+                embeddings = self.embed_fn(texts)
+                if len(embeddings) != len(texts):
+                    raise ValueError(f"Expected {len(texts)} embeddings, got {len(embeddings)}")
+                return embeddings
+            except Exception as e:
+                attempt += 1
+                if attempt > self.max_retries or not _is_retryable(e):
+                    raise
+                # 指数退避 + 抖动，避免并发子批次同时重试
+                delay = self.backoff * (2 ** (attempt - 1)) * (1 + random.random())
+                logger.warning(f"Embedding sub-batch retry {attempt}/{self.max_retries} in {delay:.1f}s: {e}")
+                time.sleep(delay)
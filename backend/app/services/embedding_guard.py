@@ -0,0 +1,385 @@
+"""
+Embedding 请求保护：自适应限流 + 熔断
+所有 embedding API 调用先经过令牌桶限流（收到 429 时减半速率并按 Retry-After 暂停，成功时逐步恢复，
+延迟超过目标值时降速），连续失败或慢调用达到阈值后熔断：冷却期内直接拒绝请求，
+搜索立即退化为关键词检索，后台向量任务延后重试；熔断状态经 Redis 在 API 与 worker 进程间共享
+"""
+import os
+import time
+import threading
+import logging
+from typing import Any, Callable, Dict, Optional
+
+from app.services.redis_client import get_redis, mark_redis_failed
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_GUARD_ENABLED = os.getenv("EMBEDDING_GUARD_ENABLED", "true").lower() == "true"
+# 熔断：连续失败次数阈值、冷却时间（秒）、慢调用阈值（毫秒，超过按失败计）
+EMBEDDING_BREAKER_FAILURE_THRESHOLD = int(os.getenv("EMBEDDING_BREAKER_FAILURE_THRESHOLD", "5"))
+EMBEDDING_BREAKER_COOLDOWN = float(os.getenv("EMBEDDING_BREAKER_COOLDOWN", "30"))
+EMBEDDING_BREAKER_SLOW_CALL_MS = float(os.getenv("EMBEDDING_BREAKER_SLOW_CALL_MS", "15000"))
+# 限流：每秒请求数上限/下限，成功后的加性增量，429 时的乘性减量，目标延迟（毫秒）
+EMBEDDING_RATE_LIMIT_MAX = float(os.getenv("EMBEDDING_RATE_LIMIT_MAX", "20"))
+EMBEDDING_RATE_LIMIT_MIN = float(os.getenv("EMBEDDING_RATE_LIMIT_MIN", "0.5"))
+EMBEDDING_RATE_LIMIT_INCREASE = float(os.getenv("EMBEDDING_RATE_LIMIT_INCREASE", "0.5"))
+EMBEDDING_RATE_LIMIT_DECREASE = float(os.getenv("EMBEDDING_RATE_LIMIT_DECREASE", "0.5"))
+EMBEDDING_RATE_LIMIT_LATENCY_TARGET_MS = float(os.getenv("EMBEDDING_RATE_LIMIT_LATENCY_TARGET_MS", "5000"))
+# 等待令牌的最长时间（秒）：交互请求（搜索）宁可退化也不排队，后台批处理可以等待
+EMBEDDING_RATE_LIMIT_INTERACTIVE_WAIT = float(os.getenv("EMBEDDING_RATE_LIMIT_INTERACTIVE_WAIT", "0.5"))
+EMBEDDING_RATE_LIMIT_BATCH_WAIT = float(os.getenv("EMBEDDING_RATE_LIMIT_BATCH_WAIT", "60"))
+# 交互请求（单条文本，不经过批处理重试）遇到超时、连接错误或 5xx 时的重试次数与间隔（秒）
+EMBEDDING_INTERACTIVE_MAX_RETRIES = int(os.getenv("EMBEDDING_INTERACTIVE_MAX_RETRIES", "1"))
+EMBEDDING_INTERACTIVE_RETRY_BACKOFF = float(os.getenv("EMBEDDING_INTERACTIVE_RETRY_BACKOFF", "0.2"))
+
+# 熔断打开标记（过期时间即剩余冷却时间）
+BREAKER_OPEN_KEY = "pkb:embedding:breaker_open"
+# 本进程读取共享熔断标记的最小间隔（秒）
+_SHARED_CHECK_INTERVAL = 1.0
+
+
+class EmbeddingUnavailableError(RuntimeError):
+    """熔断打开或限流等待超时，本次请求未发出"""
+
+
+def _status_code(error: Exception) -> Optional[int]:
+    return getattr(error, "status_code", None)
+
+
+def _is_rate_limited(error: Exception) -> bool:
+    return _status_code(error) == 429 or type(error).__name__ == "RateLimitError"
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveRateLimiter:
+    """进程内共享的令牌桶，速率按 AIMD 随 429 与延迟自适应调整"""
+
+    def __init__(
+        self,
+        max_rate: float = EMBEDDING_RATE_LIMIT_MAX,
+        min_rate: float = EMBEDDING_RATE_LIMIT_MIN,
+        increase: float = EMBEDDING_RATE_LIMIT_INCREASE,
+        decrease: float = EMBEDDING_RATE_LIMIT_DECREASE,
+        latency_target_ms: float = EMBEDDING_RATE_LIMIT_LATENCY_TARGET_MS,
+    ):
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_target_ms = latency_target_ms
+        self.rate = max_rate
+        self._tokens = max(max_rate, 1.0)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+        self.rate_limited = 0
+        self.rejected = 0
+
+    def _refill(self, now: float) -> None:
+        capacity = max(self.rate, 1.0)
+        self._tokens = min(capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, timeout: float) -> bool:
+        """获取一个令牌，最多等待 timeout 秒；超时返回 False"""
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                else:
+                    wait = (1 - self._tokens) / self.rate
+                if now + wait > deadline:
+                    self.rejected += 1
+                    return False
+            time.sleep(wait)
+
+    def on_success(self, latency_ms: float) -> None:
+        with self._lock:
+            if self.latency_target_ms and latency_ms > self.latency_target_ms:
+                # 延迟升高说明上游开始排队，小幅降速
+                self.rate = max(self.min_rate, self.rate * 0.9)
+            else:
+                self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_rate_limited(self, retry_after: Optional[float]) -> None:
+        with self._lock:
+            now = time.monotonic()
+            self.rate_limited += 1
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self._tokens = 0.0
+            self._updated = now
+            self._paused_until = max(self._paused_until, now + (retry_after or 1 / self.rate))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "rate_per_sec": round(self.rate, 2),
+                "max_rate_per_sec": self.max_rate,
+                "min_rate_per_sec": self.min_rate,
+                "paused_seconds": round(max(self._paused_until - time.monotonic(), 0), 2),
+                "rate_limited": self.rate_limited,
+                "rejected": self.rejected,
+            }
+
+
+class CircuitBreaker:
+    """连续失败熔断器：closed → open（冷却期内拒绝）→ half_open（放行一个探测请求）→ closed"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        failure_threshold: int = EMBEDDING_BREAKER_FAILURE_THRESHOLD,
+        cooldown: float = EMBEDDING_BREAKER_COOLDOWN,
+    ):
+        self.failure_threshold = max(failure_threshold, 1)
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self.rejected = 0
+        self._probe_in_flight = False
+        self._shared_checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def _check_shared(self, now: float) -> None:
+        """其他进程打开熔断时同步为打开状态（调用方持有锁）"""
+        if now - self._shared_checked_at < _SHARED_CHECK_INTERVAL:
+            return
+        self._shared_checked_at = now
+        client = get_redis()
+        if client is None:
+            return
+        try:
+            ttl_ms = client.pttl(BREAKER_OPEN_KEY)
+        except Exception as e:
+            logger.warning(f"Failed to read shared circuit breaker state: {e}")
+            mark_redis_failed()
+            return
+        if ttl_ms and ttl_ms > 0:
+            self.state = self.OPEN
+            self.opened_at = now - self.cooldown + ttl_ms / 1000
+
+    def _publish_open(self) -> None:
+        client = get_redis()
+        if client is None:
+            return
+        try:
+            client.set(BREAKER_OPEN_KEY, time.time(), px=int(self.cooldown * 1000))
+        except Exception as e:
+            logger.warning(f"Failed to publish circuit breaker state: {e}")
+            mark_redis_failed()
+
+    def _publish_closed(self) -> None:
+        client = get_redis()
+        if client is None:
+            return
+        try:
+            client.delete(BREAKER_OPEN_KEY)
+        except Exception as e:
+            logger.warning(f"Failed to publish circuit breaker state: {e}")
+            mark_redis_failed()
+
+    def is_open(self) -> bool:
+        """冷却期内返回 True（不改变状态、不占用探测名额）"""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == self.CLOSED:
+                self._check_shared(now)
+            return self.state == self.OPEN and now < self.opened_at + self.cooldown
+
+    def remaining(self) -> float:
+        """距离允许探测还剩多少秒"""
+        with self._lock:
+            if self.state != self.OPEN:
+                return 0.0
+            return max(self.opened_at + self.cooldown - time.monotonic(), 0.0)
+
+    def allow(self) -> bool:
+        """是否放行本次请求；冷却结束后只放行一个探测请求"""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == self.CLOSED:
+                self._check_shared(now)
+            if self.state == self.OPEN and now >= self.opened_at + self.cooldown:
+                self.state = self.HALF_OPEN
+                self._probe_in_flight = False
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            recovered = self.state != self.CLOSED
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probe_in_flight = False
+        if recovered:
+            logger.info("Embedding circuit breaker closed")
+            self._publish_closed()
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == self.OPEN:
+                return
+            if self.state != self.HALF_OPEN and self.failures < self.failure_threshold:
+                return
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self._probe_in_flight = False
+            self.times_opened += 1
+        logger.warning(f"Embedding circuit breaker opened for {self.cooldown:.0f}s after {self.failures} failures")
+        self._publish_open()
+
+    def stats(self) -> Dict[str, Any]:
+        open_now = self.is_open()
+        with self._lock:
+            return {
+                "state": self.OPEN if open_now else (self.HALF_OPEN if self.state == self.OPEN else self.state),
+                "consecutive_failures": self.failures,
+                "failure_threshold": self.failure_threshold,
+                "cooldown_seconds": self.cooldown,
+                "retry_in_seconds": round(max(self.opened_at + self.cooldown - time.monotonic(), 0), 1)
+                if open_now else 0.0,
+                "times_opened": self.times_opened,
+                "rejected": self.rejected,
+            }
+
+
+class EmbeddingGuard:
+    """把 embedding API 调用包在限流与熔断之中"""
+
+    def __init__(self, slow_call_ms: float = EMBEDDING_BREAKER_SLOW_CALL_MS):
+        self.limiter = AdaptiveRateLimiter()
+        self.breaker = CircuitBreaker()
+        self.slow_call_ms = slow_call_ms
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _reset_after_fork(self) -> None:
+        # Celery prefork 子进程不继承父进程的锁与计数
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pid = os.getpid()
+                    self.limiter = AdaptiveRateLimiter()
+                    self.breaker = CircuitBreaker()
+
+    def is_open(self) -> bool:
+        if not EMBEDDING_GUARD_ENABLED:
+            return False
+        self._reset_after_fork()
+        return self.breaker.is_open()
+
+    def retry_in(self) -> float:
+        """熔断剩余冷却时间（秒），未熔断时为 0"""
+        self._reset_after_fork()
+        return self.breaker.remaining()
+
+    def call(self, fn: Callable[[], Any], wait: float = EMBEDDING_RATE_LIMIT_BATCH_WAIT) -> Any:
+        """
+        执行一次 embedding API 调用
+
+        Args:
+            fn: 发出请求的无参函数
+            wait: 等待限流令牌的最长时间（秒）
+
+        Raises:
+            EmbeddingUnavailableError: 熔断打开或等待令牌超时，请求未发出
+        """
+        if not EMBEDDING_GUARD_ENABLED:
+            return fn()
+        self._reset_after_fork()
+
+        # 熔断打开时立即失败，不在限流器上排队
+        if self.breaker.is_open():
+            self.breaker.rejected += 1
+            raise EmbeddingUnavailableError("Embedding circuit breaker is open")
+        if not self.limiter.acquire(wait):
+            raise EmbeddingUnavailableError(f"Embedding rate limit wait exceeded {wait:.1f}s")
+        if not self.breaker.allow():
+            raise EmbeddingUnavailableError("Embedding circuit breaker is open")
+
+        started = time.perf_counter()
+        try:
+            result = fn()
+        except Exception as e:
+            if _is_rate_limited(e):
+                self.limiter.on_rate_limited(_retry_after(e))
+                self.breaker.record_failure()
+            elif _is_service_failure(e):
+                self.breaker.record_failure()
+            else:
+                # 请求本身有问题（4xx），上游是健康的
+                self.breaker.record_success()
+            raise
+
+        latency_ms = (time.perf_counter() - started) * 1000
+        self.limiter.on_success(latency_ms)
+        if self.slow_call_ms and latency_ms > self.slow_call_ms:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return result
+
+    def call_interactive(self, fn: Callable[[], Any]) -> Any:
+        """
+        执行一次交互请求（搜索查询向量等单条请求）
+
+        限流时只短暂等待、熔断时立即失败；超时、连接错误与 5xx 有限次重试（每次都计入熔断统计），
+        429 不重试（限流器已降速）
+        """
+        attempt = 0
+        while True:
+            try:
+                return self.call(fn, wait=EMBEDDING_RATE_LIMIT_INTERACTIVE_WAIT)
+            except EmbeddingUnavailableError:
+                raise
+            except Exception as e:
+                attempt += 1
+                if attempt > EMBEDDING_INTERACTIVE_MAX_RETRIES or _is_rate_limited(e) or not _is_service_failure(e):
+                    raise
+                logger.warning(f"Embedding request retry {attempt}/{EMBEDDING_INTERACTIVE_MAX_RETRIES}: {e}")
+                time.sleep(EMBEDDING_INTERACTIVE_RETRY_BACKOFF)
+
+    def stats(self) -> Dict[str, Any]:
+        self._reset_after_fork()
+        return {
+            "enabled": EMBEDDING_GUARD_ENABLED,
+            "circuit_breaker": self.breaker.stats(),
+            "rate_limiter": self.limiter.stats(),
+            "slow_call_ms": self.slow_call_ms,
+        }
+
+
+def _is_service_failure(error: Exception) -> bool:
+    """超时、连接错误与服务端错误说明上游不健康"""
+    from app.services.embedding_batcher import _is_retryable
+    return _is_retryable(error)
+
+
+embedding_guard = EmbeddingGuard()
@@ -0,0 +1,548 @@
+"""
+向量模型迁移（全量重新生成向量）
+更换 embedding 模型时，按主键 keyset 分页遍历 chunks，用目标模型把向量写入影子列 chunks.embedding_shadow，
+每批向量与检查点在同一事务提交，worker 崩溃后从检查点继续；遇到限流时自动拉长批次间隔。
+回填完成后在一个事务内交换列名与索引名，搜索原子切换到新向量，旧向量保留在 embedding_previous 以便回滚
+"""
+import os
+import time
+import threading
+import logging
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from app.db import engine
+from app.models import EmbeddingMigration
+from app.services.embedding_service import EmbeddingService
+from app.services.embedding_store import EmbeddingStore
+from app.services.embedding_stats_service import EmbeddingStatsService
+from app.services.vector_writer import BulkVectorWriter, rows_per_second
+from app.services.vector_index_service import VectorIndexService, INDEX_NAME, INDEX_LOCK_KEY
+from app.services.search_cache import bump_corpus_version
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_BACKFILL_BATCH_SIZE = int(os.getenv("EMBEDDING_BACKFILL_BATCH_SIZE", "200"))
+# 单个任务最多处理的批次数，之后释放租约并重新投递，避免长时间占用 worker
+EMBEDDING_BACKFILL_BATCHES_PER_TASK = int(os.getenv("EMBEDDING_BACKFILL_BATCHES_PER_TASK", "20"))
+# 批次间隔（秒）：基础值与限流时的上限
+EMBEDDING_BACKFILL_DELAY = float(os.getenv("EMBEDDING_BACKFILL_DELAY", "0"))
+EMBEDDING_BACKFILL_MAX_DELAY = float(os.getenv("EMBEDDING_BACKFILL_MAX_DELAY", "60"))
+# 遍历轮数上限：后续轮次补齐迁移期间新增的 chunk 和生成失败的 chunk
+EMBEDDING_BACKFILL_MAX_PASSES = int(os.getenv("EMBEDDING_BACKFILL_MAX_PASSES", "3"))
+EMBEDDING_BACKFILL_LEASE_SECONDS = int(os.getenv("EMBEDDING_BACKFILL_LEASE_SECONDS", "600"))
+EMBEDDING_ACTIVE_MODEL_TTL = float(os.getenv("EMBEDDING_ACTIVE_MODEL_TTL", "10"))
+
+SHADOW_COLUMN = "embedding_shadow"
+PREVIOUS_COLUMN = "embedding_previous"
+SHADOW_INDEX_NAME = f"{INDEX_NAME}_shadow"
+PREVIOUS_INDEX_NAME = f"{INDEX_NAME}_previous"
+
+ACTIVE_STATUSES = ("pending", "running", "paused", "backfilled")
+
+# 生效模型的进程内缓存：{"model": Optional[str], "expires_at": float}
+_active_model_cache: Dict[str, Any] = {}
+_active_model_lock = threading.Lock()
+
+ACTIVE_MODEL_SQL = """
+    SELECT target_model FROM embedding_migrations
+    WHERE status = 'switched'
+    ORDER BY switched_at DESC
+    LIMIT 1
+"""
+
+
+class EmbeddingModelChangedError(Exception):
+    """向量生成期间生效模型已切换（或回滚），这批向量不能写入 embedding 列"""
+
+    def __init__(self, model: str, active_model: str):
+        super().__init__(f"Embeddings from {model} rejected: active model is now {active_model}")
+        self.model = model
+        self.active_model = active_model
+
+
+def get_active_model() -> Optional[str]:
+    """最近一次切换生效的模型，没有迁移记录（或数据库不可用）时返回 None，使用环境变量配置"""
+    now = time.time()
+    with _active_model_lock:
+        if _active_model_cache and _active_model_cache["expires_at"] > now:
+            return _active_model_cache["model"]
+
+    model = None
+    try:
+        with engine.connect() as conn:
+            model = conn.execute(text(ACTIVE_MODEL_SQL)).scalar()
+    except Exception as e:
+        logger.debug(f"Active embedding model lookup failed: {e}")
+
+    with _active_model_lock:
+        _active_model_cache.update({"model": model, "expires_at": now + EMBEDDING_ACTIVE_MODEL_TTL})
+    return model
+
+
+def _clear_active_model_cache() -> None:
+    with _active_model_lock:
+        _active_model_cache.clear()
+
+
+def verify_active_model(db: Session, model: str) -> None:
+    """
+    在调用方的写入事务中确认向量模型仍是生效模型（写入 embedding 列之前调用）
+
+    先对 chunks 加 ROW EXCLUSIVE 锁：与切换/回滚交换列时的 ACCESS EXCLUSIVE 锁互斥，
+    因此这里读到的生效模型（不经过进程内缓存）在本事务提交前不会改变；
+    不一致时清空进程内缓存并抛出 EmbeddingModelChangedError，由调用方重新排队
+    """
+    db.execute(text("LOCK TABLE chunks IN ROW EXCLUSIVE MODE"))
+    active_model = db.execute(text(ACTIVE_MODEL_SQL)).scalar() or EmbeddingService.qualify_model_name(
+        os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+    )
+    if model != active_model:
+        _clear_active_model_cache()
+        raise EmbeddingModelChangedError(model, active_model)
+
+
+class EmbeddingMigrationService:
+    """向量模型迁移：影子列回填、进度、原子切换与回滚"""
+
+    def __init__(self, db: Session):
+        self.db = db
+
+    # ------------------------------------------------------------------
+    # 创建与查询
+    # ------------------------------------------------------------------
+
+    def get_active(self) -> Optional[EmbeddingMigration]:
+        """进行中的迁移（同一时间只允许一个）"""
+        return self.db.query(EmbeddingMigration).filter(
+            EmbeddingMigration.status.in_(ACTIVE_STATUSES)
+        ).order_by(EmbeddingMigration.created_at.desc()).first()
+
+    def get(self, migration_id: str) -> Optional[EmbeddingMigration]:
+        return self.db.query(EmbeddingMigration).filter(EmbeddingMigration.id == migration_id).first()
+
+    def list_migrations(self, limit: int = 20) -> List[Dict[str, Any]]:
+        migrations = self.db.query(EmbeddingMigration).order_by(
+            EmbeddingMigration.created_at.desc()
+        ).limit(limit).all()
+        return [self.get_progress(m) for m in migrations]
+
+    def start(self, target_model: str) -> Dict[str, Any]:
+        """
+        创建迁移任务并准备影子列
+
+        Args:
+            target_model: 目标模型（需在 EmbeddingService.SUPPORTED_MODELS 中）
+
+        Returns:
+            迁移进度；调用方负责投递回填任务
+        """
+        target_model = EmbeddingService.qualify_model_name(target_model)
+        if target_model not in EmbeddingService.SUPPORTED_MODELS:
+            return {"success": False, "error": f"Unsupported embedding model: {target_model}"}
+
+        active = self.get_active()
+        if active:
+            return {"success": False, "error": f"Embedding migration {active.id} is already {active.status}"}
+
+        source_model = EmbeddingService().current_model
+        if source_model == target_model:
+            return {"success": False, "error": f"{target_model} is already the active embedding model"}
+
+        dimension = EmbeddingService.SUPPORTED_MODELS[target_model]["dimension"]
+        self._prepare_schema(dimension)
+
+        total = self.db.execute(text("SELECT COUNT(*) FROM chunks")).scalar() or 0
+        migration = EmbeddingMigration(
+            source_model=source_model,
+            target_model=target_model,
+            dimension=dimension,
+            status="pending",
+            total_chunks=total,
+            batch_delay=EMBEDDING_BACKFILL_DELAY,
+        )
+        self.db.add(migration)
+        self.db.commit()
+
+        logger.info(f"Embedding migration {migration.id} created: {source_model} -> {target_model} ({total} chunks)")
+        return {"success": True, **self.get_progress(migration)}
+
+    def _prepare_schema(self, dimension: int) -> None:
+        """重建影子列；去重存储的向量列取消维度限制，以便保存目标模型的向量"""
+        self.db.execute(text("SET LOCAL lock_timeout = '10s'"))
+        self.db.execute(text(f"DROP INDEX IF EXISTS {SHADOW_INDEX_NAME}"))
+        self.db.execute(text(f"ALTER TABLE chunks DROP COLUMN IF EXISTS {SHADOW_COLUMN}"))
+        self.db.execute(text(f"ALTER TABLE chunks ADD COLUMN {SHADOW_COLUMN} vector({int(dimension)})"))
+
+        store_type = self.db.execute(text("""
+            SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+            WHERE attrelid = 'embedding_store'::regclass AND attname = 'embedding'
+        """)).scalar()
+        if store_type and store_type != "vector":
+            self.db.execute(text("ALTER TABLE embedding_store ALTER COLUMN embedding TYPE vector"))
+
+    # ------------------------------------------------------------------
+    # 回填
+    # ------------------------------------------------------------------
+
+    def _claim(self, migration_id: str, owner: str) -> bool:
+        """
+        获取执行租约：租约过期或由同一任务持有时可获取
+
+        task_acks_late 下 worker 崩溃后重新投递的消息任务 ID 不变，可以立即接续执行
+        """
+        claimed = self.db.execute(text("""
+            UPDATE embedding_migrations
+            SET status = 'running', lease_owner = :owner,
+                lease_until = now() + make_interval(secs => :lease), updated_at = now()
+            WHERE id = :id
+              AND status IN ('pending', 'running')
+              AND (lease_until IS NULL OR lease_until < now() OR lease_owner = :owner)
+            RETURNING id
+        """), {"id": migration_id, "owner": owner, "lease": EMBEDDING_BACKFILL_LEASE_SECONDS}).first()
+        self.db.commit()
+        return claimed is not None
+
+    def _release(self, migration: EmbeddingMigration) -> None:
+        migration.lease_owner = None
+        migration.lease_until = None
+        migration.updated_at = datetime.utcnow()
+        self.db.commit()
+
+    def _lease_expired(self, migration: EmbeddingMigration) -> bool:
+        """租约是否已过期（与数据库时钟比较）"""
+        return bool(self.db.execute(text("""
+            SELECT lease_until IS NULL OR lease_until < now() FROM embedding_migrations WHERE id = :id
+        """), {"id": migration.id}).scalar())
+
+    def _next_batch(self, migration: EmbeddingMigration) -> List[Tuple[Any, str]]:
+        """keyset 分页读取下一批尚未生成影子向量的 (id, text)"""
+        params = {"limit": EMBEDDING_BACKFILL_BATCH_SIZE}
+        after = ""
+        if migration.checkpoint_id:
+            after = "AND id > :after"
+            params["after"] = migration.checkpoint_id
+        rows = self.db.execute(text(f"""
+            SELECT id, text FROM chunks
+            WHERE {SHADOW_COLUMN} IS NULL {after}
+            ORDER BY id
+            LIMIT :limit
+        """), params).fetchall()
+        return [(row.id, row.text) for row in rows]
+
+    def _remaining(self) -> int:
+        return self.db.execute(
+            text(f"SELECT COUNT(*) FROM chunks WHERE {SHADOW_COLUMN} IS NULL")
+        ).scalar() or 0
+
+    def _adjust_delay(self, migration: EmbeddingMigration, size: int, stats: Dict[str, int]) -> None:
+        """整批都没能生成向量时视为被限流或服务异常，批次间隔翻倍；恢复后逐步回落到基础值"""
+        throttled = stats["failed"] >= size and stats["computed"] == 0
+        delay = migration.batch_delay or 0
+        if throttled:
+            delay = min(max(delay * 2, 1.0), EMBEDDING_BACKFILL_MAX_DELAY)
+            logger.warning(f"Embedding migration {migration.id} throttled, batch delay {delay:.1f}s")
+        else:
+            delay = max(delay / 2, EMBEDDING_BACKFILL_DELAY)
+            if delay < 0.1:
+                delay = EMBEDDING_BACKFILL_DELAY
+        migration.batch_delay = delay
+
+    def _finish_pass(self, migration: EmbeddingMigration) -> bool:
+        """一轮遍历结束：仍有缺失且未达轮数上限时开始下一轮，返回是否继续回填"""
+        remaining = self._remaining()
+        if remaining and migration.pass_number < EMBEDDING_BACKFILL_MAX_PASSES:
+            migration.pass_number += 1
+            migration.checkpoint_id = None
+            self.db.commit()
+            logger.info(f"Embedding migration {migration.id}: pass {migration.pass_number}, {remaining} chunks left")
+            return True
+
+        migration.status = "backfilled"
+        self.db.commit()
+        logger.info(f"Embedding migration {migration.id} backfilled ({remaining} chunks without embedding)")
+        return False
+
+    def run_batches(self, migration_id: str, owner: str,
+                    max_batches: int = EMBEDDING_BACKFILL_BATCHES_PER_TASK) -> Dict[str, Any]:
+        """
+        执行若干批回填（由 Celery 任务调用）
+
+        Returns:
+            {"ok", "processed", "continue": 是否需要继续投递}
+        """
+        if not self._claim(migration_id, owner):
+            return {"ok": True, "skipped": True, "continue": False}
+
+        migration = self.get(migration_id)
+        embedding_service = EmbeddingService(model=migration.target_model)
+        if not embedding_service.is_enabled():
+            migration.status = "failed"
+            migration.error = "Embedding service not configured"
+            self._release(migration)
+            return {"ok": False, "error": migration.error, "continue": False}
+
+        writer = BulkVectorWriter(self.db, column=SHADOW_COLUMN)
+        store = EmbeddingStore(self.db)
+        processed = 0
+        should_continue = True
+
+        try:
+            for _ in range(max_batches):
+                # 暂停 / 取消在批次之间生效
+                self.db.refresh(migration)
+                if migration.status != "running":
+                    should_continue = False
+                    break
+
+                batch = self._next_batch(migration)
+                if not batch:
+                    should_continue = self._finish_pass(migration)
+                    if not should_continue:
+                        break
+                    continue
+
+                started = time.perf_counter()
+                embeddings, stats = store.embed_texts(embedding_service, [t for _, t in batch])
+                result = writer.write([(cid, t, e) for (cid, t), e in zip(batch, embeddings)])
+
+                # 检查点与向量在同一事务提交
+                migration.checkpoint_id = batch[-1][0]
+                migration.processed_chunks = (migration.processed_chunks or 0) + result["written"]
+                migration.failed_chunks = (migration.failed_chunks or 0) + stats["failed"]
+                self._adjust_delay(migration, len(batch), stats)
+                self.db.execute(text("""
+                    UPDATE embedding_migrations
+                    SET lease_until = now() + make_interval(secs => :lease)
+                    WHERE id = :id
+                """), {"id": migration.id, "lease": EMBEDDING_BACKFILL_LEASE_SECONDS})
+                migration.updated_at = datetime.utcnow()
+                self.db.commit()
+                processed += result["written"]
+
+                if migration.batch_delay:
+                    time.sleep(migration.batch_delay)
+
+                # 吞吐按含批次间隔的实际耗时计算，ETA 反映限流后的真实速度
+                rate = rows_per_second(result["written"], time.perf_counter() - started)
+                migration.rows_per_sec = rate if not migration.rows_per_sec else round(
+                    0.8 * migration.rows_per_sec + 0.2 * rate, 1
+                )
+                self.db.commit()
+        except Exception as e:
+            logger.error(f"Embedding migration {migration_id} batch failed: {e}")
+            self.db.rollback()
+            migration = self.get(migration_id)
+            if migration.status == "running":
+                migration.status = "failed"
+            migration.error = str(e)
+            self._release(migration)
+            return {"ok": False, "error": str(e), "processed": processed, "continue": False}
+
+        self._release(migration)
+        return {"ok": True, "processed": processed, "continue": should_continue}
+
+    # ------------------------------------------------------------------
+    # 控制
+    # ------------------------------------------------------------------
+
+    def pause(self, migration: EmbeddingMigration) -> Dict[str, Any]:
+        if migration.status not in ("pending", "running"):
+            return {"success": False, "error": f"Cannot pause migration in status {migration.status}"}
+        migration.status = "paused"
+        self.db.commit()
+        return {"success": True, **self.get_progress(migration)}
+
+    def resume(self, migration: EmbeddingMigration) -> Dict[str, Any]:
+        """
+        继续回填：暂停、失败或租约过期（worker 崩溃且消息丢失）的迁移从检查点继续
+
+        Returns:
+            迁移进度；"dispatch" 表示调用方需要投递回填任务
+        """
+        stalled = migration.status == "running" and self._lease_expired(migration)
+        if migration.status not in ("paused", "failed", "pending") and not stalled:
+            return {"success": False, "error": f"Cannot resume migration in status {migration.status}"}
+        migration.status = "pending"
+        migration.error = None
+        migration.lease_owner = None
+        migration.lease_until = None
+        self.db.commit()
+        return {"success": True, "dispatch": True, **self.get_progress(migration)}
+
+    def cancel(self, migration: EmbeddingMigration) -> Dict[str, Any]:
+        if migration.status not in ACTIVE_STATUSES and migration.status != "failed":
+            return {"success": False, "error": f"Cannot cancel migration in status {migration.status}"}
+        migration.status = "cancelled"
+        self.db.execute(text("SET LOCAL lock_timeout = '10s'"))
+        self.db.execute(text(f"DROP INDEX IF EXISTS {SHADOW_INDEX_NAME}"))
+        self.db.execute(text(f"ALTER TABLE chunks DROP COLUMN IF EXISTS {SHADOW_COLUMN}"))
+        self.db.commit()
+        return {"success": True, **self.get_progress(migration)}
+
+    # ------------------------------------------------------------------
+    # 切换与回滚
+    # ------------------------------------------------------------------
+
+    def _build_shadow_index(self, migration: EmbeddingMigration) -> Dict[str, Any]:
+        """切换前在影子列上构建 ANN 索引（CONCURRENTLY，不阻塞回填与写入）"""
+        config = VectorIndexService.get_config()
+        method = config["method"]
+        if method == "none":
+            return {"built": False, "reason": "VECTOR_INDEX_METHOD=none"}
+        index_service = VectorIndexService(self.db)
+        plan = index_service.get_index_plan(migration.dimension)
+        if plan["dimension"] > plan["max_dimension"]:
+            # 例如 3072 维的完整向量超出 vector 索引上限，可改用 VECTOR_INDEX_STORAGE=halfvec 或截断维度
+            return {
+                "built": False,
+                "reason": f"{plan['dimension']} dimensions exceed the {plan['max_dimension']}-dimension "
+                          f"limit of {plan['storage']} ANN indexes",
+            }
+
+        params = {
+            "m": config["m"],
+            "ef_construction": config["ef_construction"],
+            "lists": config["lists"] or index_service._suggest_lists(migration.total_chunks or 0),
+        }
+        self.db.commit()
+
+        started = time.time()
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            locked = conn.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": INDEX_LOCK_KEY}).scalar()
+            if not locked:
+                raise RuntimeError("Another vector index build is in progress")
+            try:
+                conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {SHADOW_INDEX_NAME}"))
+                conn.execute(text(index_service._build_index_sql(
+                    SHADOW_INDEX_NAME, method, params, concurrently=True,
+                    column=SHADOW_COLUMN, column_dimension=migration.dimension
+                )))
+            finally:
+                conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": INDEX_LOCK_KEY})
+        return {"built": True, "method": method, "storage": plan["storage"], "dimension": plan["dimension"],
+                "build_time": round(time.time() - started, 1)}
+
+    def _swap_columns(self, current_to: str, replacement: str) -> None:
+        """在当前事务内交换向量列与对应的 ANN 索引（仅修改元数据，不重写数据）"""
+        index_names = {SHADOW_COLUMN: SHADOW_INDEX_NAME, PREVIOUS_COLUMN: PREVIOUS_INDEX_NAME}
+        self.db.execute(text("SET LOCAL lock_timeout = '10s'"))
+        self.db.execute(text(f"DROP INDEX IF EXISTS {index_names[current_to]}"))
+        self.db.execute(text(f"ALTER TABLE chunks DROP COLUMN IF EXISTS {current_to}"))
+        self.db.execute(text(f"ALTER INDEX IF EXISTS {INDEX_NAME} RENAME TO {index_names[current_to]}"))
+        self.db.execute(text(f"ALTER TABLE chunks RENAME COLUMN embedding TO {current_to}"))
+        self.db.execute(text(f"ALTER TABLE chunks RENAME COLUMN {replacement} TO embedding"))
+        self.db.execute(text(f"ALTER INDEX IF EXISTS {index_names[replacement]} RENAME TO {INDEX_NAME}"))
+
+    def _after_swap(self) -> int:
+        """切换/回滚后刷新统计与缓存，并为生效列中缺失向量的 chunk 补生成向量"""
+        from app.services.embedding_scheduler import schedule_embeddings
+
+        _clear_active_model_cache()
+        VectorIndexService.clear_cache()
+        EmbeddingStatsService(self.db).invalidate()
+        self.db.commit()
+        bump_corpus_version()
+
+        missing = [row.id for row in self.db.execute(
+            text("SELECT id FROM chunks WHERE embedding IS NULL AND length(trim(text)) > 0")
+        ).fetchall()]
+        if missing:
+            schedule_embeddings(missing)
+        return len(missing)
+
+    def switch(self, migration: EmbeddingMigration, force: bool = False) -> Dict[str, Any]:
+        """
+        原子切换：影子列成为 embedding，原 embedding 保留为 embedding_previous
+
+        Args:
+            force: 仍有 chunk 未生成影子向量时也切换（这些 chunk 切换后重新生成向量）
+        """
+        if migration.status not in ("backfilled", "paused"):
+            return {"success": False, "error": f"Cannot switch migration in status {migration.status}; pause it or wait until backfill finishes"}
+
+        remaining = self._remaining()
+        if remaining and not force:
+            return {"success": False, "error": f"{remaining} chunks have no embedding from {migration.target_model}"}
+
+        index = self._build_shadow_index(migration)
+
+        self._swap_columns(PREVIOUS_COLUMN, SHADOW_COLUMN)
+        migration.status = "switched"
+        migration.switched_at = datetime.utcnow()
+        migration.lease_owner = None
+        migration.lease_until = None
+        self.db.commit()
+        logger.info(f"Switched vector search to {migration.target_model} (migration {migration.id})")
+
+        rescheduled = self._after_swap()
+        return {"success": True, "index": index, "rescheduled_chunks": rescheduled, **self.get_progress(migration)}
+
+    def rollback(self, migration: EmbeddingMigration) -> Dict[str, Any]:
+        """回滚到切换前的向量列与模型（切换后新增的 chunk 用原模型重新生成向量）"""
+        if migration.status != "switched":
+            return {"success": False, "error": f"Cannot roll back migration in status {migration.status}"}
+        has_previous = self.db.execute(text("""
+            SELECT 1 FROM information_schema.columns
+            WHERE table_name = 'chunks' AND column_name = :column
+        """), {"column": PREVIOUS_COLUMN}).first()
+        if not has_previous:
+            return {"success": False, "error": "Previous embeddings have already been dropped"}
+
+        self._swap_columns(SHADOW_COLUMN, PREVIOUS_COLUMN)
+        migration.status = "rolled_back"
+        self.db.commit()
+        logger.info(f"Rolled back vector search to {migration.source_model} (migration {migration.id})")
+
+        rescheduled = self._after_swap()
+        return {"success": True, "rescheduled_chunks": rescheduled, **self.get_progress(migration)}
+
+    def drop_previous(self) -> Dict[str, Any]:
+        """确认新向量无误后删除旧向量列（空间在后续 VACUUM 中回收）"""
+        self.db.execute(text("SET LOCAL lock_timeout = '10s'"))
+        self.db.execute(text(f"DROP INDEX IF EXISTS {PREVIOUS_INDEX_NAME}"))
+        self.db.execute(text(f"ALTER TABLE chunks DROP COLUMN IF EXISTS {PREVIOUS_COLUMN}"))
+        self.db.commit()
+        return {"success": True}
+
+    # ------------------------------------------------------------------
+    # 进度
+    # ------------------------------------------------------------------
+
+    def get_progress(self, migration: EmbeddingMigration) -> Dict[str, Any]:
+        """迁移进度与预计剩余时间"""
+        remaining = None
+        if migration.status in ACTIVE_STATUSES:
+            remaining = self._remaining()
+        total = migration.total_chunks or 0
+        done = max(total - remaining, 0) if remaining is not None else total
+        eta = None
+        if remaining and migration.rows_per_sec:
+            eta = round(remaining / migration.rows_per_sec)
+
+        stalled = migration.status == "running" and self._lease_expired(migration)
+
+        return {
+            "id": str(migration.id),
+            "source_model": migration.source_model,
+            "target_model": migration.target_model,
+            "dimension": migration.dimension,
+            "status": migration.status,
+            "stalled": stalled,
+            "pass": migration.pass_number,
+            "total_chunks": total,
+            "remaining_chunks": remaining,
+            "progress": round(done / total, 4) if total else 1.0,
+            "processed_chunks": migration.processed_chunks,
+            "failed_chunks": migration.failed_chunks,
+            "rows_per_sec": migration.rows_per_sec,
+            "batch_delay": migration.batch_delay,
+            "eta_seconds": eta,
+            "error": migration.error,
+            "created_at": migration.created_at.isoformat() if migration.created_at else None,
+            "updated_at": migration.updated_at.isoformat() if migration.updated_at else None,
+            "switched_at": migration.switched_at.isoformat() if migration.switched_at else None,
+        }
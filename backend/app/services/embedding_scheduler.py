@@ -0,0 +1,294 @@
+"""
+合并式 embedding 调度
+入库时不再为每个文档单独投递 generate_embeddings 任务，而是把待生成向量的 chunk ID 写入 Redis 待处理集合，
+由 drain_pending_embeddings 任务按数量（最多 N 个 chunk）或时间窗口（T 毫秒）成批取出处理，
+突发上传时把大量小请求合并为少量满批次请求；Redis 不可用时退回为直接投递任务。
+取出的 chunk 先移入带租约的处理中集合，向量提交后才删除；worker 崩溃时租约到期的 chunk 由下次取出时放回待处理集合。
+处理失败（含租约到期）按 chunk 计数，以指数退避放回待处理集合，超过最大次数后移入死信集合，不再重试
+"""
+import os
+import time
+import logging
+from typing import Any, Dict, Iterable, List
+
+from app.services.redis_client import get_redis, mark_redis_failed
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_COALESCE_ENABLED = os.getenv("EMBEDDING_COALESCE_ENABLED", "true").lower() == "true"
+EMBEDDING_COALESCE_MAX_CHUNKS = int(os.getenv("EMBEDDING_COALESCE_MAX_CHUNKS", "512"))
+EMBEDDING_COALESCE_WINDOW_MS = int(os.getenv("EMBEDDING_COALESCE_WINDOW_MS", "2000"))
+# 单个 drain 任务最多处理的批次数，超出后重新投递，避免长时间占用 worker
+EMBEDDING_DRAIN_MAX_BATCHES = int(os.getenv("EMBEDDING_DRAIN_MAX_BATCHES", "10"))
+# 取出的 chunk 的租约时长（秒），需大于处理一个批次的最长耗时
+EMBEDDING_CLAIM_LEASE_SECONDS = int(os.getenv("EMBEDDING_CLAIM_LEASE_SECONDS", "600"))
+# 单个 chunk 最多处理次数，超过后移入死信集合
+EMBEDDING_MAX_ATTEMPTS = int(os.getenv("EMBEDDING_MAX_ATTEMPTS", "5"))
+# 失败重试的退避时长（秒）：第 n 次失败后等待 base * 2^(n-1)，不超过 max
+EMBEDDING_RETRY_BASE_SECONDS = float(os.getenv("EMBEDDING_RETRY_BASE_SECONDS", "30"))
+EMBEDDING_RETRY_MAX_SECONDS = float(os.getenv("EMBEDDING_RETRY_MAX_SECONDS", "3600"))
+
+# 待处理 chunk：有序集合，score 为可处理时间（入队时间，失败重试时为退避结束时间）
+PENDING_KEY = "pkb:embedding:pending"
+# 已取出、正在处理的 chunk：有序集合，score 为租约到期时间
+PROCESSING_KEY = "pkb:embedding:processing"
+# 失败次数：哈希，chunk ID -> 次数（处理成功后删除）
+ATTEMPTS_KEY = "pkb:embedding:attempts"
+# 死信：有序集合，score 为移入时间
+DEAD_LETTER_KEY = "pkb:embedding:dead"
+# 已投递但尚未开始的 drain 任务标记，避免同一窗口内重复投递
+DRAIN_SCHEDULED_KEY = "pkb:embedding:drain_scheduled"
+
+# 记一次失败：退避后放回待处理集合，或超过最大次数移入死信集合（返回 true 表示已移入死信）
+# KEYS: pending, processing, attempts, dead；ARGV: now, max_attempts, base_seconds, max_seconds
+_RETRY_LUA = """
+local function retry(id)
+    local now = tonumber(ARGV[1])
+    redis.call('ZREM', KEYS[2], id)
+    local attempts = redis.call('HINCRBY', KEYS[3], id, 1)
+    if attempts >= tonumber(ARGV[2]) then
+        redis.call('HDEL', KEYS[3], id)
+        redis.call('ZREM', KEYS[1], id)
+        redis.call('ZADD', KEYS[4], now, id)
+        return true
+    end
+    local delay = math.min(tonumber(ARGV[3]) * 2 ^ (attempts - 1), tonumber(ARGV[4]))
+    redis.call('ZADD', KEYS[1], now + delay, id)
+    return false
+end
+"""
+
+# 原子地回收租约到期的 chunk（计一次失败），再取出已到可处理时间的最早一批并登记租约
+# ARGV 在 _RETRY_LUA 之后追加：lease_until, count
+CLAIM_SCRIPT = _RETRY_LUA + """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+for _, id in ipairs(expired) do
+    retry(id)
+end
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[6]))
+for _, id in ipairs(ids) do
+    redis.call('ZREM', KEYS[1], id)
+    redis.call('ZADD', KEYS[2], ARGV[5], id)
+end
+return ids
+"""
+
+# 处理失败的一批 chunk 逐个计数，返回移入死信集合的 chunk ID；ARGV[5..] 为 chunk ID
+FAIL_SCRIPT = _RETRY_LUA + """
+local dead = {}
+for i = 5, #ARGV do
+    if retry(ARGV[i]) then
+        table.insert(dead, ARGV[i])
+    end
+end
+return dead
+"""
+
+
+def _dispatch_direct(chunk_ids: List[str], countdown: float = 0) -> None:
+    from app.workers.tasks import generate_embeddings
+    generate_embeddings.apply_async((chunk_ids,), countdown=countdown)
+
+
+def _dispatch_drain(countdown: float) -> None:
+    from app.workers.tasks import drain_pending_embeddings
+    drain_pending_embeddings.apply_async(countdown=countdown)
+
+
+def schedule_embeddings(chunk_ids: Iterable[Any]) -> None:
+    """
+    登记需要生成向量的 chunk
+
+    待处理数量达到批次上限时立即触发处理，否则在时间窗口结束时处理
+    """
+    ids = [str(cid) for cid in chunk_ids]
+    if not ids:
+        return
+
+    client = get_redis() if EMBEDDING_COALESCE_ENABLED else None
+    if client is None:
+        _dispatch_direct(ids)
+        return
+
+    try:
+        now = time.time()
+        pipe = client.pipeline()
+        pipe.zadd(PENDING_KEY, {cid: now for cid in ids}, nx=True)
+        pipe.zcard(PENDING_KEY)
+        _, depth = pipe.execute()
+
+        if depth >= EMBEDDING_COALESCE_MAX_CHUNKS:
+            _dispatch_drain(countdown=0)
+        elif client.set(DRAIN_SCHEDULED_KEY, now, nx=True, px=EMBEDDING_COALESCE_WINDOW_MS * 5):
+            _dispatch_drain(countdown=EMBEDDING_COALESCE_WINDOW_MS / 1000)
+    except Exception as e:
+        logger.warning(f"Failed to enqueue chunks for coalesced embedding, dispatching directly: {e}")
+        mark_redis_failed()
+        _dispatch_direct(ids)
+
+
+def defer_embeddings(chunk_ids: Iterable[Any], countdown: float) -> None:
+    """
+    向量服务暂不可用（熔断打开）时把 chunk 延后处理
+
+    放回待处理集合并在冷却结束后投递 drain 任务；Redis 不可用时延迟投递 generate_embeddings
+    """
+    ids = [str(cid) for cid in chunk_ids]
+    client = get_redis() if EMBEDDING_COALESCE_ENABLED else None
+    if client is None:
+        if ids:
+            _dispatch_direct(ids, countdown=countdown)
+        return
+
+    try:
+        if ids:
+            _release(client, ids)
+        marker_ms = int(countdown * 1000) + EMBEDDING_COALESCE_WINDOW_MS * 5
+        if client.set(DRAIN_SCHEDULED_KEY, time.time(), nx=True, px=marker_ms):
+            _dispatch_drain(countdown=countdown)
+    except Exception as e:
+        logger.warning(f"Failed to defer chunks for coalesced embedding, dispatching directly: {e}")
+        mark_redis_failed()
+        if ids:
+            _dispatch_direct(ids, countdown=countdown)
+
+
+def _release(client, chunk_ids: List[str]) -> None:
+    """把已取出的 chunk 从处理中集合移回待处理集合"""
+    now = time.time()
+    pipe = client.pipeline()
+    pipe.zrem(PROCESSING_KEY, *chunk_ids)
+    pipe.zadd(PENDING_KEY, {cid: now for cid in chunk_ids}, nx=True)
+    pipe.execute()
+
+
+def _decode(members: List[Any]) -> List[str]:
+    return [member.decode() if isinstance(member, bytes) else member for member in members]
+
+
+def _retry_args(now: float) -> List[Any]:
+    return [now, EMBEDDING_MAX_ATTEMPTS, EMBEDDING_RETRY_BASE_SECONDS, EMBEDDING_RETRY_MAX_SECONDS]
+
+
+def claim_pending(count: int = EMBEDDING_COALESCE_MAX_CHUNKS) -> List[str]:
+    """
+    取出已到可处理时间的最早一批 chunk ID 并登记租约（处理完成后调用 ack，失败时调用 fail）
+
+    同时回收租约已到期的 chunk（处理它们的 worker 已崩溃或被强制终止），按一次失败计数
+    """
+    client = get_redis()
+    if client is None:
+        return []
+    now = time.time()
+    claimed = client.eval(
+        CLAIM_SCRIPT, 4, PENDING_KEY, PROCESSING_KEY, ATTEMPTS_KEY, DEAD_LETTER_KEY,
+        *_retry_args(now), now + EMBEDDING_CLAIM_LEASE_SECONDS, count
+    )
+    return _decode(claimed)
+
+
+def ack(chunk_ids: List[str]) -> None:
+    """向量已提交：释放租约并清除失败计数"""
+    client = get_redis()
+    if client is None or not chunk_ids:
+        return
+    pipe = client.pipeline()
+    pipe.zrem(PROCESSING_KEY, *chunk_ids)
+    pipe.hdel(ATTEMPTS_KEY, *chunk_ids)
+    pipe.execute()
+
+
+def fail(chunk_ids: List[str], error: Any) -> List[str]:
+    """
+    处理失败：每个 chunk 计一次失败，按指数退避放回待处理集合
+
+    达到 EMBEDDING_MAX_ATTEMPTS 的 chunk 移入死信集合并记录日志，返回这些 chunk ID
+    """
+    client = get_redis()
+    if client is None or not chunk_ids:
+        return []
+    dead = _decode(client.eval(
+        FAIL_SCRIPT, 4, PENDING_KEY, PROCESSING_KEY, ATTEMPTS_KEY, DEAD_LETTER_KEY,
+        *_retry_args(time.time()), *chunk_ids
+    ))
+    if dead:
+        logger.error(
+            f"Embedding failed {EMBEDDING_MAX_ATTEMPTS} times for {len(dead)} chunks, "
+            f"moved to dead letter set: {dead[:20]}; last error: {error}"
+        )
+    return dead
+
+
+def requeue(chunk_ids: List[str]) -> None:
+    """放回待处理集合立即重新处理（不计失败次数，如向量模型已切换）"""
+    client = get_redis()
+    if client is None or not chunk_ids:
+        return
+    _release(client, chunk_ids)
+
+
+def clear_drain_marker() -> None:
+    """drain 任务开始执行时清除标记，之后入队的 chunk 可以投递新的 drain 任务"""
+    client = get_redis()
+    if client is not None:
+        client.delete(DRAIN_SCHEDULED_KEY)
+
+
+def reschedule_if_pending() -> None:
+    """
+    drain 结束后仍有可处理的 chunk 时继续投递；
+    否则在最早的退避结束或租约到期时投递（重试失败的 chunk、回收崩溃 worker 的 chunk）
+    """
+    client = get_redis()
+    if client is None:
+        return
+    now = time.time()
+    ready = client.zcount(PENDING_KEY, "-inf", now)
+    if ready >= EMBEDDING_COALESCE_MAX_CHUNKS:
+        _dispatch_drain(countdown=0)
+    elif ready:
+        if client.set(DRAIN_SCHEDULED_KEY, now, nx=True, px=EMBEDDING_COALESCE_WINDOW_MS * 5):
+            _dispatch_drain(countdown=EMBEDDING_COALESCE_WINDOW_MS / 1000)
+    else:
+        due = [
+            entries[0][1]
+            for entries in (client.zrange(PENDING_KEY, 0, 0, withscores=True),
+                            client.zrange(PROCESSING_KEY, 0, 0, withscores=True))
+            if entries
+        ]
+        if due:
+            countdown = max(min(due) - now, 0) + 1
+            if client.set(DRAIN_SCHEDULED_KEY, now, nx=True, px=int(countdown * 1000) + EMBEDDING_COALESCE_WINDOW_MS * 5):
+                _dispatch_drain(countdown=countdown)
+
+
+def get_pending_stats() -> Dict[str, Any]:
+    """待处理队列深度与最早入队时长（监控指标）"""
+    client = get_redis()
+    if client is None:
+        return {"enabled": EMBEDDING_COALESCE_ENABLED, "redis_available": False}
+
+    now = time.time()
+    pipe = client.pipeline()
+    pipe.zcard(PENDING_KEY)
+    pipe.zrange(PENDING_KEY, 0, 0, withscores=True)
+    pipe.exists(DRAIN_SCHEDULED_KEY)
+    pipe.zcard(PROCESSING_KEY)
+    pipe.zcount(PROCESSING_KEY, "-inf", now)
+    pipe.zcount(PENDING_KEY, f"({now}", "+inf")
+    pipe.zcard(DEAD_LETTER_KEY)
+    depth, oldest, scheduled, processing, expired, backoff, dead = pipe.execute()
+
+    return {
+        "enabled": EMBEDDING_COALESCE_ENABLED,
+        "redis_available": True,
+        "pending_chunks": depth,
+        "processing_chunks": processing,
+        "expired_leases": expired,
+        "retrying_chunks": backoff,
+        "dead_letter_chunks": dead,
+        "oldest_pending_seconds": round(max(now - oldest[0][1], 0), 1) if oldest else 0,
+        "drain_scheduled": bool(scheduled),
+        "max_chunks_per_batch": EMBEDDING_COALESCE_MAX_CHUNKS,
+        "window_ms": EMBEDDING_COALESCE_WINDOW_MS,
+    }
@@ -3,25 +3,18 @@
 支持 OpenAI Embeddings 和本地模型（可选）
 """
 import os
-import numpy as np
 from typing import List, Optional, Dict, Any
 import logging
+from app.services.embedding_batcher import EmbeddingBatcher
+from app.services.query_embedding_cache import (
+    query_embedding_cache, normalize_query, QUERY_EMBEDDING_CACHE_ENABLED
+)
 
-# OpenAI 客户端导入
-try:
-    from openai import OpenAI
-    OPENAI_AVAILABLE = True
-except ImportError:
-    OpenAI = None
-    OPENAI_AVAILABLE = False
-
-# 可选导入 sentence_transformers
-try:
-    from sentence_transformers import SentenceTransformer
-    SENTENCE_TRANSFORMERS_AVAILABLE = True
-except ImportError:
-    SentenceTransformer = None
-    SENTENCE_TRANSFORMERS_AVAILABLE = False
+# OpenAI 客户端（进程内共享，见 openai_clients）
+from app.services.openai_clients import get_openai_client, OPENAI_AVAILABLE
+from app.services.local_embedding import get_local_engine, SENTENCE_TRANSFORMERS_AVAILABLE
+from app.services.similarity import cosine_similarity
+from app.services.embedding_guard import embedding_guard, EmbeddingUnavailableError
 
 logger = logging.getLogger(__name__)
 
@@ -35,7 +28,11 @@ class EmbeddingService:
         "text-embedding-ada-002": {"dimension": 1536, "cost_tier": "legacy"},
     }
     
-    def __init__(self):
+    def __init__(self, model: Optional[str] = None):
+        """
+        Args:
+            model: 指定使用的模型（向量模型迁移时使用目标模型），默认读取当前生效的模型
+        """
         # 检查 OpenAI 可用性
         if not OPENAI_AVAILABLE:
             logger.error("OpenAI library not available. Install with: pip install openai>=1.0.0")
@@ -49,7 +46,7 @@ class EmbeddingService:
         )
         
         # 当前使用的模型
-        self.current_model = self._get_current_model()
+        self.current_model = self.qualify_model_name(model) if model else self._get_current_model()
         
         # 初始化 OpenAI 客户端
         self.openai_client = None
@@ -58,50 +55,46 @@ class EmbeddingService:
                 # 配置 API Base（支持 Turing 平台）
                 api_base = os.getenv("TURING_API_BASE") or os.getenv("OPENAI_API_BASE")
                 
-                self.openai_client = OpenAI(
-                    api_key=self.openai_api_key,
-                    base_url=api_base
-                )
-                
-                if os.getenv("TURING_API_KEY"):
-                    logger.info(f"Turing platform embedding client initialized with base: {api_base}")
-                else:
-                    logger.info("OpenAI official embedding client initialized")
+                self.openai_client = get_openai_client("embedding", self.openai_api_key, api_base)
                     
             except Exception as e:
                 logger.error(f"Failed to initialize OpenAI client: {e}")
                 self.openai_enabled = False
         
-        # 初始化本地模型
-        if self.local_model_enabled:
-            try:
-                model_name = os.getenv("LOCAL_EMBEDDING_MODEL", "paraphrase-multilingual-MiniLM-L12-v2")
-                # 强制使用 CPU，适合无 GPU 环境
-                self.local_model = SentenceTransformer(model_name, device='cpu')
-                logger.info(f"Local embedding model loaded on CPU: {model_name}")
-            except Exception as e:
-                logger.error(f"Failed to load local embedding model: {e}")
-                self.local_model_enabled = False
-        elif os.getenv("USE_LOCAL_EMBEDDING", "false").lower() == "true":
+        # 本地模型由进程内单例引擎加载（首次编码时加载一次，所有实例共享）
+        self.local_engine = get_local_engine() if self.local_model_enabled else None
+        if not self.local_model_enabled and os.getenv("USE_LOCAL_EMBEDDING", "false").lower() == "true":
             logger.warning("Local embedding requested but sentence-transformers not available. Install with: pip install sentence-transformers")
     
+    @staticmethod
+    def qualify_model_name(model_name: str) -> str:
+        """Turing 平台使用带前缀的模型名，OpenAI 官方 API 使用原始模型名"""
+        if os.getenv("TURING_API_KEY") and not model_name.startswith("turing/"):
+            return f"turing/{model_name}"
+        return model_name
+    
     def _get_current_model(self) -> str:
         """获取当前配置的模型名称"""
-        if os.getenv("TURING_API_KEY"):
-            # Turing 平台使用带前缀的模型名
-            base_model = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
-            if not base_model.startswith("turing/"):
-                return f"turing/{base_model}"
-            return base_model
-        else:
-            # OpenAI 官方 API
-            return os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+        # 向量模型迁移切换后，以数据库记录的生效模型为准，保证查询向量与库中向量来自同一模型
+        from app.services.embedding_migration import get_active_model
+        active_model = get_active_model()
+        if active_model:
+            return active_model
+        return self.qualify_model_name(os.getenv("EMBEDDING_MODEL", "text-embedding-3-small"))
     
     def get_model_dimension(self, model_name: str = None) -> int:
         """获取指定模型的向量维度"""
         model_name = model_name or self.current_model
         return self.SUPPORTED_MODELS.get(model_name, {}).get("dimension", 3072)
     
+    def get_model_key(self) -> Optional[str]:
+        """当前实际生效的模型标识（用于向量缓存/去重存储的键），无可用模型时返回 None"""
+        if self.openai_enabled:
+            return self.current_model
+        if self.local_model_enabled:
+            return self.local_engine.model_key
+        return None
+    
     def is_enabled(self) -> bool:
         """检查是否有可用的嵌入服务"""
         return self.openai_enabled or self.local_model_enabled
@@ -137,10 +130,42 @@ class EmbeddingService:
             else:
                 logger.warning(f"Requested model '{model}' not available")
                 return None
+        except EmbeddingUnavailableError as e:
+            logger.warning(f"Embedding skipped: {e}")
+            return None
         except Exception as e:
             logger.error(f"Error getting embedding: {e}")
             return None
     
+    def get_query_embedding(self, query: str) -> Optional[List[float]]:
+        """
+        获取查询向量（带两级缓存）
+        
+        查询文本经规范化后按 (模型, 文本) 缓存，重复查询不再请求 embedding API
+        
+        Args:
+            query: 查询文本
+        
+        Returns:
+            向量列表或 None
+        """
+        text = normalize_query(query)
+        if not text or not QUERY_EMBEDDING_CACHE_ENABLED:
+            return self.get_embedding(text)
+        
+        cache_model = self.get_model_key()
+        if not cache_model:
+            return None
+        
+        embedding = query_embedding_cache.get(cache_model, text)
+        if embedding is not None:
+            return embedding
+        
+        embedding = self.get_embedding(text)
+        if embedding:
+            query_embedding_cache.set(cache_model, text, embedding)
+        return embedding
+    
     def batch_get_embeddings(self, texts: List[str], model: str = "auto") -> List[Optional[List[float]]]:
         """
         批量获取向量嵌入
@@ -170,7 +195,10 @@ class EmbeddingService:
                     return [None] * len(texts)
             
             if model == "openai" and self.openai_enabled:
-                embeddings = self._batch_get_openai_embeddings([text for _, text in valid_texts])
+                # 按条数/token 数切分子批次并发请求，失败只影响出错的子批次
+                embeddings = EmbeddingBatcher(self._batch_get_openai_embeddings).run(
+                    [text for _, text in valid_texts]
+                )
             elif model == "local" and self.local_model_enabled:
                 embeddings = self._batch_get_local_embeddings([text for _, text in valid_texts])
             else:
@@ -196,11 +224,13 @@ class EmbeddingService:
         model = self.current_model
         
         try:
-            response = self.openai_client.embeddings.create(
-                model=model,
-                input=text
+            # 单条请求来自搜索等交互场景，限流时只短暂等待，熔断时立即失败，瞬时错误重试一次
+            response = embedding_guard.call_interactive(
+                lambda: self.openai_client.embeddings.create(model=model, input=text)
             )
             return response.data[0].embedding
+        except EmbeddingUnavailableError:
+            raise
         except Exception as e:
             logger.error(f"Error getting OpenAI embedding with model {model}: {e}")
             raise
@@ -214,11 +244,12 @@ class EmbeddingService:
         model = self.current_model
         
         try:
-            response = self.openai_client.embeddings.create(
-                model=model,
-                input=texts
+            response = embedding_guard.call(
+                lambda: self.openai_client.embeddings.create(model=model, input=texts)
             )
             return [item.embedding for item in response.data]
+        except EmbeddingUnavailableError:
+            raise
         except Exception as e:
             logger.error(f"Error getting batch OpenAI embeddings with model {model}: {e}")
             raise
@@ -250,7 +281,9 @@ class EmbeddingService:
             if dimensions and ("text-embedding-3" in model):
                 params["dimensions"] = dimensions
             
-            response = self.openai_client.embeddings.create(**params)
+            response = embedding_guard.call_interactive(
+                lambda: self.openai_client.embeddings.create(**params)
+            )
             return response.data[0].embedding
             
         except Exception as e:
@@ -326,32 +359,18 @@ class EmbeddingService:
         """使用本地模型获取嵌入"""
         if not self.local_model_enabled:
             raise RuntimeError("Local embedding model not available")
-        embedding = self.local_model.encode(text)
-        return embedding.tolist()
+        return self.local_engine.encode([text])[0]
     
     def _batch_get_local_embeddings(self, texts: List[str]) -> List[List[float]]:
         """批量获取本地模型嵌入"""
         if not self.local_model_enabled:
             raise RuntimeError("Local embedding model not available")
-        embeddings = self.local_model.encode(texts)
-        return [emb.tolist() for emb in embeddings]
+        return self.local_engine.encode(texts)
     
     def get_similarity(self, embedding1: List[float], embedding2: List[float]) -> float:
         """计算两个向量的余弦相似度"""
         try:
-            vec1 = np.array(embedding1)
-            vec2 = np.array(embedding2)
-            
-            # 计算余弦相似度
-            dot_product = np.dot(vec1, vec2)
-            norm1 = np.linalg.norm(vec1)
-            norm2 = np.linalg.norm(vec2)
-            
-            if norm1 == 0 or norm2 == 0:
-                return 0.0
-            
-            similarity = dot_product / (norm1 * norm2)
-            return float(similarity)
+            return cosine_similarity(embedding1, embedding2)
         except Exception as e:
             logger.error(f"Error calculating similarity: {e}")
             return 0.0
@@ -359,14 +378,8 @@ class EmbeddingService:
     def get_model_info(self) -> Dict[str, Any]:
         """获取模型信息"""
         local_model_name = None
-        if self.local_model_enabled and hasattr(self, 'local_model'):
-            # 尝试获取模型名称，不同版本的 sentence-transformers 可能不同
-            if hasattr(self.local_model, '_model_name'):
-                local_model_name = self.local_model._model_name
-            elif hasattr(self.local_model, 'model_name'):
-                local_model_name = self.local_model.model_name
-            else:
-                local_model_name = "unknown"
+        if self.local_model_enabled:
+            local_model_name = self.local_engine.config["model"]
         
         # 检测使用的 API 平台
         api_platform = "disabled"
@@ -387,7 +400,10 @@ class EmbeddingService:
         if self.openai_enabled:
             current_dimension = self.get_model_dimension(self.current_model)
         elif self.local_model_enabled:
-            current_dimension = 384  # 默认本地模型维度
+            try:
+                current_dimension = self.local_engine.dimension()
+            except Exception as e:
+                logger.error(f"Failed to load local embedding model: {e}")
         
         return {
             "openai_available": OPENAI_AVAILABLE,
@@ -0,0 +1,185 @@
+"""
+向量覆盖率统计服务
+维护已生成向量的 chunk 数量：generate_embeddings 写入时增量累加，删除 chunk 时按其中已有向量的数量扣减，
+搜索通过进程内缓存以 O(1) 判断是否存在可检索的向量，避免每次查询都全表 COUNT；
+只有向量列切换（模型迁移）后才标记过期，由一个线程在独立连接上全量统计校准
+"""
+import os
+import time
+import threading
+import logging
+from typing import Dict, Any, Optional
+from sqlalchemy import delete, text
+from sqlalchemy.orm import Session
+
+from app.models import Chunk
+
+logger = logging.getLogger(__name__)
+
+STATS_ROW_ID = 1
+
+
+class EmbeddingStatsService:
+    """chunks.embedding 覆盖率统计"""
+
+    # 进程内缓存：{"embedded_chunks": int, "expires_at": float}
+    _cache: Dict[str, Any] = {}
+    _lock = threading.Lock()
+    # 统计过期时只允许一个线程全量统计，其余线程等待后复用结果
+    _refresh_lock = threading.Lock()
+
+    CACHE_TTL = float(os.getenv("EMBEDDING_STATS_CACHE_TTL", "10"))
+
+    def __init__(self, db: Session):
+        self.db = db
+
+    # ------------------------------------------------------------------
+    # 写入侧
+    # ------------------------------------------------------------------
+
+    def record_embedded(self, count: int) -> None:
+        """
+        累加新生成向量的 chunk 数量（与 chunk 更新在同一事务中提交）
+
+        Args:
+            count: 本次从无到有生成向量的 chunk 数量
+        """
+        if count <= 0:
+            return
+        # 统计行不存在时以过期状态插入，下次读取时全量统计校准
+        self.db.execute(text("""
+            INSERT INTO embedding_stats (id, embedded_chunks, is_stale, updated_at)
+            VALUES (:id, :count, true, now())
+            ON CONFLICT (id) DO UPDATE
+            SET embedded_chunks = embedding_stats.embedded_chunks + :count,
+                updated_at = now()
+        """), {"id": STATS_ROW_ID, "count": count})
+        self._clear_cache()
+
+    def record_deleted(self, count: int) -> None:
+        """
+        扣减被删除的已有向量 chunk 数量（与删除在同一事务中提交）
+
+        Args:
+            count: 删除的 chunk 中已生成向量的数量
+        """
+        if count <= 0:
+            return
+        self.db.execute(text("""
+            UPDATE embedding_stats
+            SET embedded_chunks = GREATEST(embedded_chunks - :count, 0), updated_at = now()
+            WHERE id = :id
+        """), {"id": STATS_ROW_ID, "count": count})
+        self._clear_cache()
+
+    def delete_chunks(self, *criteria) -> int:
+        """
+        删除满足条件的 chunk，并按其中已有向量的数量扣减计数
+
+        Returns:
+            删除的 chunk 数量
+        """
+        embedded = self.db.execute(
+            delete(Chunk).where(*criteria).returning(Chunk.embedding.is_not(None)),
+            execution_options={"synchronize_session": False},
+        ).scalars().all()
+        self.record_deleted(sum(embedded))
+        return len(embedded)
+
+    def invalidate(self) -> None:
+        """标记统计过期（向量列整体替换后调用），下次读取时重新全量统计"""
+        self.db.execute(text("""
+            UPDATE embedding_stats SET is_stale = true, updated_at = now() WHERE id = :id
+        """), {"id": STATS_ROW_ID})
+        self._clear_cache()
+
+    @classmethod
+    def _clear_cache(cls) -> None:
+        with cls._lock:
+            cls._cache.clear()
+
+    # ------------------------------------------------------------------
+    # 读取侧
+    # ------------------------------------------------------------------
+
+    def refresh(self) -> int:
+        """全量统计并写回统计行（在独立连接的独立事务中执行，不提交调用方的会话）"""
+        with self.db.get_bind().begin() as conn:
+            embedded = conn.execute(
+                text("SELECT COUNT(*) FROM chunks WHERE embedding IS NOT NULL")
+            ).scalar() or 0
+
+            conn.execute(text("""
+                INSERT INTO embedding_stats (id, embedded_chunks, is_stale, refreshed_at, updated_at)
+                VALUES (:id, :count, false, now(), now())
+                ON CONFLICT (id) DO UPDATE
+                SET embedded_chunks = :count, is_stale = false, refreshed_at = now(), updated_at = now()
+            """), {"id": STATS_ROW_ID, "count": embedded})
+
+        logger.info(f"Embedding stats refreshed: {embedded} embedded chunks")
+        return embedded
+
+    def get_embedded_count(self) -> int:
+        """获取已生成向量的 chunk 数量（进程内缓存 -> 统计行 -> 过期时全量统计）"""
+        now = time.time()
+        with self._lock:
+            if self._cache and self._cache["expires_at"] > now:
+                return self._cache["embedded_chunks"]
+
+        row = self.db.execute(text("""
+            SELECT embedded_chunks, is_stale FROM embedding_stats WHERE id = :id
+        """), {"id": STATS_ROW_ID}).first()
+
+        if row is not None and not row.is_stale:
+            embedded = row.embedded_chunks or 0
+        else:
+            with self._refresh_lock:
+                # 等待期间其他线程可能已完成全量统计
+                with self._lock:
+                    if self._cache and self._cache["expires_at"] > time.time():
+                        return self._cache["embedded_chunks"]
+                embedded = self.refresh()
+
+        with self._lock:
+            self._cache.update({"embedded_chunks": embedded, "expires_at": time.time() + self.CACHE_TTL})
+        return embedded
+
+    def has_embeddings(self) -> bool:
+        """是否存在至少一个已生成向量的 chunk"""
+        return self.get_embedded_count() > 0
+
+    def get_coverage(self, exact: bool = False) -> Dict[str, Any]:
+        """
+        获取向量覆盖率，用于运维监控
+
+        Args:
+            exact: 是否精确统计（会触发全表 COUNT 并校准计数器）
+
+        Returns:
+            覆盖率统计
+        """
+        if exact:
+            embedded = self.refresh()
+            total = self.db.execute(text("SELECT COUNT(*) FROM chunks")).scalar() or 0
+        else:
+            embedded = self.get_embedded_count()
+            # chunk 总数使用规划器统计估算，O(1)
+            total = self.db.execute(text("""
+                SELECT GREATEST(reltuples, 0)::bigint FROM pg_class WHERE relname = 'chunks'
+            """)).scalar() or 0
+            total = max(int(total), embedded)
+
+        row = self.db.execute(text("""
+            SELECT is_stale, refreshed_at, updated_at FROM embedding_stats WHERE id = :id
+        """), {"id": STATS_ROW_ID}).first()
+
+        return {
+            "embedded_chunks": embedded,
+            "total_chunks": total,
+            "total_is_estimate": not exact,
+            "pending_chunks": max(total - embedded, 0),
+            "coverage": round(embedded / total, 4) if total else 0.0,
+            "is_stale": bool(row.is_stale) if row else True,
+            "refreshed_at": row.refreshed_at.isoformat() if row and row.refreshed_at else None,
+            "updated_at": row.updated_at.isoformat() if row and row.updated_at else None,
+        }
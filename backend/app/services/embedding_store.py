@@ -0,0 +1,148 @@
+"""
+内容寻址向量存储
+按 (模型, sha256(规范化文本)) 保存已生成的向量：重复上传、图片重新分块、删除后重新扫描入库、
+以及各文档中重复出现的页眉页脚等相同文本直接复用已有向量，不再调用 embedding API
+"""
+import hashlib
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from app.models import EmbeddingStoreEntry
+from app.services.query_embedding_cache import normalize_query
+from app.services.vector_query import to_vector_literal
+
+logger = logging.getLogger(__name__)
+
+
+def text_hash(content: str) -> str:
+    """规范化文本（NFKC、折叠空白）后的 sha256"""
+    return hashlib.sha256(normalize_query(content).encode("utf-8")).hexdigest()
+
+
+class EmbeddingStore:
+    """向量去重存储，与调用方共用数据库会话（写入随调用方事务提交）"""
+
+    def __init__(self, db: Session):
+        self.db = db
+
+    def lookup(self, model: str, hashes: List[str]) -> Dict[str, List[float]]:
+        """批量查找已存在的向量"""
+        if not hashes:
+            return {}
+        rows = self.db.query(EmbeddingStoreEntry.text_hash, EmbeddingStoreEntry.embedding).filter(
+            EmbeddingStoreEntry.model == model,
+            EmbeddingStoreEntry.text_hash.in_(hashes)
+        ).all()
+        return {
+            row.text_hash: row.embedding.tolist() if hasattr(row.embedding, "tolist") else list(row.embedding)
+            for row in rows
+        }
+
+    def save(self, model: str, items: List[Tuple[str, List[float]]]) -> None:
+        """
+        写入新生成的向量（并发写入同一文本时保留先写入的一条）
+
+        按哈希排序写入：并发 worker 写入相同的常见文本时按相同顺序获取行锁，避免死锁
+        """
+        if not items:
+            return
+        self.db.execute(text("""
+            INSERT INTO embedding_store (model, text_hash, embedding, hit_count, created_at, last_used_at)
+            VALUES (:model, :text_hash, CAST(:embedding AS vector), 0, now(), now())
+            ON CONFLICT (model, text_hash) DO NOTHING
+        """), [
+            {"model": model, "text_hash": h, "embedding": to_vector_literal(embedding)}
+            for h, embedding in sorted(items, key=lambda item: item[0])
+        ])
+
+    def _record_hits(self, model: str, hit_counts: Dict[str, int]) -> None:
+        """
+        复用计数（尽力而为）：使用独立的自动提交连接，不参与向量写入事务；
+        其他事务正持有的行直接跳过（SKIP LOCKED），热点文本不会让各 worker 相互等待
+        """
+        if not hit_counts:
+            return
+        hashes = sorted(hit_counts)
+        try:
+            with self.db.get_bind().connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                conn.execute(text("""
+                    UPDATE embedding_store s
+                    SET hit_count = s.hit_count + h.hits, last_used_at = now()
+                    FROM (
+                        SELECT e.text_hash, v.hits
+                        FROM embedding_store e
+                        JOIN unnest(CAST(:hashes AS text[]), CAST(:hits AS int[])) AS v(text_hash, hits)
+                            ON e.text_hash = v.text_hash
+                        WHERE e.model = :model
+                        ORDER BY e.text_hash
+                        FOR UPDATE OF e SKIP LOCKED
+                    ) h
+                    WHERE s.model = :model AND s.text_hash = h.text_hash
+                """), {"model": model, "hashes": hashes, "hits": [hit_counts[h] for h in hashes]})
+        except Exception as e:
+            logger.debug(f"Failed to record embedding store hits: {e}")
+
+    def embed_texts(self, embedding_service, texts: List[str]) -> Tuple[List[Optional[List[float]]], Dict[str, int]]:
+        """
+        获取一组文本的向量：先查存储，只为缺失的不同文本调用 embedding API，并把新向量写回存储
+
+        Args:
+            embedding_service: EmbeddingService 实例
+            texts: 文本列表
+
+        Returns:
+            (与输入等长的向量列表, {"reused", "computed", "failed"} 统计)
+        """
+        model = embedding_service.get_model_key()
+        if not model:
+            return [None] * len(texts), {"reused": 0, "computed": 0, "failed": len(texts)}
+
+        hashes = [text_hash(t) if t and t.strip() else None for t in texts]
+        known = self.lookup(model, sorted({h for h in hashes if h}))
+
+        # 本批次内相同文本也只请求一次
+        missing: Dict[str, str] = {}
+        for h, t in zip(hashes, texts):
+            if h and h not in known and h not in missing:
+                missing[h] = t
+
+        computed = 0
+        if missing:
+            missing_hashes = list(missing)
+            embeddings = embedding_service.batch_get_embeddings([missing[h] for h in missing_hashes])
+            new_items = [(h, e) for h, e in zip(missing_hashes, embeddings) if e]
+            self.save(model, new_items)
+            known.update(dict(new_items))
+            computed = len(new_items)
+
+        hit_counts: Dict[str, int] = {}
+        results: List[Optional[List[float]]] = []
+        for h in hashes:
+            embedding = known.get(h) if h else None
+            results.append(embedding)
+            if embedding is not None and h not in missing:
+                hit_counts[h] = hit_counts.get(h, 0) + 1
+        self._record_hits(model, hit_counts)
+
+        stats = {
+            "reused": sum(hit_counts.values()),
+            "computed": computed,
+            "failed": sum(1 for r in results if r is None),
+        }
+        logger.info(f"Embedding store: {stats['reused']} reused, {stats['computed']} computed, {stats['failed']} failed")
+        return results, stats
+
+    def get_stats(self) -> Dict[str, Any]:
+        """存储规模与复用统计"""
+        rows = self.db.execute(text("""
+            SELECT model, COUNT(*) AS entries, COALESCE(SUM(hit_count), 0) AS hits
+            FROM embedding_store GROUP BY model ORDER BY model
+        """)).fetchall()
+        return {
+            "models": [{"model": r.model, "entries": r.entries, "hits": int(r.hits)} for r in rows],
+            "total_entries": sum(r.entries for r in rows),
+            "total_hits": sum(int(r.hits) for r in rows),
+        }
@@ -0,0 +1,455 @@
+"""
+关键词倒排索引
+在 chunks / contents 上维护 tsvector 列（GIN 索引），中文按二元组（bigram）切分并附带单字（与二元组同位置）、
+英文数字按词切分，入库时计算词项及位置；查询时把精确匹配、全部词匹配、任意词匹配三个层级合并为一次索引查询，并用 ts_rank 排序
+"""
+import re
+import logging
+from typing import List, Dict, Optional, Any, Tuple
+from sqlalchemy import event, text, inspect
+from sqlalchemy.orm import Session
+
+from app.models import Chunk, Content
+
+logger = logging.getLogger(__name__)
+
+# 中日韩字符（按 bigram 切分）
+CJK_PATTERN = "\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\u3040-\u30ff\uac00-\ud7af"
+TOKEN_RE = re.compile(f"[{CJK_PATTERN}]+|[0-9a-z\u00c0-\u024f]+")
+CJK_RE = re.compile(f"^[{CJK_PATTERN}]+$")
+
+# tsvector 限制：位置最大 16383，单个词项最多 256 个位置，词项最长 2046 字节
+MAX_POSITION = 16383
+MAX_POSITIONS_PER_LEXEME = 256
+MAX_LEXEME_LENGTH = 200
+
+# 层级基础分：精确匹配 > 全部词匹配 > 任意词匹配，再叠加 ts_rank
+TIER_BASE_SCORES = {3: 0.70, 2: 0.50, 1: 0.30}
+RANK_WEIGHT = 0.25
+
+# 索引构建互斥用的 advisory lock 键
+BACKFILL_LOCK_KEY = 7310002
+# 添加 search_vector 列互斥用的 advisory lock 键
+SCHEMA_LOCK_KEY = 7310003
+
+# 入库分词规则版本（记录在 chunks.search_vector 列注释中），变化后启动时原地重建词项
+TOKENIZER_VERSION = "pkb-tokenizer-2"
+
+# GIN 倒排索引：(索引名, 表名)
+KEYWORD_INDEXES = (
+    ("idx_chunks_search_vector", "chunks"),
+    ("idx_contents_search_vector", "contents"),
+)
+
+
+def tokenize(value: Optional[str]) -> List[str]:
+    """
+    切分文本为词项：中文连续片段切为二元组（单字保留），其余按字母数字词切分并转小写
+    """
+    if not value:
+        return []
+
+    tokens = []
+    for match in TOKEN_RE.finditer(value.lower()):
+        run = match.group()
+        if CJK_RE.match(run):
+            if len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        elif len(run) <= MAX_LEXEME_LENGTH:
+            tokens.append(run)
+    return tokens
+
+
+def index_tokens(value: Optional[str]) -> List[List[str]]:
+    """
+    入库词项：按位置分组，中文每个二元组与其首字同位置，末字与最后一个二元组同位置
+
+    单字查询可以命中任意位置的字（含二元组末字），二元组之间的相邻关系不变，短语查询不受影响
+    """
+    if not value:
+        return []
+
+    groups = []
+    for match in TOKEN_RE.finditer(value.lower()):
+        run = match.group()
+        if CJK_RE.match(run):
+            if len(run) == 1:
+                groups.append([run])
+            else:
+                groups.extend([run[i:i + 2], run[i]] for i in range(len(run) - 1))
+                groups[-1].append(run[-1])
+        elif len(run) <= MAX_LEXEME_LENGTH:
+            groups.append([run])
+    return groups
+
+
+def _quote_lexeme(lexeme: str) -> str:
+    """按 tsvector / tsquery 文本格式转义词项"""
+    return "'" + lexeme.replace("\\", "\\\\").replace("'", "''") + "'"
+
+
+def build_tsvector(sections: List[Tuple[Optional[str], str]]) -> Optional[str]:
+    """
+    构建 tsvector 文本表示（直接指定词项、位置和权重，不依赖数据库分词配置）
+
+    Args:
+        sections: [(文本, 权重 A/B/C/D)]，位置在各段之间连续编号
+
+    Returns:
+        tsvector 文本，没有词项时返回 None
+    """
+    positions: Dict[str, List[str]] = {}
+    position = 0
+    for value, weight in sections:
+        suffix = "" if weight == "D" else weight
+        for group in index_tokens(value):
+            position = min(position + 1, MAX_POSITION)
+            for token in group:
+                entries = positions.setdefault(token, [])
+                if len(entries) < MAX_POSITIONS_PER_LEXEME and (not entries or entries[-1] != f"{position}{suffix}"):
+                    entries.append(f"{position}{suffix}")
+
+    if not positions:
+        return None
+    return " ".join(f"{_quote_lexeme(lexeme)}:{','.join(entries)}" for lexeme, entries in positions.items())
+
+
+def chunk_search_vector(chunk_text: Optional[str]) -> Optional[str]:
+    """chunk 正文的 tsvector"""
+    return build_tsvector([(chunk_text, "D")])
+
+
+def content_search_vector(title: Optional[str], meta: Optional[Dict]) -> Optional[str]:
+    """文档标题（权重 A）和元数据关键词（权重 B）的 tsvector"""
+    keywords = (meta or {}).get("keywords") if isinstance(meta, dict) else None
+    if isinstance(keywords, (list, tuple)):
+        keywords = " ".join(str(k) for k in keywords)
+    return build_tsvector([(title, "A"), (keywords if isinstance(keywords, str) else None, "B")])
+
+
+def _phrase_query(value: str) -> Optional[str]:
+    """将一个词/短语转换为 tsquery 短语（相邻词项用 <-> 连接，等价于子串匹配）"""
+    tokens = tokenize(value)
+    if not tokens:
+        return None
+    if len(tokens) == 1 and len(tokens[0]) == 1 and CJK_RE.match(tokens[0]):
+        # 单个汉字：匹配单字词项（任意位置）；前缀匹配兼容按旧规则入库、尚未重建的行
+        return f"{_quote_lexeme(tokens[0])}:*"
+    return "(" + " <-> ".join(_quote_lexeme(t) for t in tokens) + ")"
+
+
+def _combine(parts: List[Optional[str]], operator: str) -> Optional[str]:
+    """用指定运算符组合多个 tsquery 片段（去重、忽略空片段）"""
+    parts = list(dict.fromkeys(p for p in parts if p))
+    if not parts:
+        return None
+    return "(" + f" {operator} ".join(parts) + ")"
+
+
+def build_tiered_queries(query: str, search_terms: List[str]) -> Optional[Dict[str, str]]:
+    """
+    构建三个层级的 tsquery
+
+    - exact: 完整查询或其同义词作为短语匹配（对应原 LIKE '%query%'）
+    - all_words: 所有空格分隔的词都出现
+    - any_word: 任意一个词出现
+
+    Returns:
+        {"exact", "all_words", "any_word", "candidates"}，无法生成词项时返回 None
+    """
+    words = [w.strip() for w in query.split() if w.strip()]
+
+    exact = _combine([_phrase_query(term) for term in [query] + list(search_terms)], "|")
+    all_words = _combine([_phrase_query(w) for w in words], "&")
+    any_word = _combine([_phrase_query(w) for w in words], "|")
+
+    if not exact and not any_word:
+        return None
+
+    exact = exact or any_word
+    all_words = all_words or exact
+    any_word = any_word or exact
+    return {
+        "exact": exact,
+        "all_words": all_words,
+        "any_word": any_word,
+        # 候选集：任意层级命中
+        "candidates": f"{exact} | {any_word}",
+    }
+
+
+class KeywordIndex:
+    """基于 tsvector 倒排索引的关键词检索"""
+
+    def __init__(self, db: Session):
+        self.db = db
+
+    def hits_sql(self) -> str:
+        """
+        命中 chunk 及其得分的 SQL（一次索引查询覆盖三个层级）
+
+        需要绑定参数 :kw_exact / :kw_all / :kw_any / :kw_candidates
+        """
+        return f"""
+            WITH q AS (
+                SELECT CAST(:kw_exact AS tsquery) AS exact,
+                       CAST(:kw_all AS tsquery) AS all_words,
+                       CAST(:kw_any AS tsquery) AS any_word,
+                       CAST(:kw_candidates AS tsquery) AS candidates
+            ),
+            matched AS (
+                SELECT c.id FROM chunks c, q WHERE c.search_vector @@ q.candidates
+                UNION
+                SELECT c.id FROM contents ct JOIN chunks c ON c.content_id = ct.id, q
+                WHERE ct.search_vector @@ q.candidates
+            )
+            SELECT c.id AS chunk_id, c.content_id,
+                CASE
+                    WHEN COALESCE(c.search_vector @@ q.exact, false) OR COALESCE(ct.search_vector @@ q.exact, false)
+                        THEN {TIER_BASE_SCORES[3]}
+                    WHEN COALESCE(c.search_vector @@ q.all_words, false) OR COALESCE(ct.search_vector @@ q.all_words, false)
+                        THEN {TIER_BASE_SCORES[2]}
+                    ELSE {TIER_BASE_SCORES[1]}
+                END
+                + {RANK_WEIGHT} * GREATEST(
+                    ts_rank(COALESCE(c.search_vector, ''::tsvector), q.candidates, 32),
+                    ts_rank(COALESCE(ct.search_vector, ''::tsvector), q.candidates, 32)
+                ) AS score
+            FROM matched
+            JOIN chunks c ON c.id = matched.id
+            JOIN contents ct ON ct.id = c.content_id, q
+        """
+
+    def document_hits_sql(self) -> str:
+        """
+        按文档分组的命中 SQL：每个文档只保留得分最高的 chunk，并附带其余命中 chunk 的ID
+
+        在关联正文之前完成去重，长文档的大量命中 chunk 不会占满 LIMIT；
+        除 hits_sql 的参数外还需要绑定 :kw_supporting（附带的 chunk ID 数量）
+        """
+        return f"""
+            SELECT DISTINCT ON (hits.content_id) hits.chunk_id, hits.score,
+                (array_agg(hits.chunk_id) OVER (
+                    PARTITION BY hits.content_id ORDER BY hits.score DESC
+                    ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING
+                ))[2:1 + CAST(:kw_supporting AS int)] AS supporting_chunk_ids
+            FROM ({self.hits_sql()}) hits
+            ORDER BY hits.content_id, hits.score DESC
+        """
+
+    def build_params(self, query: str, search_terms: List[str]) -> Optional[Dict[str, str]]:
+        """构建查询参数，无法生成词项时返回 None"""
+        queries = build_tiered_queries(query, search_terms)
+        if not queries:
+            return None
+        return {
+            "kw_exact": queries["exact"],
+            "kw_all": queries["all_words"],
+            "kw_any": queries["any_word"],
+            "kw_candidates": queries["candidates"],
+        }
+
+    # ------------------------------------------------------------------
+    # 索引维护
+    # ------------------------------------------------------------------
+
+    def get_status(self) -> Dict[str, Any]:
+        """倒排索引覆盖情况"""
+        row = self.db.execute(text("""
+            SELECT
+                (SELECT COUNT(*) FROM chunks) AS total_chunks,
+                (SELECT COUNT(*) FROM chunks WHERE search_vector IS NULL) AS pending_chunks,
+                (SELECT COUNT(*) FROM contents) AS total_contents,
+                (SELECT COUNT(*) FROM contents WHERE search_vector IS NULL) AS pending_contents
+        """)).first()
+        return {
+            "total_chunks": row.total_chunks,
+            "pending_chunks": row.pending_chunks,
+            "total_contents": row.total_contents,
+            "pending_contents": row.pending_contents,
+        }
+
+    def _rebuild(self, table: str, columns: str, compute, batch_size: int) -> int:
+        """按主键顺序分批原地重算词项（重建期间旧词项仍可检索）"""
+        updated = 0
+        last_id = None
+        while True:
+            if last_id is None:
+                rows = self.db.execute(text(f"""
+                    SELECT id, {columns} FROM {table} ORDER BY id LIMIT :limit
+                """), {"limit": batch_size}).fetchall()
+            else:
+                rows = self.db.execute(text(f"""
+                    SELECT id, {columns} FROM {table} WHERE id > :last_id ORDER BY id LIMIT :limit
+                """), {"last_id": last_id, "limit": batch_size}).fetchall()
+            if not rows:
+                break
+            self.db.execute(
+                text(f"UPDATE {table} SET search_vector = CAST(:sv AS tsvector) WHERE id = :id"),
+                [{"id": row.id, "sv": compute(row) or ""} for row in rows]
+            )
+            self.db.commit()
+            updated += len(rows)
+            last_id = rows[-1].id
+        return updated
+
+    def backfill(self, batch_size: int = 500, rebuild: bool = False) -> Dict[str, int]:
+        """
+        为缺少 tsvector 的 chunks / contents 计算倒排词项
+
+        Args:
+            batch_size: 每批处理数量
+            rebuild: 是否全部重建（分词规则变化后使用，原地分批重算，不会清空已有词项）
+
+        Returns:
+            处理数量
+        """
+        updated = {"contents": 0, "chunks": 0}
+        if rebuild:
+            updated["contents"] = self._rebuild(
+                "contents", "title, meta", lambda row: content_search_vector(row.title, row.meta), batch_size
+            )
+            updated["chunks"] = self._rebuild(
+                "chunks", "text", lambda row: chunk_search_vector(row.text), batch_size
+            )
+
+        while True:
+            rows = self.db.execute(text("""
+                SELECT id, title, meta FROM contents WHERE search_vector IS NULL LIMIT :limit
+            """), {"limit": batch_size}).fetchall()
+            if not rows:
+                break
+            self.db.execute(
+                text("UPDATE contents SET search_vector = CAST(:sv AS tsvector) WHERE id = :id"),
+                [{"id": row.id, "sv": content_search_vector(row.title, row.meta) or ""} for row in rows]
+            )
+            self.db.commit()
+            updated["contents"] += len(rows)
+
+        while True:
+            rows = self.db.execute(text("""
+                SELECT id, text FROM chunks WHERE search_vector IS NULL LIMIT :limit
+            """), {"limit": batch_size}).fetchall()
+            if not rows:
+                break
+            self.db.execute(
+                text("UPDATE chunks SET search_vector = CAST(:sv AS tsvector) WHERE id = :id"),
+                [{"id": row.id, "sv": chunk_search_vector(row.text) or ""} for row in rows]
+            )
+            self.db.commit()
+            updated["chunks"] += len(rows)
+
+        if updated["contents"] or updated["chunks"]:
+            logger.info(f"Keyword index backfilled: {updated}")
+        return updated
+
+
+# ----------------------------------------------------------------------
+# 入库时维护 tsvector
+# ----------------------------------------------------------------------
+
+@event.listens_for(Chunk, "before_insert")
+@event.listens_for(Chunk, "before_update")
+def _set_chunk_search_vector(mapper, connection, target):
+    """chunk 写入时计算正文词项（更新时仅在正文变化时重新计算）"""
+    state = inspect(target)
+    if state.persistent and not state.attrs.text.history.has_changes():
+        return
+    if target.text is not None:
+        target.search_vector = chunk_search_vector(target.text) or ""
+
+
+@event.listens_for(Content, "before_insert")
+@event.listens_for(Content, "before_update")
+def _set_content_search_vector(mapper, connection, target):
+    """content 写入时计算标题和关键词词项（更新时仅在标题或元数据变化时重新计算）"""
+    state = inspect(target)
+    if state.persistent and not (
+        state.attrs.title.history.has_changes() or state.attrs.meta.history.has_changes()
+    ):
+        return
+    target.search_vector = content_search_vector(target.title, target.meta) or ""
+
+
+def ensure_keyword_columns() -> None:
+    """
+    确保 chunks / contents 上存在 search_vector 列（API 与 Celery worker 启动时同步调用）
+
+    ORM 模型已映射该列，列不存在时所有 Chunk / Content 查询都会失败，必须在处理请求或任务之前完成；
+    可空且无默认值的 ADD COLUMN 只修改系统目录，不会重写表。表尚未创建时跳过（create_all 会建出该列）
+    """
+    from app.db import engine
+
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        missing = [
+            table for table in ("chunks", "contents")
+            if conn.execute(text("SELECT to_regclass(:table)"), {"table": table}).scalar() is not None
+            and not conn.execute(text("""
+                SELECT 1 FROM information_schema.columns
+                WHERE table_schema = current_schema() AND table_name = :table AND column_name = 'search_vector'
+            """), {"table": table}).first()
+        ]
+        if not missing:
+            return
+
+        # create_all 不会为已有表添加新列；多个进程同时启动时依次执行
+        conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": SCHEMA_LOCK_KEY})
+        try:
+            for table in missing:
+                conn.execute(text(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS search_vector tsvector"))
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": SCHEMA_LOCK_KEY})
+        logger.info(f"Added search_vector column to {missing}")
+
+
+def _index_validity(conn, name: str) -> Optional[bool]:
+    """索引是否有效，不存在时返回 None（CONCURRENTLY 构建失败会遗留无效索引）"""
+    return conn.execute(text("""
+        SELECT ix.indisvalid FROM pg_class i JOIN pg_index ix ON ix.indexrelid = i.oid
+        WHERE i.relname = :name
+    """), {"name": name}).scalar()
+
+
+def ensure_keyword_index() -> None:
+    """
+    确保 GIN 索引存在并补全历史数据（应用启动时在后台调用）
+
+    索引使用 CONCURRENTLY 构建，不阻塞入库写入
+    """
+    from app.db import SessionLocal, engine
+
+    try:
+        ensure_keyword_columns()
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            locked = conn.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": BACKFILL_LOCK_KEY}).scalar()
+            if not locked:
+                return
+            try:
+                for name, table in KEYWORD_INDEXES:
+                    valid = _index_validity(conn, name)
+                    if valid:
+                        continue
+                    if valid is False:
+                        conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+                    conn.execute(text(
+                        f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} USING gin (search_vector)"
+                    ))
+
+                # 分词规则变化后原地重建全部词项，否则只补全缺失的
+                version = conn.execute(text("""
+                    SELECT col_description('chunks'::regclass, attnum) FROM pg_attribute
+                    WHERE attrelid = 'chunks'::regclass AND attname = 'search_vector'
+                """)).scalar()
+                db = SessionLocal()
+                try:
+                    KeywordIndex(db).backfill(rebuild=version != TOKENIZER_VERSION)
+                finally:
+                    db.close()
+                if version != TOKENIZER_VERSION:
+                    conn.execute(text(f"COMMENT ON COLUMN chunks.search_vector IS '{TOKENIZER_VERSION}'"))
+            finally:
+                conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": BACKFILL_LOCK_KEY})
+    except Exception as e:
+        logger.warning(f"Failed to ensure keyword index: {e}")
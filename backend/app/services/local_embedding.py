@@ -0,0 +1,420 @@
+"""
+本地 CPU 向量引擎
+每个进程只加载一次 SentenceTransformer 模型（可选 ONNX / OpenVINO 后端与 int8 量化模型文件），
+并发请求由调度线程动态合并为批次，可选交给独立的进程池并行编码，适合无 GPU、无外网的节点离线运行
+"""
+import os
+import time
+import queue
+import threading
+import logging
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+# 可选导入 sentence_transformers
+try:
+    from sentence_transformers import SentenceTransformer
+    SENTENCE_TRANSFORMERS_AVAILABLE = True
+except ImportError:
+    SentenceTransformer = None
+    SENTENCE_TRANSFORMERS_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+USE_LOCAL_EMBEDDING = os.getenv("USE_LOCAL_EMBEDDING", "false").lower() == "true"
+LOCAL_EMBEDDING_MODEL = os.getenv("LOCAL_EMBEDDING_MODEL", "paraphrase-multilingual-MiniLM-L12-v2")
+# 推理后端：torch | onnx | openvino（后两者需要 sentence-transformers>=3.2 及对应运行时）
+LOCAL_EMBEDDING_BACKEND = os.getenv("LOCAL_EMBEDDING_BACKEND", "torch").lower()
+# ONNX / OpenVINO 模型文件，如 onnx/model_qint8_avx512_vnni.onnx（int8 量化）
+LOCAL_EMBEDDING_MODEL_FILE = os.getenv("LOCAL_EMBEDDING_MODEL_FILE")
+LOCAL_EMBEDDING_CACHE_DIR = os.getenv("LOCAL_EMBEDDING_CACHE_DIR")
+# 编码进程数，0 表示在当前进程内编码
+LOCAL_EMBEDDING_WORKERS = int(os.getenv("LOCAL_EMBEDDING_WORKERS", "0"))
+# 每个编码进程的线程数，0 表示使用库默认值
+LOCAL_EMBEDDING_THREADS = int(os.getenv("LOCAL_EMBEDDING_THREADS", "0"))
+LOCAL_EMBEDDING_MAX_BATCH = int(os.getenv("LOCAL_EMBEDDING_MAX_BATCH", "64"))
+LOCAL_EMBEDDING_MAX_WAIT_MS = float(os.getenv("LOCAL_EMBEDDING_MAX_WAIT_MS", "5"))
+# 单次编码请求的最长等待时间（秒），超时后请求失败，调用方退回关键词检索
+LOCAL_EMBEDDING_TIMEOUT = float(os.getenv("LOCAL_EMBEDDING_TIMEOUT", "60"))
+
+
+def _load_model(config: Dict[str, Any]):
+    """加载模型；指定的后端不可用时退回 torch"""
+    if config["threads"] > 0:
+        try:
+            import torch
+            torch.set_num_threads(config["threads"])
+        except ImportError:
+            pass
+
+    kwargs: Dict[str, Any] = {"device": "cpu"}
+    if config["cache_dir"]:
+        kwargs["cache_folder"] = config["cache_dir"]
+
+    if config["backend"] != "torch":
+        backend_kwargs = dict(kwargs, backend=config["backend"])
+        if config["model_file"]:
+            backend_kwargs["model_kwargs"] = {"file_name": config["model_file"]}
+        try:
+            return SentenceTransformer(config["model"], **backend_kwargs)
+        except Exception as e:
+            logger.warning(f"Local embedding backend '{config['backend']}' unavailable, falling back to torch: {e}")
+
+    return SentenceTransformer(config["model"], **kwargs)
+
+
+# 编码进程内的模型（进程池 initializer 中加载）
+_worker_model = None
+
+
+def _init_worker(config: Dict[str, Any]) -> None:
+    global _worker_model
+    _worker_model = _load_model(config)
+
+
+def _worker_encode(texts: List[str]) -> np.ndarray:
+    return _worker_model.encode(texts, batch_size=len(texts), convert_to_numpy=True).astype(np.float32)
+
+
+def _worker_dimension() -> int:
+    return _worker_model.get_sentence_embedding_dimension()
+
+
+class _Request:
+    __slots__ = ("texts", "future", "enqueued_at")
+
+    def __init__(self, texts: List[str]):
+        self.texts = texts
+        self.future: Future = Future()
+        self.enqueued_at = time.perf_counter()
+
+
+class _Group:
+    """一次调度合并的请求：拆成若干批编码，全部完成后按偏移切回各请求"""
+
+    def __init__(self, requests: List[_Request], batches: int):
+        self.requests = requests
+        self.results: List[Optional[np.ndarray]] = [None] * batches
+        self.remaining = batches
+        self.lock = threading.Lock()
+
+    def complete(self, index: int, embeddings: Optional[np.ndarray], error: Optional[BaseException]) -> None:
+        if error is not None:
+            for request in self.requests:
+                if not request.future.done():
+                    request.future.set_exception(error)
+            return
+
+        with self.lock:
+            self.results[index] = embeddings
+            self.remaining -= 1
+            if self.remaining:
+                return
+
+        stacked = np.concatenate(self.results) if len(self.results) > 1 else self.results[0]
+        offset = 0
+        for request in self.requests:
+            count = len(request.texts)
+            if not request.future.done():
+                request.future.set_result(stacked[offset:offset + count])
+            offset += count
+
+
+class LocalEmbeddingEngine:
+    """进程内单例的本地向量引擎（动态批处理 + 可选进程池）"""
+
+    def __init__(
+        self,
+        model: str = LOCAL_EMBEDDING_MODEL,
+        backend: str = LOCAL_EMBEDDING_BACKEND,
+        model_file: Optional[str] = LOCAL_EMBEDDING_MODEL_FILE,
+        workers: int = LOCAL_EMBEDDING_WORKERS,
+        threads: int = LOCAL_EMBEDDING_THREADS,
+        max_batch: int = LOCAL_EMBEDDING_MAX_BATCH,
+        max_wait_ms: float = LOCAL_EMBEDDING_MAX_WAIT_MS,
+        timeout: float = LOCAL_EMBEDDING_TIMEOUT,
+    ):
+        self.config = {
+            "model": model,
+            "backend": backend,
+            "model_file": model_file,
+            "cache_dir": LOCAL_EMBEDDING_CACHE_DIR,
+            "threads": threads,
+        }
+        self.max_batch = max(max_batch, 1)
+        self.max_wait = max(max_wait_ms, 0) / 1000
+        self.timeout = timeout if timeout > 0 else None
+
+        # Celery prefork 的 worker 是守护进程，不能再创建子进程，只能在进程内编码
+        if workers > 0 and multiprocessing.current_process().daemon:
+            logger.warning("Local embedding process pool unavailable in daemon process, encoding in-process")
+            workers = 0
+        self.workers = workers
+
+        self._model = None
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._slots = threading.BoundedSemaphore(max(workers, 1))
+        self._queue: "queue.Queue[_Request]" = queue.Queue()
+        self._dispatcher: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._pool_lock = threading.Lock()
+        self._dimension: Optional[int] = None
+
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "requests": 0, "texts": 0, "batches": 0, "encode_seconds": 0.0, "queue_wait_seconds": 0.0,
+            "timeouts": 0, "pool_restarts": 0,
+        }
+
+    @property
+    def model_key(self) -> str:
+        """向量缓存/去重存储使用的模型标识（不同后端或量化文件的向量不混用）"""
+        key = f"local:{self.config['model']}"
+        if self.config["backend"] != "torch":
+            key += f":{self.config['backend']}"
+            if self.config["model_file"]:
+                key += f":{self.config['model_file']}"
+        return key
+
+    def _ensure_started(self) -> None:
+        if self._dispatcher is not None:
+            return
+        with self._start_lock:
+            if self._dispatcher is not None:
+                return
+            started = time.perf_counter()
+            if self.workers > 0:
+                self._pool = self._new_pool()
+                self._dimension = self._pool.submit(_worker_dimension).result()
+            else:
+                self._model = _load_model(self.config)
+                self._dimension = self._model.get_sentence_embedding_dimension()
+            logger.info(
+                f"Local embedding engine ready: {self.model_key}, {self.workers or 'in-process'} workers, "
+                f"loaded in {time.perf_counter() - started:.1f}s"
+            )
+            self._dispatcher = threading.Thread(target=self._dispatch_loop, name="local-embedding", daemon=True)
+            self._dispatcher.start()
+
+    def _new_pool(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(self.config,),
+        )
+
+    def _restart_pool(self, broken: ProcessPoolExecutor) -> None:
+        """编码进程异常退出（如被 OOM kill）后进程池不可再用，关闭并重建（同一个池只重建一次）"""
+        with self._pool_lock:
+            if self._pool is not broken:
+                return
+            logger.error("Local embedding process pool broken, restarting")
+            broken.shutdown(wait=False, cancel_futures=True)
+            self._pool = self._new_pool()
+        with self._stats_lock:
+            self._stats["pool_restarts"] += 1
+
+    def dimension(self) -> int:
+        self._ensure_started()
+        return self._dimension
+
+    def encode(self, texts: List[str]) -> List[List[float]]:
+        """编码一组文本（阻塞直到完成），与其他线程的并发请求合并批处理"""
+        if not texts:
+            return []
+        self._ensure_started()
+        request = _Request(list(texts))
+        self._queue.put(request)
+        try:
+            return request.future.result(timeout=self.timeout).tolist()
+        except TimeoutError:
+            # 取消后迟到的编码结果直接丢弃
+            request.future.cancel()
+            with self._stats_lock:
+                self._stats["timeouts"] += 1
+            raise TimeoutError(f"Local embedding timed out after {self.timeout}s")
+
+    # ------------------------------------------------------------------
+    # 调度
+    # ------------------------------------------------------------------
+
+    def _dispatch_loop(self) -> None:
+        while True:
+            requests = [self._queue.get()]
+            size = len(requests[0].texts)
+            # 在等待窗口内继续收集请求，凑满一个批次
+            deadline = time.perf_counter() + self.max_wait
+            while size < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                requests.append(request)
+                size += len(request.texts)
+
+            try:
+                self._run(requests)
+            except Exception as e:
+                logger.error(f"Local embedding dispatch failed: {e}")
+                for request in requests:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+
+    def _run(self, requests: List[_Request]) -> None:
+        now = time.perf_counter()
+        texts = [t for request in requests for t in request.texts]
+        batches = [texts[i:i + self.max_batch] for i in range(0, len(texts), self.max_batch)]
+        group = _Group(requests, len(batches))
+
+        with self._stats_lock:
+            self._stats["requests"] += len(requests)
+            self._stats["queue_wait_seconds"] += sum(now - r.enqueued_at for r in requests)
+
+        for index, batch in enumerate(batches):
+            if self._pool is None:
+                self._encode_in_process(group, index, batch)
+            else:
+                # 所有编码进程都忙时在这里等待，期间到达的请求在队列中累积为更大的批次
+                self._slots.acquire()
+                pool = self._pool
+                started = time.perf_counter()
+                try:
+                    future = pool.submit(_worker_encode, batch)
+                except BaseException as e:
+                    self._slots.release()
+                    if isinstance(e, BrokenProcessPool):
+                        self._restart_pool(pool)
+                    group.complete(index, None, e)
+                    return
+                future.add_done_callback(
+                    lambda f, index=index, size=len(batch), started=started, pool=pool: self._on_pool_done(
+                        group, index, size, started, pool, f
+                    )
+                )
+
+    def _encode_in_process(self, group: _Group, index: int, batch: List[str]) -> None:
+        started = time.perf_counter()
+        try:
+            embeddings = self._model.encode(batch, batch_size=len(batch), convert_to_numpy=True).astype(np.float32)
+        except Exception as e:
+            group.complete(index, None, e)
+            return
+        self._record_batch(len(batch), time.perf_counter() - started)
+        group.complete(index, embeddings, None)
+
+    def _on_pool_done(
+        self, group: _Group, index: int, size: int, started: float, pool: ProcessPoolExecutor, future: Future
+    ) -> None:
+        self._slots.release()
+        error = future.exception() if not future.cancelled() else BrokenProcessPool("Local embedding pool restarted")
+        if isinstance(error, BrokenProcessPool):
+            self._restart_pool(pool)
+        if error is None:
+            self._record_batch(size, time.perf_counter() - started)
+        group.complete(index, None if error else future.result(), error)
+
+    def _record_batch(self, size: int, seconds: float) -> None:
+        with self._stats_lock:
+            self._stats["texts"] += size
+            self._stats["batches"] += 1
+            self._stats["encode_seconds"] += seconds
+
+    # ------------------------------------------------------------------
+    # 统计
+    # ------------------------------------------------------------------
+
+    def stats(self) -> Dict[str, Any]:
+        """编码吞吐统计（每个编码进程的平均吞吐；整体吞吐见 benchmark）"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        return {
+            "model_key": self.model_key,
+            "backend": self.config["backend"],
+            "model_file": self.config["model_file"],
+            "workers": self.workers,
+            "max_batch": self.max_batch,
+            "max_wait_ms": self.max_wait * 1000,
+            "loaded": self._dispatcher is not None,
+            "dimension": self._dimension,
+            "requests": stats["requests"],
+            "texts": stats["texts"],
+            "batches": stats["batches"],
+            "avg_batch_size": round(stats["texts"] / stats["batches"], 1) if stats["batches"] else 0.0,
+            "avg_queue_wait_ms": round(stats["queue_wait_seconds"] / stats["requests"] * 1000, 2)
+            if stats["requests"] else 0.0,
+            "texts_per_sec_per_worker": round(stats["texts"] / stats["encode_seconds"], 1)
+            if stats["encode_seconds"] else 0.0,
+            "queue_depth": self._queue.qsize(),
+            "timeouts": stats["timeouts"],
+            "pool_restarts": stats["pool_restarts"],
+        }
+
+    def benchmark(self, num_texts: int = 256, text_length: int = 200, concurrency: int = 8) -> Dict[str, Any]:
+        """
+        以并发请求测量整体吞吐
+
+        Args:
+            num_texts: 文本总数
+            text_length: 每条文本的字符数
+            concurrency: 并发请求数（模拟多个搜索/任务同时请求）
+        """
+        self._ensure_started()
+        sample = "本地向量引擎吞吐测试 local embedding throughput benchmark. "
+        texts = [(sample * (text_length // len(sample) + 1))[:text_length] + str(i) for i in range(num_texts)]
+        concurrency = max(min(concurrency, num_texts), 1)
+        slices = [texts[i::concurrency] for i in range(concurrency)]
+
+        errors: List[BaseException] = []
+
+        def run(part: List[str]) -> None:
+            try:
+                self.encode(part)
+            except Exception as e:
+                errors.append(e)
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=run, args=(part,)) for part in slices]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        if errors:
+            raise errors[0]
+
+        return {
+            "texts": num_texts,
+            "text_length": text_length,
+            "concurrency": concurrency,
+            "seconds": round(elapsed, 3),
+            "texts_per_sec": round(num_texts / elapsed, 1) if elapsed > 0 else 0.0,
+            **{k: v for k, v in self.stats().items() if k in ("model_key", "workers", "avg_batch_size")},
+        }
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+_engine: Optional[LocalEmbeddingEngine] = None
+_engine_lock = threading.Lock()
+
+
+def get_local_engine() -> Optional[LocalEmbeddingEngine]:
+    """本地向量引擎单例；未启用 USE_LOCAL_EMBEDDING 或未安装 sentence-transformers 时返回 None"""
+    global _engine
+    if not USE_LOCAL_EMBEDDING or not SENTENCE_TRANSFORMERS_AVAILABLE:
+        return None
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = LocalEmbeddingEngine()
+    return _engine
@@ -0,0 +1,216 @@
+"""
+OpenAI / Turing 客户端注册表
+进程内按 (用途, API Key, Base URL) 懒加载并复用 OpenAI 客户端，所有用途共享同一个 httpx 连接池，
+避免每次构造服务（每次搜索、问答、Celery 任务、DocumentProcessor）都重新建立 TLS 连接；
+各用途使用独立的超时配置，并记录请求数、错误数与延迟
+"""
+import os
+import time
+import threading
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+import httpx
+
+# 导入 OpenAI 客户端
+try:
+    from openai import OpenAI
+    OPENAI_AVAILABLE = True
+except ImportError:
+    OpenAI = None
+    OPENAI_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+# 连接池配置（所有用途共享）
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "50"))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "20"))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "60"))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "5"))
+
+# 各用途的请求超时（秒）：向量请求短而频繁，图片理解和报告生成耗时较长
+PURPOSE_TIMEOUTS = {
+    "embedding": float(os.getenv("OPENAI_EMBEDDING_TIMEOUT", "30")),
+    "chat": float(os.getenv("OPENAI_CHAT_TIMEOUT", "60")),
+    "classification": float(os.getenv("OPENAI_CLASSIFICATION_TIMEOUT", "30")),
+    "vision": float(os.getenv("OPENAI_VISION_TIMEOUT", "120")),
+}
+
+# 各用途的 SDK 内置重试次数（未配置的用途使用 SDK 默认值 2）；
+# embedding 的重试在 SDK 之外执行，让限流与熔断看到每一次 429/失败：
+# 批量请求由 EmbeddingBatcher 按子批次重试，单条交互请求由 embedding_guard.call_interactive 重试
+PURPOSE_MAX_RETRIES = {
+    "embedding": int(os.getenv("OPENAI_EMBEDDING_MAX_RETRIES", "0")),
+}
+
+
+class _PurposeMetrics:
+    """单个用途的请求统计"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.status_codes: Dict[str, int] = {}
+
+    def record(self, status: Optional[int], elapsed_ms: float) -> None:
+        with self._lock:
+            self.requests += 1
+            self.total_ms += elapsed_ms
+            self.max_ms = max(self.max_ms, elapsed_ms)
+            key = str(status) if status is not None else "exception"
+            self.status_codes[key] = self.status_codes.get(key, 0) + 1
+            if status is None or status >= 400:
+                self.errors += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "errors": self.errors,
+                "avg_ms": round(self.total_ms / self.requests, 1) if self.requests else 0.0,
+                "max_ms": round(self.max_ms, 1),
+                "status_codes": dict(self.status_codes),
+            }
+
+
+class _InstrumentedTransport(httpx.BaseTransport):
+    """在共享连接池之上记录每个用途的请求耗时（到收到响应头为止）与结果"""
+
+    def __init__(self, transport: httpx.BaseTransport, metrics: _PurposeMetrics):
+        self._transport = transport
+        self._metrics = metrics
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        started = time.perf_counter()
+        try:
+            response = self._transport.handle_request(request)
+        except Exception:
+            self._metrics.record(None, (time.perf_counter() - started) * 1000)
+            raise
+        self._metrics.record(response.status_code, (time.perf_counter() - started) * 1000)
+        return response
+
+    def close(self) -> None:
+        # 共享连接池由注册表统一关闭
+        pass
+
+
+class OpenAIClientRegistry:
+    """进程级 OpenAI 客户端注册表（线程安全；fork 后的子进程自动重建，不共享父进程的连接）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._transport: Optional[httpx.HTTPTransport] = None
+        self._clients: Dict[Tuple[str, str, Optional[str]], Any] = {}
+        self._metrics: Dict[str, _PurposeMetrics] = {}
+
+    def _reset_after_fork(self) -> None:
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._transport = None
+            self._clients = {}
+            self._metrics = {}
+
+    def _get_transport(self) -> httpx.HTTPTransport:
+        if self._transport is None:
+            self._transport = httpx.HTTPTransport(limits=httpx.Limits(
+                max_connections=OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+            ))
+        return self._transport
+
+    def get(self, purpose: str, api_key: Optional[str], base_url: Optional[str] = None):
+        """
+        获取（必要时创建）指定用途的客户端
+
+        Args:
+            purpose: 用途（embedding / chat / classification / vision），决定超时与统计分组
+            api_key: API Key
+            base_url: API Base（Turing 平台或兼容接口），None 表示 OpenAI 官方
+
+        Returns:
+            OpenAI 客户端；openai 库不可用或缺少 API Key 时返回 None
+        """
+        if not OPENAI_AVAILABLE or not api_key:
+            return None
+
+        key = (purpose, api_key, base_url)
+        with self._lock:
+            self._reset_after_fork()
+            client = self._clients.get(key)
+            if client is not None:
+                return client
+
+            metrics = self._metrics.setdefault(purpose, _PurposeMetrics())
+            timeout = httpx.Timeout(PURPOSE_TIMEOUTS.get(purpose, 60.0), connect=OPENAI_CONNECT_TIMEOUT)
+            http_client = httpx.Client(
+                transport=_InstrumentedTransport(self._get_transport(), metrics),
+                timeout=timeout,
+                follow_redirects=True,
+            )
+            client = OpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                timeout=timeout,
+                max_retries=PURPOSE_MAX_RETRIES.get(purpose, 2),
+                http_client=http_client,
+            )
+            self._clients[key] = client
+            logger.info(f"OpenAI client created for {purpose} (base: {base_url or 'default'})")
+            return client
+
+    def _pool_stats(self) -> Dict[str, Any]:
+        pool = getattr(self._transport, "_pool", None)
+        if pool is None:
+            return {"connections": 0, "idle_connections": 0}
+        try:
+            connections = list(pool.connections)
+            return {
+                "connections": len(connections),
+                "idle_connections": sum(1 for c in connections if c.is_idle()),
+            }
+        except Exception:
+            return {}
+
+    def stats(self) -> Dict[str, Any]:
+        """客户端数量、连接池状态与各用途请求统计"""
+        with self._lock:
+            self._reset_after_fork()
+            return {
+                "clients": len(self._clients),
+                "pool": {
+                    "max_connections": OPENAI_MAX_CONNECTIONS,
+                    "max_keepalive_connections": OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+                    "keepalive_expiry": OPENAI_KEEPALIVE_EXPIRY,
+                    **self._pool_stats(),
+                },
+                "timeouts": PURPOSE_TIMEOUTS,
+                "max_retries": PURPOSE_MAX_RETRIES,
+                "purposes": {purpose: m.snapshot() for purpose, m in self._metrics.items()},
+            }
+
+    def close(self) -> None:
+        """关闭所有客户端与连接池"""
+        with self._lock:
+            for client in self._clients.values():
+                try:
+                    client.close()
+                except Exception:
+                    pass
+            if self._transport is not None:
+                self._transport.close()
+            self._transport = None
+            self._clients = {}
+
+
+openai_clients = OpenAIClientRegistry()
+
+
+def get_openai_client(purpose: str, api_key: Optional[str], base_url: Optional[str] = None):
+    """获取共享的 OpenAI 客户端，见 OpenAIClientRegistry.get"""
+    return openai_clients.get(purpose, api_key, base_url)
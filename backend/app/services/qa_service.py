@@ -11,13 +11,7 @@ from app.models import QAHistory, Content, Chunk
 from app.services.search_service import SearchService
 import logging
 
-# 导入新版本 OpenAI 客户端
-try:
-    from openai import OpenAI
-    OPENAI_AVAILABLE = True
-except ImportError:
-    OpenAI = None
-    OPENAI_AVAILABLE = False
+from app.services.openai_clients import get_openai_client, OPENAI_AVAILABLE
 
 logger = logging.getLogger(__name__)
 
@@ -46,13 +40,10 @@ class QAService:
             return
         
         try:
-            # 创建 Turing API 客户端
-            self.openai_client = OpenAI(
-                api_key=self.turing_api_key,
-                base_url=self.turing_api_base
-            )
+            # 复用进程内共享的 Turing API 客户端
+            self.openai_client = get_openai_client("chat", self.turing_api_key, self.turing_api_base)
             self.openai_enabled = True
-            logger.info(f"Turing API client initialized successfully with model: {self.qa_model}")
+            logger.debug(f"Turing API client initialized successfully with model: {self.qa_model}")
         except Exception as e:
             logger.error(f"Failed to initialize Turing API client: {e}")
             self.openai_enabled = False
@@ -0,0 +1,122 @@
+"""
+查询向量缓存
+按 (模型, 规范化查询文本) 缓存查询向量：进程内 LRU 为第一级，Redis 为跨进程共享的第二级，
+重复或热门查询无需再请求 embedding API
+"""
+import os
+import re
+import hashlib
+import threading
+import unicodedata
+import logging
+from array import array
+from typing import Any, Dict, List, Optional
+
+from app.services.lru_cache import LRUCache
+from app.services.redis_client import get_redis, mark_redis_failed
+
+logger = logging.getLogger(__name__)
+
+QUERY_EMBEDDING_CACHE_ENABLED = os.getenv("QUERY_EMBEDDING_CACHE_ENABLED", "true").lower() == "true"
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "2048"))
+QUERY_EMBEDDING_CACHE_TTL = float(os.getenv("QUERY_EMBEDDING_CACHE_TTL", "3600"))
+QUERY_EMBEDDING_CACHE_REDIS_TTL = int(os.getenv("QUERY_EMBEDDING_CACHE_REDIS_TTL", str(7 * 24 * 3600)))
+
+REDIS_KEY_PREFIX = "pkb:qemb:"
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_query(text: str) -> str:
+    """规范化查询文本：全角/半角统一（NFKC）并折叠空白；不改变大小写，避免影响向量语义"""
+    return _WHITESPACE_RE.sub(" ", unicodedata.normalize("NFKC", text)).strip()
+
+
+def _cache_key(model: str, text: str) -> str:
+    return hashlib.sha1(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+
+class QueryEmbeddingCache:
+    """两级查询向量缓存（进程内 LRU + Redis）"""
+
+    def __init__(self, maxsize: int = QUERY_EMBEDDING_CACHE_SIZE, ttl: float = QUERY_EMBEDDING_CACHE_TTL,
+                 redis_ttl: int = QUERY_EMBEDDING_CACHE_REDIS_TTL):
+        self.local = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.redis_ttl = redis_ttl
+        self._lock = threading.Lock()
+        self.redis_hits = 0
+        self.redis_errors = 0
+        self.computed = 0
+
+    def get(self, model: str, text: str) -> Optional[List[float]]:
+        """查找缓存，依次查询进程内 LRU 和 Redis"""
+        key = _cache_key(model, text)
+        embedding = self.local.get(key)
+        if embedding is not None:
+            return embedding
+
+        client = get_redis()
+        if client is None:
+            return None
+        try:
+            payload = client.get(REDIS_KEY_PREFIX + key)
+        except Exception as e:
+            self._record_redis_error(e)
+            return None
+        if payload is None:
+            return None
+
+        # Redis 中以 float32 二进制存储，回填进程内缓存
+        embedding = array("f", payload).tolist()
+        self.local.set(key, embedding)
+        with self._lock:
+            self.redis_hits += 1
+        return embedding
+
+    def set(self, model: str, text: str, embedding: List[float]) -> None:
+        """写入两级缓存"""
+        key = _cache_key(model, text)
+        self.local.set(key, embedding)
+        with self._lock:
+            self.computed += 1
+
+        client = get_redis()
+        if client is None:
+            return
+        try:
+            client.set(REDIS_KEY_PREFIX + key, array("f", embedding).tobytes(), ex=self.redis_ttl)
+        except Exception as e:
+            self._record_redis_error(e)
+
+    def _record_redis_error(self, error: Exception) -> None:
+        with self._lock:
+            self.redis_errors += 1
+        logger.warning(f"Query embedding cache Redis error: {error}")
+        mark_redis_failed()
+
+    def clear(self) -> None:
+        """清空进程内缓存（Redis 中的条目按 TTL 过期）"""
+        self.local.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """缓存命中统计"""
+        local = self.local.stats()
+        with self._lock:
+            lookups = local["hits"] + local["misses"]
+            total_hits = local["hits"] + self.redis_hits
+            return {
+                "enabled": QUERY_EMBEDDING_CACHE_ENABLED,
+                "lookups": lookups,
+                "local": local,
+                "redis": {
+                    "available": get_redis() is not None,
+                    "hits": self.redis_hits,
+                    "errors": self.redis_errors,
+                    "ttl": self.redis_ttl,
+                },
+                "misses": self.computed,
+                "hit_rate": round(total_hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+query_embedding_cache = QueryEmbeddingCache()
@@ -7,6 +7,7 @@ import logging
 from typing import Dict, Any, Optional
 from sqlalchemy.orm import Session
 from app.models import Category, Content, ContentCategory
+from app.services.search_cache import bump_corpus_version
 
 logger = logging.getLogger(__name__)
 
@@ -103,6 +104,7 @@ class QuickClassificationService:
             
             self.db.add(content_category)
             self.db.commit()
+            bump_corpus_version()
             
             logger.info(f"Quick classified content {content_id} as {category.name}")
             
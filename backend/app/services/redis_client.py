@@ -0,0 +1,65 @@
+"""
+共享 Redis 连接
+与 Celery broker 使用同一个 REDIS_URL；Redis 不可用时返回 None，调用方降级为纯进程内逻辑，
+连接失败后在 REDIS_RETRY_INTERVAL 秒内不再重试，避免每次请求都等待连接超时
+"""
+import os
+import time
+import threading
+import logging
+from typing import Optional
+
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    redis = None
+    REDIS_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", "0.2"))
+REDIS_RETRY_INTERVAL = float(os.getenv("REDIS_RETRY_INTERVAL", "30"))
+
+_client = None
+_failed_at = 0.0
+_lock = threading.Lock()
+
+
+def get_redis() -> Optional["redis.Redis"]:
+    """获取共享 Redis 客户端（内部连接池线程安全），不可用时返回 None"""
+    global _client, _failed_at
+
+    if not REDIS_AVAILABLE:
+        return None
+    if _client is not None:
+        return _client
+    if _failed_at and time.time() - _failed_at < REDIS_RETRY_INTERVAL:
+        return None
+
+    with _lock:
+        if _client is not None:
+            return _client
+        try:
+            client = redis.Redis.from_url(
+                REDIS_URL,
+                socket_timeout=REDIS_SOCKET_TIMEOUT,
+                socket_connect_timeout=REDIS_SOCKET_TIMEOUT,
+            )
+            client.ping()
+            _client = client
+            _failed_at = 0.0
+            logger.info("Shared Redis client connected")
+        except Exception as e:
+            _failed_at = time.time()
+            logger.warning(f"Redis unavailable, falling back to in-process caches: {e}")
+    return _client
+
+
+def mark_redis_failed() -> None:
+    """调用方遇到 Redis 错误时调用，暂停使用 Redis 一段时间"""
+    global _client, _failed_at
+    with _lock:
+        _client = None
+        _failed_at = time.time()
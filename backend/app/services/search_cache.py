@@ -0,0 +1,75 @@
+"""
+搜索结果缓存
+缓存键包含语料版本号：入库、生成向量、分类、删除等写操作提交后递增版本号（存放于 Redis，跨进程共享），
+旧版本的缓存条目自然失效，不会返回过期结果；Redis 不可用时无法感知其他进程的写入，直接跳过缓存
+"""
+import os
+import copy
+import json
+import logging
+from typing import Any, Dict, Optional
+
+from app.services.lru_cache import LRUCache
+from app.services.redis_client import get_redis, mark_redis_failed
+
+logger = logging.getLogger(__name__)
+
+SEARCH_CACHE_ENABLED = os.getenv("SEARCH_CACHE_ENABLED", "true").lower() == "true"
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "512"))
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "300"))
+
+CORPUS_VERSION_KEY = "pkb:corpus_version"
+
+
+def get_corpus_version() -> Optional[int]:
+    """当前语料版本号，Redis 不可用时返回 None"""
+    client = get_redis()
+    if client is None:
+        return None
+    try:
+        return int(client.get(CORPUS_VERSION_KEY) or 0)
+    except Exception as e:
+        logger.warning(f"Failed to read corpus version: {e}")
+        mark_redis_failed()
+        return None
+
+
+def bump_corpus_version() -> None:
+    """语料发生变化（写操作提交后调用），使所有进程中的搜索结果缓存失效"""
+    search_result_cache.clear()
+    client = get_redis()
+    if client is None:
+        return
+    try:
+        client.incr(CORPUS_VERSION_KEY)
+    except Exception as e:
+        logger.warning(f"Failed to bump corpus version: {e}")
+        mark_redis_failed()
+
+
+class SearchResultCache:
+    """按 (语料版本, 查询参数) 缓存 SearchService.search 的返回结果"""
+
+    def __init__(self, maxsize: int = SEARCH_CACHE_SIZE, ttl: float = SEARCH_CACHE_TTL):
+        self.cache = LRUCache(maxsize=maxsize, ttl=ttl)
+
+    @staticmethod
+    def make_key(version: int, **params: Any) -> str:
+        return f"{version}:" + json.dumps(params, sort_keys=True, ensure_ascii=False, default=str)
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """读取缓存，返回副本避免调用方修改缓存内容"""
+        response = self.cache.get(key)
+        return copy.deepcopy(response) if response is not None else None
+
+    def set(self, key: str, response: Dict[str, Any]) -> None:
+        self.cache.set(key, copy.deepcopy(response))
+
+    def clear(self) -> None:
+        self.cache.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"enabled": SEARCH_CACHE_ENABLED, "corpus_version": get_corpus_version(), **self.cache.stats()}
+
+
+search_result_cache = SearchResultCache()
@@ -0,0 +1,161 @@
+"""
+混合搜索离线评估
+回放问答历史（QAHistory.question 作为查询，sources 中的文档作为相关文档，feedback 过滤无效样本），
+对比不同融合策略与候选深度下的检索质量，用于在不损失质量的前提下降低候选深度
+"""
+import math
+import time
+import logging
+from typing import Any, Dict, List, Optional, Set
+
+from sqlalchemy.orm import Session
+
+from app.models import QAHistory
+from app.services.search_fusion import FUSION_STRATEGIES, fuse
+from app.services.search_service import SearchService
+
+logger = logging.getLogger(__name__)
+
+
+def _relevant_content_ids(sources: Any) -> Set[str]:
+    """从 QAHistory.sources 中提取相关文档ID（兼容字典列表和ID列表两种格式）"""
+    ids = set()
+    for source in sources or []:
+        if isinstance(source, dict):
+            content_id = source.get("content_id")
+        else:
+            content_id = source
+        if content_id:
+            ids.add(str(content_id))
+    return ids
+
+
+def _metrics(ranked_ids: List[str], relevant: Set[str], top_k: int) -> Dict[str, float]:
+    """计算单个查询的 recall@k / hit@k / MRR / nDCG@k"""
+    ranked_ids = ranked_ids[:top_k]
+    hits = [1 if cid in relevant else 0 for cid in ranked_ids]
+
+    reciprocal_rank = 0.0
+    for rank, hit in enumerate(hits, start=1):
+        if hit:
+            reciprocal_rank = 1.0 / rank
+            break
+
+    dcg = sum(hit / math.log2(rank + 1) for rank, hit in enumerate(hits, start=1))
+    ideal = sum(1 / math.log2(rank + 1) for rank in range(1, min(len(relevant), top_k) + 1))
+
+    return {
+        "recall": sum(hits) / len(relevant),
+        "hit_rate": 1.0 if any(hits) else 0.0,
+        "mrr": reciprocal_rank,
+        "ndcg": dcg / ideal if ideal else 0.0,
+    }
+
+
+class SearchEvaluationService:
+    """基于问答历史的融合策略 / 候选深度评估"""
+
+    def __init__(self, db: Session):
+        self.db = db
+        self.search_service = SearchService(db)
+
+    def load_samples(self, limit: int = 200, include_unrated: bool = True) -> List[Dict[str, Any]]:
+        """
+        加载评估样本
+
+        Args:
+            limit: 最多使用的问答记录数（按时间倒序）
+            include_unrated: 是否包含未评价的记录；feedback 为 bad 的记录始终排除
+
+        Returns:
+            [{"question", "relevant"}]
+        """
+        query = self.db.query(QAHistory).filter(QAHistory.sources.isnot(None))
+        if include_unrated:
+            query = query.filter((QAHistory.feedback.is_(None)) | (QAHistory.feedback != "bad"))
+        else:
+            query = query.filter(QAHistory.feedback == "good")
+
+        samples = []
+        for record in query.order_by(QAHistory.created_at.desc()).limit(limit).all():
+            relevant = _relevant_content_ids(record.sources)
+            if relevant:
+                samples.append({"question": record.question, "relevant": relevant})
+        return samples
+
+    def evaluate(
+        self,
+        strategies: Optional[List[str]] = None,
+        depths: Optional[List[int]] = None,
+        top_k: int = 5,
+        limit: int = 200,
+        include_unrated: bool = True,
+    ) -> Dict[str, Any]:
+        """
+        评估各融合策略在不同候选深度下的检索质量
+
+        每个样本只按最大深度各执行一次关键词 / 语义检索，较小深度取其前缀，
+        因此评估成本与策略、深度的组合数量无关
+
+        Args:
+            strategies: 待评估的融合策略，默认全部
+            depths: 待评估的每路候选深度，默认 [top_k, 2*top_k, 4*top_k]
+            top_k: 评估的最终结果数量（与问答服务一致默认为 5）
+            limit: 最多回放的问答记录数
+            include_unrated: 是否包含未评价的记录
+
+        Returns:
+            评估报告
+        """
+        strategies = strategies or list(FUSION_STRATEGIES)
+        unknown = [s for s in strategies if s not in FUSION_STRATEGIES]
+        if unknown:
+            raise ValueError(f"Unknown fusion strategy: {', '.join(unknown)}")
+        depths = sorted(set(depths or [top_k, top_k * 2, top_k * 4]))
+        max_depth = depths[-1]
+
+        samples = self.load_samples(limit=limit, include_unrated=include_unrated)
+        if not samples:
+            return {"success": False, "error": "No QA history with sources available for evaluation"}
+
+        totals: Dict[str, Dict[int, Dict[str, float]]] = {
+            strategy: {depth: {"recall": 0.0, "hit_rate": 0.0, "mrr": 0.0, "ndcg": 0.0} for depth in depths}
+            for strategy in strategies
+        }
+        leg_timings: Dict[str, float] = {}
+
+        for sample in samples:
+            timings: Dict[str, float] = {}
+            keyword_results, semantic_results = self.search_service.collect_hybrid_candidates(
+                sample["question"], max_depth, None, timings
+            )
+            for key, value in timings.items():
+                leg_timings[key] = leg_timings.get(key, 0.0) + value
+
+            for depth in depths:
+                for strategy in strategies:
+                    fused = fuse(keyword_results[:depth], semantic_results[:depth], top_k, strategy=strategy)
+                    scores = _metrics([r["content_id"] for r in fused], sample["relevant"], top_k)
+                    for metric, value in scores.items():
+                        totals[strategy][depth][metric] += value
+
+        count = len(samples)
+        results = [
+            {
+                "strategy": strategy,
+                "candidate_depth": depth,
+                **{metric: round(value / count, 4) for metric, value in totals[strategy][depth].items()},
+            }
+            for strategy in strategies
+            for depth in depths
+        ]
+
+        return {
+            "success": True,
+            "samples": count,
+            "top_k": top_k,
+            "depths": depths,
+            "results": results,
+            "avg_leg_timings_ms": {key: round(value / count, 2) for key, value in leg_timings.items()},
+            "evaluated_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
@@ -0,0 +1,145 @@
+"""
+混合搜索结果融合策略
+将关键词、语义两路（已按文档去重、按得分排序）的结果融合为一个排序列表，
+融合后的 score 统一落在 [0, 1] 区间，供问答服务沿用原有的相关度阈值
+"""
+import os
+from typing import Callable, Dict, List, Optional
+
+# 默认融合策略，保持与历史行为一致
+DEFAULT_FUSION = os.getenv("SEARCH_FUSION", "weighted")
+
+# RRF 平滑常数，越大排名靠后的结果衰减越慢
+RRF_K = int(os.getenv("SEARCH_RRF_K", "60"))
+
+# 各路权重（weighted / weighted_rrf / linear 使用）
+DEFAULT_WEIGHTS = {"keyword": 0.6, "semantic": 0.4}
+
+
+def _merge_by_content(
+    legs: Dict[str, List[Dict]],
+    leg_score: Callable[[str, int, Dict], float],
+) -> List[Dict]:
+    """
+    按 content_id 合并各路结果并累加各路贡献分
+
+    Args:
+        legs: {路名: 结果列表}，结果列表按排名顺序
+        leg_score: (路名, 排名(从1开始), 结果) -> 该路贡献分
+
+    Returns:
+        合并后的结果（不修改输入），每个文档保留原始得分最高的 chunk
+    """
+    merged: Dict[str, Dict] = {}
+    best_original: Dict[str, float] = {}
+
+    for leg, results in legs.items():
+        for rank, result in enumerate(results, start=1):
+            content_id = result["content_id"]
+            contribution = leg_score(leg, rank, result)
+
+            if content_id not in merged:
+                merged[content_id] = {**result, "score": contribution}
+                best_original[content_id] = result["score"]
+                continue
+
+            entry = merged[content_id]
+            fused_score = entry["score"] + contribution
+            if result["score"] > best_original[content_id]:
+                # 该路 chunk 原始得分更高，使用该路的 chunk 内容
+                entry = {**result}
+                best_original[content_id] = result["score"]
+            entry["score"] = fused_score
+            entry["match_type"] = "hybrid"
+            merged[content_id] = entry
+
+    return list(merged.values())
+
+
+def weighted_fusion(legs: Dict[str, List[Dict]], weights: Optional[Dict[str, float]] = None) -> List[Dict]:
+    """按固定权重直接加权原始得分（历史默认行为：关键词 0.6 / 语义 0.4）"""
+    weights = weights or DEFAULT_WEIGHTS
+    return _merge_by_content(legs, lambda leg, rank, result: result["score"] * weights.get(leg, 0.0))
+
+
+def weighted_rrf_fusion(
+    legs: Dict[str, List[Dict]],
+    weights: Optional[Dict[str, float]] = None,
+    k: int = RRF_K,
+) -> List[Dict]:
+    """
+    加权 Reciprocal Rank Fusion：score = Σ w_leg / (k + rank)
+
+    只依赖排名，不受两路得分尺度不一致的影响；
+    结果按理论最大值（各路均排名第一）归一化到 [0, 1]
+    """
+    weights = weights or DEFAULT_WEIGHTS
+    max_score = sum(weights.get(leg, 0.0) for leg in legs) / (k + 1) or 1.0
+    return _merge_by_content(
+        legs, lambda leg, rank, result: weights.get(leg, 0.0) / (k + rank) / max_score
+    )
+
+
+def rrf_fusion(legs: Dict[str, List[Dict]], weights: Optional[Dict[str, float]] = None, k: int = RRF_K) -> List[Dict]:
+    """Reciprocal Rank Fusion（各路等权）"""
+    return weighted_rrf_fusion(legs, {leg: 1.0 for leg in legs}, k)
+
+
+def linear_fusion(legs: Dict[str, List[Dict]], weights: Optional[Dict[str, float]] = None) -> List[Dict]:
+    """
+    分数归一化线性融合：各路得分先按本次结果做 min-max 归一化，再按权重加权
+
+    权重按参与融合的路数重新归一化，保证融合得分不超过 1
+    """
+    weights = weights or DEFAULT_WEIGHTS
+    total_weight = sum(weights.get(leg, 0.0) for leg in legs) or 1.0
+
+    bounds = {}
+    for leg, results in legs.items():
+        scores = [r["score"] for r in results]
+        bounds[leg] = (min(scores), max(scores)) if scores else (0.0, 0.0)
+
+    def leg_score(leg: str, rank: int, result: Dict) -> float:
+        low, high = bounds[leg]
+        normalized = (result["score"] - low) / (high - low) if high > low else 1.0
+        return normalized * weights.get(leg, 0.0) / total_weight
+
+    return _merge_by_content(legs, leg_score)
+
+
+FUSION_STRATEGIES: Dict[str, Callable[..., List[Dict]]] = {
+    "weighted": weighted_fusion,
+    "rrf": rrf_fusion,
+    "weighted_rrf": weighted_rrf_fusion,
+    "linear": linear_fusion,
+}
+
+
+def fuse(
+    keyword_results: List[Dict],
+    semantic_results: List[Dict],
+    top_k: int,
+    strategy: Optional[str] = None,
+    weights: Optional[Dict[str, float]] = None,
+) -> List[Dict]:
+    """
+    融合关键词与语义搜索结果
+
+    Args:
+        keyword_results: 关键词搜索结果（按得分降序）
+        semantic_results: 语义搜索结果（按得分降序）
+        top_k: 返回结果数量
+        strategy: 融合策略，见 FUSION_STRATEGIES，缺省使用 SEARCH_FUSION
+        weights: 各路权重 {"keyword": .., "semantic": ..}
+
+    Returns:
+        融合后的结果列表
+    """
+    strategy = strategy or DEFAULT_FUSION
+    if strategy not in FUSION_STRATEGIES:
+        raise ValueError(f"Unknown fusion strategy: {strategy}. Available: {', '.join(FUSION_STRATEGIES)}")
+
+    legs = {"keyword": keyword_results, "semantic": semantic_results}
+    fused = FUSION_STRATEGIES[strategy](legs, weights)
+    fused.sort(key=lambda x: x["score"], reverse=True)
+    return fused[:top_k]
@@ -2,29 +2,60 @@
 增强搜索服务
 支持关键词搜索、语义搜索和混合搜索
 """
+import os
 import re
 import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Optional, Tuple
 from sqlalchemy.orm import Session
-from sqlalchemy import or_, and_, func, desc
+from sqlalchemy import or_, and_, func, desc, Float
+from sqlalchemy.dialects.postgresql import UUID as PG_UUID, ARRAY
 from sqlalchemy.sql import text
+from app.db import SessionLocal
 from app.models import Content, Chunk, QAHistory, Category, ContentCategory, Collection
 from app.services.embedding_service import EmbeddingService
+from app.services.embedding_guard import embedding_guard
+from app.services.vector_query import VectorQuery
+from app.services.embedding_stats_service import EmbeddingStatsService
+from app.services.keyword_index import KeywordIndex
+from app.services.search_fusion import fuse
+from app.services.search_cache import (
+    search_result_cache, get_corpus_version, SEARCH_CACHE_ENABLED
+)
 import logging
 
 logger = logging.getLogger(__name__)
 
+# 混合搜索关键词一路使用的线程池（独立的数据库会话/连接）；向量一路在调用线程中执行。
+# 搜索与问答接口是同步接口，在 FastAPI 线程池（默认 40 个线程）中执行，每个混合搜索最多占用本池一个线程，
+# 默认与之一致；数据库连接池按每个并发搜索 2 个连接配置（见 app.db）
+HYBRID_SEARCH_WORKERS = int(os.getenv("HYBRID_SEARCH_WORKERS", "40"))
+_hybrid_executor = ThreadPoolExecutor(max_workers=HYBRID_SEARCH_WORKERS, thread_name_prefix="hybrid-search")
+
+
+# 文件类型与查询意图不符时，允许跨类型匹配的最低相似度
+CROSS_MODALITY_SIMILARITY = 0.4
+
+
+def _record_timing(timings: Optional[Dict], key: str, started: float) -> None:
+    """记录某一路检索耗时（毫秒）"""
+    if timings is not None:
+        timings[key] = round((time.time() - started) * 1000, 2)
+
+
 class SearchService:
-    def __init__(self, db: Session):
+    def __init__(self, db: Session, embedding_service: Optional[EmbeddingService] = None):
         self.db = db
-        self.embedding_service = EmbeddingService()
+        self.embedding_service = embedding_service or EmbeddingService()
     
     def search(
         self, 
         query: str, 
         top_k: int = 10, 
         search_type: str = "hybrid",
-        filters: Optional[Dict] = None
+        filters: Optional[Dict] = None,
+        fusion: Optional[str] = None,
+        candidate_depth: Optional[int] = None
     ) -> Dict:
         """
         统一搜索接口
@@ -34,33 +65,76 @@ class SearchService:
             top_k: 返回结果数量
             search_type: 搜索类型 ("keyword", "semantic", "hybrid")
             filters: 过滤条件 {"modality": "text", "created_by": "memo.api"}
+                     可包含 ANN 参数 {"ef_search": 80, "probes": 10}
+                     可包含 {"supporting_chunks": N}，每个文档额外返回 N 个命中 chunk 的ID
+            fusion: 混合搜索融合策略 ("weighted", "rrf", "weighted_rrf", "linear")，缺省使用 SEARCH_FUSION
+            candidate_depth: 混合搜索每一路的候选数量，缺省为 top_k
         
         Returns:
             搜索结果字典
         """
         start_time = time.time()
+        timings: Dict[str, float] = {}
+        
+        # 结果缓存：键包含语料版本号，写操作提交后旧条目自动失效
+        cache_key = None
+        version = get_corpus_version() if SEARCH_CACHE_ENABLED else None
+        if version is not None:
+            cache_key = search_result_cache.make_key(
+                version, query=query, top_k=top_k, search_type=search_type,
+                filters=filters, fusion=fusion, candidate_depth=candidate_depth
+            )
+            cached = search_result_cache.get(cache_key)
+            if cached is not None:
+                cached["response_time"] = time.time() - start_time
+                cached["timings"] = {"total_ms": round(cached["response_time"] * 1000, 2)}
+                cached["cached"] = True
+                self._update_search_stats(query, cached["total"])
+                return cached
+        
+        # 向量服务熔断时语义一路只能使用已缓存的查询向量，搜索退化为关键词检索
+        degraded = (
+            search_type != "keyword"
+            and self.embedding_service.is_enabled()
+            and embedding_guard.is_open()
+        )
         
         try:
             if search_type == "keyword":
+                keyword_start = time.time()
                 results = self._keyword_search(query, top_k, filters)
+                _record_timing(timings, "keyword_ms", keyword_start)
             elif search_type == "semantic":
-                results = self._semantic_search(query, top_k, filters)
+                results = self._semantic_search(query, top_k, filters, timings)
+                if not results and degraded:
+                    keyword_start = time.time()
+                    results = self._keyword_search(query, top_k, filters)
+                    _record_timing(timings, "keyword_ms", keyword_start)
             else:  # hybrid
-                results = self._hybrid_search(query, top_k, filters)
+                results = self._hybrid_search(query, top_k, filters, timings, fusion, candidate_depth)
             
             response_time = time.time() - start_time
+            _record_timing(timings, "total_ms", start_time)
             
             # 更新搜索统计
             self._update_search_stats(query, len(results))
             
-            return {
+            response = {
                 "query": query,
                 "results": results,
                 "total": len(results),
                 "response_time": response_time,
                 "search_type": search_type,
-                "embedding_enabled": self.embedding_service.is_enabled()
+                "embedding_enabled": self.embedding_service.is_enabled(),
+                "timings": timings,
+                "cached": False
             }
+            if degraded:
+                response["degraded"] = "keyword_only"
+            # 退化结果不缓存，熔断恢复后立即恢复完整的混合检索
+            elif cache_key:
+                search_result_cache.set(cache_key, response)
+            return response
             
         except Exception as e:
             logger.error(f"Search error: {e}")
@@ -71,30 +145,88 @@ class SearchService:
                 "response_time": time.time() - start_time,
                 "search_type": search_type,
                 "embedding_enabled": self.embedding_service.is_enabled(),
+                "timings": timings,
                 "error": str(e)
             }
             logger.error(f"Search error response: {error_response}")
             return error_response
     
     def _keyword_search(self, query: str, top_k: int, filters: Optional[Dict] = None) -> List[Dict]:
-        """关键词搜索"""
+        """关键词搜索：优先使用倒排索引，索引不可用时回退到 LIKE 匹配"""
+        query = query.strip()
+        if not query:
+            return []
+        
         try:
-            # 构建基础查询，包含分类信息
-            base_query = self.db.query(
-                Chunk, Content, Category.name.label('category_name'), 
-                Category.color.label('category_color'),
-                ContentCategory.confidence.label('category_confidence')
-            ).select_from(Chunk).join(
-                Content, Chunk.content_id == Content.id
-            ).outerjoin(
-                ContentCategory, Content.id == ContentCategory.content_id
-            ).outerjoin(
-                Category, ContentCategory.category_id == Category.id
-            )
-            
-            # 应用过滤条件
-            if filters:
-                base_query = self._apply_filters(base_query, filters)
+            indexed = self._indexed_keyword_search(query, top_k, filters)
+            if indexed is not None:
+                return indexed
+        except Exception as e:
+            logger.warning(f"Indexed keyword search failed, falling back to LIKE: {e}")
+            self.db.rollback()
+        
+        return self._like_keyword_search(query, top_k, filters)
+    
+    def _build_keyword_base_query(self, filters: Optional[Dict] = None):
+        """构建关键词搜索的基础查询，包含分类信息"""
+        base_query = self.db.query(
+            Chunk, Content, Category.name.label('category_name'), 
+            Category.color.label('category_color'),
+            ContentCategory.confidence.label('category_confidence')
+        ).select_from(Chunk).join(
+            Content, Chunk.content_id == Content.id
+        ).outerjoin(
+            ContentCategory, Content.id == ContentCategory.content_id
+        ).outerjoin(
+            Category, ContentCategory.category_id == Category.id
+        )
+        
+        # 应用过滤条件
+        if filters:
+            base_query = self._apply_filters(base_query, filters)
+        return base_query
+    
+    def _indexed_keyword_search(self, query: str, top_k: int, filters: Optional[Dict] = None) -> Optional[List[Dict]]:
+        """
+        基于 tsvector 倒排索引的关键词搜索
+        
+        精确匹配、全部词匹配、任意词匹配三个层级在一次索引查询中完成并按层级+ts_rank排序；
+        命中先在 SQL 中按文档分组（每个文档一个最佳 chunk），只为保留下来的 chunk 读取正文。
+        查询无法生成词项时返回 None
+        """
+        keyword_index = KeywordIndex(self.db)
+        params = keyword_index.build_params(query, self._extract_search_terms(query))
+        if params is None:
+            return None
+        supporting_chunks = int((filters or {}).get("supporting_chunks") or 0)
+        
+        hits = text(keyword_index.document_hits_sql()).bindparams(
+            kw_supporting=supporting_chunks, **params
+        ).columns(
+            chunk_id=PG_UUID(as_uuid=True), score=Float, supporting_chunk_ids=ARRAY(PG_UUID(as_uuid=True))
+        ).subquery("keyword_hits")
+        
+        # 分类为外连接，多分类文档仍可能产生多行，多取一些后在格式化时去重
+        rows = self._build_keyword_base_query(filters).add_columns(
+            hits.c.score, hits.c.supporting_chunk_ids
+        ).join(
+            hits, hits.c.chunk_id == Chunk.id
+        ).order_by(desc(hits.c.score)).limit(top_k * 2).all()
+        
+        scores = {str(row[0].id): float(row[-2]) for row in rows}
+        results = [tuple(row[:-2]) for row in rows]
+        formatted = self._format_search_results(results, query, "keyword", scores)[:top_k]
+        
+        if supporting_chunks:
+            supporting = {str(row[0].id): [str(cid) for cid in row[-1] or []] for row in rows}
+            for result in formatted:
+                result["supporting_chunk_ids"] = supporting.get(result["chunk_id"], [])
+        return formatted
+    
+    def _like_keyword_search(self, query: str, top_k: int, filters: Optional[Dict] = None) -> List[Dict]:
+        """关键词搜索（LIKE 匹配，倒排索引不可用时的回退路径）"""
+        try:
+            base_query = self._build_keyword_base_query(filters)
             
             # 对查询进行预处理
             query = query.strip()
@@ -171,115 +303,98 @@ class SearchService:
             logger.error(f"Keyword search error: {e}")
             return []
     
-    def _semantic_search(self, query: str, top_k: int, filters: Optional[Dict] = None) -> List[Dict]:
-        """语义搜索 - 使用原生 SQL 避免 SQLAlchemy 向量方法"""
+    def _semantic_search(self, query: str, top_k: int, filters: Optional[Dict] = None,
+                         timings: Optional[Dict] = None) -> List[Dict]:
+        """语义搜索 - 获取查询向量后执行向量检索"""
         if not self.embedding_service.is_enabled():
             logger.warning("Semantic search requested but embedding service not available")
             return []
         
         try:
             # 获取查询向量
-            query_embedding = self.embedding_service.get_embedding(query)
+            embedding_start = time.time()
+            query_embedding = self.embedding_service.get_query_embedding(query)
+            _record_timing(timings, "embedding_ms", embedding_start)
             if not query_embedding:
                 logger.warning("Failed to get query embedding")
                 return []
-            
-            # 使用 SQLAlchemy 的原生 SQL 执行，但避免 ORM 方法
-            from sqlalchemy import text
-            
-            # 将向量转换为字符串格式
-            embedding_str = '[' + ','.join(map(str, query_embedding)) + ']'
-            
-            # 检查有多少 chunks 有向量
-            count_sql = text("SELECT COUNT(*) FROM chunks WHERE embedding IS NOT NULL")
-            chunk_count = self.db.execute(count_sql).scalar()
-            
-            if chunk_count == 0:
+        except Exception as e:
+            logger.error(f"Query embedding error: {e}")
+            return []
+        
+        return self._vector_search(query, query_embedding, top_k, filters, timings)
+    
+    def _vector_search(self, query: str, query_embedding: List[float], top_k: int,
+                       filters: Optional[Dict] = None, timings: Optional[Dict] = None) -> List[Dict]:
+        """向量检索 - 使用参数化的预编译向量查询"""
+        vector_start = time.time()
+        try:
+            # 检查是否存在已生成向量的 chunks（增量维护的计数器，O(1)）
+            if not EmbeddingStatsService(self.db).has_embeddings():
                 logger.warning("No chunks with embeddings found")
                 return []
             
-            # 构建语义搜索 SQL
-            base_sql = f"""
-                SELECT 
-                    chunks.id as chunk_id,
-                    chunks.text,
-                    chunks.chunk_type,
-                    contents.id as content_id,
-                    contents.title,
-                    contents.source_uri,
-                    contents.modality,
-                    contents.category,
-                    contents.tags,
-                    contents.created_at,
-                    categories.name as category_name,
-                    categories.color as category_color,
-                    content_categories.confidence as category_confidence,
-                    (chunks.embedding <=> '{embedding_str}'::vector) as distance
-                FROM chunks 
-                JOIN contents ON chunks.content_id = contents.id
-                LEFT JOIN content_categories ON contents.id = content_categories.content_id
-                LEFT JOIN categories ON content_categories.category_id = categories.id
-                WHERE chunks.embedding IS NOT NULL
-            """
-            
-            # 添加过滤条件
-            where_conditions = []
-            params = {}
-            
-            if filters:
-                if filters.get('modality'):
-                    where_conditions.append("contents.modality = %(modality)s")
-                    params['modality'] = filters['modality']
-                if filters.get('category'):
-                    # 支持按分类ID或分类名称筛选
-                    category_value = filters['category']
-                    if isinstance(category_value, str) and len(category_value) == 36:  # UUID格式
-                        where_conditions.append("categories.id = %(category)s")
-                    else:
-                        where_conditions.append("categories.name = %(category)s")
-                    params['category'] = category_value
-                if filters.get('created_by'):
-                    where_conditions.append("contents.created_by = %(created_by)s")
-                    params['created_by'] = filters['created_by']
-            
-            if where_conditions:
-                base_sql += " AND " + " AND ".join(where_conditions)
-            
-            # 添加相似度阈值过滤（距离小于0.8，即相似度大于0.2）
-            base_sql += f"""
-                AND (chunks.embedding <=> '{embedding_str}'::vector) < 0.8
-                ORDER BY chunks.embedding <=> '{embedding_str}'::vector
-                LIMIT {top_k * 2}
-            """
-            
-            sql = text(base_sql)
-            
-            # 执行查询
-            if params:
-                results = self.db.execute(sql, params).fetchall()
-            else:
-                results = self.db.execute(sql).fetchall()
+            # 查询意图（动态相似度阈值、期望文件类型）与过滤条件一起编译进向量查询，
+            # 过滤较严格时迭代加深，尽量返回 top_k 个不同文档
+            similarity_threshold = max(self._get_dynamic_similarity_threshold(query), 0.2)
+            results, plan = VectorQuery(self.db).search_documents(
+                query_embedding,
+                top_k=top_k,
+                filters=filters,
+                max_distance=1 - similarity_threshold,
+                expected_modality=self._infer_expected_modality(query) or None,
+                cross_modality_distance=1 - CROSS_MODALITY_SIMILARITY
+            )
+            if timings is not None:
+                timings["vector_rounds"] = len(plan["rounds"])
             
-            # 使用格式化方法应用去重逻辑
-            return self._format_semantic_results(results, query)
+            return self._format_semantic_results(
+                results, query, supporting_chunks=int((filters or {}).get("supporting_chunks") or 0)
+            )
             
         except Exception as e:
             logger.error(f"Semantic search error: {e}")
+            # 回滚失败的事务，避免影响同一会话中的后续查询
+            self.db.rollback()
             return []
+        finally:
+            _record_timing(timings, "vector_ms", vector_start)
     
-    def _hybrid_search(self, query: str, top_k: int, filters: Optional[Dict] = None) -> List[Dict]:
-        """混合搜索：结合关键词和语义搜索"""
+    def _run_leg(self, method: str, *args):
+        """在独立的数据库会话中执行一路检索（供线程池调用）"""
+        db = SessionLocal()
         try:
-            # 获取两种搜索结果
-            keyword_results = self._keyword_search(query, top_k, filters)
-            
-            if self.embedding_service.is_enabled():
-                semantic_results = self._semantic_search(query, top_k, filters)
-            else:
-                semantic_results = []
+            leg = SearchService(db, embedding_service=self.embedding_service)
+            return getattr(leg, method)(*args)
+        finally:
+            db.close()
+    
+    def _keyword_leg(self, query: str, top_k: int, filters: Optional[Dict], timings: Dict) -> List[Dict]:
+        """关键词检索一路（独立会话），记录耗时"""
+        keyword_start = time.time()
+        try:
+            return self._run_leg("_keyword_search", query, top_k, filters)
+        finally:
+            _record_timing(timings, "keyword_ms", keyword_start)
+    
+    def _hybrid_search(self, query: str, top_k: int, filters: Optional[Dict] = None,
+                       timings: Optional[Dict] = None, fusion: Optional[str] = None,
+                       candidate_depth: Optional[int] = None) -> List[Dict]:
+        """
+        混合搜索：结合关键词和语义搜索
+        
+        关键词检索（线程池，独立连接）与查询向量请求（调用线程）并发执行，向量到达后在调用线程中继续向量检索；
+        总耗时约为 max(关键词, 向量化 + 向量检索)
+        """
+        timings = timings if timings is not None else {}
+        depth = candidate_depth or top_k
+        try:
+            keyword_results, semantic_results = self.collect_hybrid_candidates(query, depth, filters, timings)
             
             # 结果去重和融合
-            merged_results = self._merge_search_results(keyword_results, semantic_results, top_k)
+            fusion_start = time.time()
+            merged_results = self._merge_search_results(keyword_results, semantic_results, top_k, fusion)
+            _record_timing(timings, "fusion_ms", fusion_start)
             
             return merged_results
             
@@ -287,6 +402,19 @@ class SearchService:
             logger.error(f"Hybrid search error: {e}")
             return []
     
+    def collect_hybrid_candidates(self, query: str, depth: int, filters: Optional[Dict],
+                                   timings: Dict) -> Tuple[List[Dict], List[Dict]]:
+        """并发获取关键词、语义两路候选结果（关键词一路提交到线程池，语义一路在当前线程执行）"""
+        if not self.embedding_service.is_enabled():
+            return self._keyword_leg(query, depth, filters, timings), []
+        
+        keyword_future = _hybrid_executor.submit(self._keyword_leg, query, depth, filters, timings)
+        try:
+            semantic_results = self._semantic_search(query, depth, filters, timings)
+        finally:
+            keyword_results = keyword_future.result()
+        return keyword_results, semantic_results
+    
     def _extract_search_terms(self, query: str) -> List[str]:
         """
         提取搜索词，支持中文搜索优化
@@ -367,8 +495,9 @@ class SearchService:
         
         return filtered_results
     
-    def _format_search_results(self, results: List[Tuple], query: str, match_type: str) -> List[Dict]:
-        """格式化搜索结果"""
+    def _format_search_results(self, results: List[Tuple], query: str, match_type: str,
+                               scores: Optional[Dict[str, float]] = None) -> List[Dict]:
+        """格式化搜索结果（scores 为倒排索引给出的 chunk_id -> 得分，缺省时按文本匹配估算）"""
         formatted_results = []
         seen_content_ids = {}  # 用于去重，存储 content_id -> 最佳结果
         q_lower = query.lower()
@@ -382,7 +511,9 @@ class SearchService:
                 category_name = category_color = category_confidence = None
             
             # 计算相关性分数
-            score = self._calculate_relevance_score(chunk.text, content.title, q_lower)
+            score = scores.get(str(chunk.id)) if scores else None
+            if score is None:
+                score = self._calculate_relevance_score(chunk.text, content.title, q_lower)
             
             current_result = {
                 "score": score,
@@ -414,28 +545,16 @@ class SearchService:
         formatted_results.sort(key=lambda x: x["score"], reverse=True)
         return formatted_results
     
-    def _format_semantic_results(self, results: List[Tuple], query: str) -> List[Dict]:
-        """格式化语义搜索结果"""
+    def _format_semantic_results(self, results: List[Tuple], query: str, supporting_chunks: int = 0) -> List[Dict]:
+        """格式化语义搜索结果（相似度阈值、文件类型意图和文档去重已在向量查询中完成）"""
         formatted_results = []
         seen_content_ids = {}  # 用于去重，存储 content_id -> 最佳结果
         
-        # 智能确定相似度阈值和文件类型过滤
-        similarity_threshold = self._get_dynamic_similarity_threshold(query)
-        expected_modality = self._infer_expected_modality(query)
-        
         for row in results:
             # 处理原生 SQL 查询结果
             distance = float(row.distance)
             similarity = 1 - distance  # 转换为相似度分数
             
-            # 动态相似度过滤
-            if similarity < similarity_threshold:
-                continue
-            
-            # 文件类型智能过滤
-            if not self._is_modality_match(query, row.modality, expected_modality, similarity):
-                continue
-            
             current_result = {
                 "score": similarity,
                 "text": row.text,
@@ -454,6 +573,8 @@ class SearchService:
                 "chunk_type": row.chunk_type,
                 "distance": distance
             }
+            if row.supporting_chunk_ids is not None and supporting_chunks:
+                current_result["supporting_chunk_ids"] = [str(cid) for cid in row.supporting_chunk_ids]
             
             # 去重逻辑：同一文档只保留得分最高的chunk
             content_id = str(row.content_id)
@@ -467,39 +588,10 @@ class SearchService:
         formatted_results.sort(key=lambda x: x["score"], reverse=True)
         return formatted_results
     
-    def _merge_search_results(self, keyword_results: List[Dict], semantic_results: List[Dict], top_k: int) -> List[Dict]:
-        """合并关键词和语义搜索结果（基于文档级别去重）"""
-        merged = {}
-        
-        # 添加关键词结果（权重 0.6）
-        for result in keyword_results:
-            content_id = result["content_id"]
-            result["score"] *= 0.6
-            merged[content_id] = result
-        
-        # 添加语义结果（权重 0.4）
-        for result in semantic_results:
-            content_id = result["content_id"]
-            if content_id in merged:
-                # 合并分数，保留更好的chunk信息
-                new_score = merged[content_id]["score"] + result["score"] * 0.4
-                if result["score"] * 0.4 > merged[content_id]["score"]:
-                    # 如果语义搜索的chunk得分更高，使用语义搜索的chunk内容
-                    result["score"] = new_score
-                    result["match_type"] = "hybrid"
-                    merged[content_id] = result
-                else:
-                    # 否则只更新分数和匹配类型
-                    merged[content_id]["score"] = new_score
-                    merged[content_id]["match_type"] = "hybrid"
-            else:
-                result["score"] *= 0.4
-                merged[content_id] = result
-        
-        # 排序并返回
-        final_results = list(merged.values())
-        final_results.sort(key=lambda x: x["score"], reverse=True)
-        return final_results[:top_k]
+    def _merge_search_results(self, keyword_results: List[Dict], semantic_results: List[Dict], top_k: int,
+                              fusion: Optional[str] = None) -> List[Dict]:
+        """合并关键词和语义搜索结果（基于文档级别去重，融合策略见 search_fusion）"""
+        return fuse(keyword_results, semantic_results, top_k, strategy=fusion)
     
     def _calculate_relevance_score(self, text: str, title: str, query: str) -> float:
         """计算相关性分数"""
@@ -719,23 +811,3 @@ class SearchService:
         
         # 返回空表示不限制文件类型
         return ''
-    
-    def _is_modality_match(self, query: str, file_modality: str, expected_modality: str, similarity: float) -> bool:
-        """检查文件类型是否匹配查询意图"""
-        # 如果没有明确的文件类型期望，允许所有类型
-        if not expected_modality:
-            return True
-        
-        # 如果期望的类型与实际类型匹配
-        if expected_modality == file_modality:
-            return True
-        
-        # 如果相似度非常高（>0.4），允许跨类型匹配
-        if similarity > 0.4:
-            return True
-        
-        # 特殊情况：图片查询但文件是文本，需要更高的相似度
-        if expected_modality == 'image' and file_modality in ['text', 'pdf']:
-            return similarity > 0.45  # 需要非常高的相似度才允许
-        
-        return False
@@ -0,0 +1,135 @@
+"""
+向量相似度计算
+float32 归一化后用矩阵乘法一次计算多对余弦相似度，按块计算以限制内存，
+top-k 使用 argpartition 选取，供去重、聚类与合集匹配等 N×M 比较场景使用
+"""
+import os
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# 每块的相似度矩阵元素上限（默认 4M 个 float32，约 16MB）
+SIMILARITY_BLOCK_ELEMENTS = int(os.getenv("SIMILARITY_BLOCK_ELEMENTS", str(4 * 1024 * 1024)))
+
+
+def to_matrix(vectors: Sequence[Optional[Sequence[float]]]) -> np.ndarray:
+    """
+    向量列表转为 float32 矩阵
+
+    Args:
+        vectors: 向量列表，None 的条目填充为零向量（与任何向量的相似度为 0）
+    """
+    dimension = next((len(v) for v in vectors if v is not None), 0)
+    matrix = np.zeros((len(vectors), dimension), dtype=np.float32)
+    for i, vector in enumerate(vectors):
+        if vector is not None:
+            matrix[i] = vector
+    return matrix
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """按行 L2 归一化（零向量保持为零）"""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def cosine_similarity(vector1: Sequence[float], vector2: Sequence[float]) -> float:
+    """两个向量的余弦相似度"""
+    vec1 = np.asarray(vector1, dtype=np.float32)
+    vec2 = np.asarray(vector2, dtype=np.float32)
+    norm1 = np.linalg.norm(vec1)
+    norm2 = np.linalg.norm(vec2)
+    if norm1 == 0 or norm2 == 0:
+        return 0.0
+    return float(np.dot(vec1, vec2) / (norm1 * norm2))
+
+
+def _row_block(rows: int, columns: int) -> int:
+    return max(1, min(rows, SIMILARITY_BLOCK_ELEMENTS // max(columns, 1)))
+
+
+def cosine_matrix(queries: np.ndarray, candidates: np.ndarray) -> np.ndarray:
+    """
+    完整的余弦相似度矩阵 (len(queries) × len(candidates))
+
+    结果本身需要 N×M 内存，大规模比较请使用 top_k_similar
+    """
+    queries = normalize_rows(queries)
+    candidates = normalize_rows(candidates)
+    result = np.empty((len(queries), len(candidates)), dtype=np.float32)
+    block = _row_block(len(queries), len(candidates))
+    for start in range(0, len(queries), block):
+        result[start:start + block] = queries[start:start + block] @ candidates.T
+    return result
+
+
+def top_k_similar(
+    queries: np.ndarray,
+    candidates: np.ndarray,
+    k: int = 10,
+    min_score: Optional[float] = None,
+    exclude_self: bool = False,
+) -> List[List[Tuple[int, float]]]:
+    """
+    每个查询向量在候选向量中的 top-k 相似项
+
+    查询与候选都按块计算，任一时刻只持有一个块的相似度矩阵和每个查询当前的 k 个最佳结果
+
+    Args:
+        queries: 查询矩阵 (N × D)
+        candidates: 候选矩阵 (M × D)
+        k: 每个查询返回的结果数
+        min_score: 最低相似度，低于该值的结果丢弃
+        exclude_self: 查询与候选为同一组向量时排除自身（第 i 个查询不匹配第 i 个候选）
+
+    Returns:
+        每个查询的 [(候选下标, 相似度)] 列表，按相似度降序
+    """
+    queries = normalize_rows(queries)
+    candidates = normalize_rows(candidates)
+    n, m = len(queries), len(candidates)
+    k = min(k, m)
+    if n == 0 or k <= 0:
+        return [[] for _ in range(n)]
+
+    # 单块矩阵 (query_block × candidate_block) 不超过 SIMILARITY_BLOCK_ELEMENTS
+    query_block = min(n, 256)
+    candidate_block = _row_block(m, query_block)
+
+    results: List[List[Tuple[int, float]]] = []
+    for q_start in range(0, n, query_block):
+        q = queries[q_start:q_start + query_block]
+        best_scores = np.full((len(q), 0), -np.inf, dtype=np.float32)
+        best_indices = np.empty((len(q), 0), dtype=np.int64)
+
+        for c_start in range(0, m, candidate_block):
+            scores = q @ candidates[c_start:c_start + candidate_block].T
+            if exclude_self:
+                rows = np.arange(len(q))
+                columns = rows + q_start - c_start
+                mask = (columns >= 0) & (columns < scores.shape[1])
+                scores[rows[mask], columns[mask]] = -np.inf
+
+            indices = np.broadcast_to(np.arange(c_start, c_start + scores.shape[1]), scores.shape)
+            merged_scores = np.concatenate([best_scores, scores], axis=1)
+            merged_indices = np.concatenate([best_indices, indices], axis=1)
+            if merged_scores.shape[1] > k:
+                keep = np.argpartition(-merged_scores, k - 1, axis=1)[:, :k]
+                merged_scores = np.take_along_axis(merged_scores, keep, axis=1)
+                merged_indices = np.take_along_axis(merged_indices, keep, axis=1)
+            best_scores, best_indices = merged_scores, merged_indices
+
+        order = np.argsort(-best_scores, axis=1)
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        best_indices = np.take_along_axis(best_indices, order, axis=1)
+        for row_scores, row_indices in zip(best_scores, best_indices):
+            matches = []
+            for index, score in zip(row_indices, row_scores):
+                if score == -np.inf or (min_score is not None and score < min_score):
+                    continue
+                matches.append((int(index), float(score)))
+            results.append(matches)
+
+    return results
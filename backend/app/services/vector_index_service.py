@@ -0,0 +1,640 @@
+"""
+向量索引管理服务
+管理 chunks.embedding 上的 pgvector ANN 索引（HNSW / IVFFlat），
+支持索引创建与重建、按查询调整 ef_search / probes，以及与精确搜索对比的召回率/延迟报告。
+索引可以建在截断维度和/或量化（halfvec / 二值）后的向量表达式上以缩小索引、加快检索，
+chunks.embedding 始终保存完整精度向量，候选再按完整向量精确重排
+"""
+import os
+import re
+import time
+import math
+import logging
+import threading
+from typing import Dict, List, Optional, Any, Tuple
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from app.db import engine
+from app.services.embedding_stats_service import EmbeddingStatsService
+
+logger = logging.getLogger(__name__)
+
+# 统一的索引名称，重建时先构建临时索引再原子替换
+INDEX_NAME = "idx_chunks_embedding_ann"
+BUILD_INDEX_NAME = f"{INDEX_NAME}_build"
+
+# 与 SearchService 中的 <=> 运算符（余弦距离）对应
+VECTOR_OPCLASS = "vector_cosine_ops"
+
+# 索引存储方式：ANN 索引的运算符类、候选检索使用的距离运算符，以及 pgvector 可索引的最大维度
+STORAGE_MODES = {
+    "full": {"opclass": VECTOR_OPCLASS, "operator": "<=>", "max_dimension": 2000},
+    "halfvec": {"opclass": "halfvec_cosine_ops", "operator": "<=>", "max_dimension": 4000},
+    "binary": {"opclass": "bit_hamming_ops", "operator": "<~>", "max_dimension": 64000},
+}
+
+# 向量列维度与现有索引定义缓存（模型迁移切换、其他进程重建索引后在 TTL 内更新）
+DIMENSION_CACHE_TTL = 60
+
+# 从 pg_get_indexdef 解析索引的运算符类与截断维度
+INDEX_OPCLASS_RE = re.compile(r"\b(\w+_ops)\b")
+INDEX_SUBVECTOR_RE = re.compile(r"subvector\(\s*embedding\s*,\s*1\s*,\s*(\d+)\s*\)")
+
+# 索引构建互斥用的 advisory lock 键
+INDEX_LOCK_KEY = 7310001
+
+
+def vector_expression(value_sql: str, plan: Dict[str, Any]) -> str:
+    """
+    ANN 索引与候选检索共用的向量表达式
+
+    索引表达式与查询中的表达式必须一致（含类型修饰的维度），规划器才会使用表达式索引
+    """
+    dimension = plan["dimension"]
+    if plan["truncated"]:
+        value_sql = f"subvector({value_sql}, 1, {dimension})"
+    if plan["storage"] == "halfvec":
+        return f"({value_sql})::halfvec({dimension})"
+    if plan["storage"] == "binary":
+        return f"binary_quantize({value_sql})::bit({dimension})"
+    if plan["truncated"]:
+        return f"({value_sql})::vector({dimension})"
+    return value_sql
+
+
+class VectorIndexService:
+    """chunks.embedding 的 ANN 索引生命周期管理"""
+
+    _dimension_cache: Dict[str, Any] = {}
+    _dimension_lock = threading.Lock()
+    _index_cache: Dict[str, Any] = {}
+
+    SUPPORTED_METHODS = {
+        "hnsw": {
+            "build_params": ["m", "ef_construction"],
+            "search_param": "hnsw.ef_search",
+        },
+        "ivfflat": {
+            "build_params": ["lists"],
+            "search_param": "ivfflat.probes",
+        },
+    }
+
+    def __init__(self, db: Session):
+        self.db = db
+
+    # ------------------------------------------------------------------
+    # 配置
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def get_config() -> Dict[str, Any]:
+        """读取索引相关环境变量配置"""
+        method = os.getenv("VECTOR_INDEX_METHOD", "hnsw").lower()
+        if method not in VectorIndexService.SUPPORTED_METHODS and method != "none":
+            logger.warning(f"Unknown VECTOR_INDEX_METHOD '{method}', falling back to hnsw")
+            method = "hnsw"
+
+        storage = os.getenv("VECTOR_INDEX_STORAGE", "full").lower()
+        if storage not in STORAGE_MODES:
+            logger.warning(f"Unknown VECTOR_INDEX_STORAGE '{storage}', falling back to full")
+            storage = "full"
+
+        lists = os.getenv("VECTOR_INDEX_LISTS")
+        dimensions = os.getenv("VECTOR_INDEX_DIMENSIONS")
+        return {
+            "method": method,
+            "m": int(os.getenv("VECTOR_INDEX_M", "16")),
+            "ef_construction": int(os.getenv("VECTOR_INDEX_EF_CONSTRUCTION", "64")),
+            "lists": int(lists) if lists else None,  # None 表示根据数据量自动计算
+            "ef_search": int(os.getenv("VECTOR_EF_SEARCH", "40")),
+            "probes": int(os.getenv("VECTOR_IVFFLAT_PROBES", "10")),
+            "maintenance_work_mem": os.getenv("VECTOR_INDEX_MAINTENANCE_WORK_MEM"),
+            "storage": storage,
+            "dimensions": int(dimensions) if dimensions else None,  # None 表示不截断
+            "rerank_factor": max(int(os.getenv("VECTOR_RERANK_FACTOR", "4")), 1),
+        }
+
+    def get_column_dimension(self) -> Optional[int]:
+        """chunks.embedding 列声明的维度（进程内缓存）"""
+        now = time.time()
+        with self._dimension_lock:
+            if self._dimension_cache and self._dimension_cache["expires_at"] > now:
+                return self._dimension_cache["dimension"]
+
+        typmod = self.db.execute(text("""
+            SELECT atttypmod FROM pg_attribute
+            WHERE attrelid = 'chunks'::regclass AND attname = 'embedding'
+        """)).scalar()
+        dimension = typmod if typmod and typmod > 0 else None
+
+        with self._dimension_lock:
+            self._dimension_cache.update({"dimension": dimension, "expires_at": now + DIMENSION_CACHE_TTL})
+        return dimension
+
+    @classmethod
+    def clear_cache(cls) -> None:
+        """索引重建、删除或向量列切换后清除进程内缓存"""
+        with cls._dimension_lock:
+            cls._dimension_cache.clear()
+            cls._index_cache.clear()
+
+    @staticmethod
+    def _make_plan(storage: str, dimension: Optional[int], truncated: bool, rerank_factor: int) -> Dict[str, Any]:
+        return {
+            "storage": storage,
+            "dimension": dimension,
+            "truncated": truncated,
+            # 索引向量与完整向量不同时，候选需要按完整向量精确重排
+            "compressed": storage != "full" or truncated,
+            "opclass": STORAGE_MODES[storage]["opclass"],
+            "operator": STORAGE_MODES[storage]["operator"],
+            "rerank_factor": rerank_factor,
+            "max_dimension": STORAGE_MODES[storage]["max_dimension"],
+        }
+
+    def get_index_plan(self, column_dimension: Optional[int] = None) -> Dict[str, Any]:
+        """
+        当前配置下 ANN 索引的向量表达式方案（构建索引时使用；查询使用 get_active_plan）
+
+        Args:
+            column_dimension: 完整向量维度，默认读取 chunks.embedding 列定义
+
+        Returns:
+            {"storage", "dimension", "truncated", "compressed", "opclass", "operator", "rerank_factor", "max_dimension"}
+        """
+        config = self.get_config()
+        column_dimension = column_dimension or self.get_column_dimension()
+        truncated = bool(
+            config["dimensions"] and (column_dimension is None or config["dimensions"] < column_dimension)
+        )
+        dimension = config["dimensions"] if truncated else column_dimension
+        return self._make_plan(config["storage"], dimension, truncated, config["rerank_factor"])
+
+    def get_index_definition(self) -> Optional[str]:
+        """现有有效 ANN 索引的定义（pg_get_indexdef，进程内缓存），没有索引时返回 None"""
+        now = time.time()
+        with self._dimension_lock:
+            if self._index_cache and self._index_cache["expires_at"] > now:
+                return self._index_cache["definition"]
+
+        definition = self.db.execute(text("""
+            SELECT pg_get_indexdef(i.oid)
+            FROM pg_class i
+            JOIN pg_index ix ON ix.indexrelid = i.oid
+            WHERE i.relname = :name AND ix.indisvalid
+        """), {"name": INDEX_NAME}).scalar()
+
+        with self._dimension_lock:
+            self._index_cache.update({"definition": definition, "expires_at": now + DIMENSION_CACHE_TTL})
+        return definition
+
+    def _plan_from_definition(self, definition: str) -> Optional[Dict[str, Any]]:
+        """按索引定义还原向量表达式方案，无法识别时返回 None"""
+        opclasses = INDEX_OPCLASS_RE.findall(definition)
+        storage = next(
+            (mode for mode, spec in STORAGE_MODES.items() if opclasses and spec["opclass"] == opclasses[-1]), None
+        )
+        if storage is None:
+            return None
+        subvector = INDEX_SUBVECTOR_RE.search(definition)
+        dimension = int(subvector.group(1)) if subvector else self.get_column_dimension()
+        return self._make_plan(storage, dimension, bool(subvector), self.get_config()["rerank_factor"])
+
+    def get_active_plan(self) -> Dict[str, Any]:
+        """
+        查询使用的向量表达式方案：与现有 ANN 索引一致
+
+        查询表达式必须与索引表达式一致才能走索引；VECTOR_INDEX_STORAGE / VECTOR_INDEX_DIMENSIONS
+        改变后、新索引替换旧索引之前，查询继续按旧索引的方案执行。没有索引时按完整向量精确检索
+        """
+        definition = self.get_index_definition()
+        plan = self._plan_from_definition(definition) if definition else None
+        if plan is None:
+            if definition:
+                logger.warning(f"Unrecognized vector index definition, searching without it: {definition}")
+            plan = self._make_plan("full", self.get_column_dimension(), False, self.get_config()["rerank_factor"])
+        return plan
+
+    @staticmethod
+    def _same_plan(a: Dict[str, Any], b: Dict[str, Any]) -> bool:
+        return all(a[key] == b[key] for key in ("storage", "dimension", "truncated"))
+
+    # ------------------------------------------------------------------
+    # 索引状态
+    # ------------------------------------------------------------------
+
+    def get_index_status(self) -> Dict[str, Any]:
+        """获取 chunks.embedding 上现有 ANN 索引的状态"""
+        rows = self.db.execute(text("""
+            SELECT
+                i.relname AS index_name,
+                am.amname AS method,
+                ix.indisvalid AS is_valid,
+                pg_relation_size(i.oid) AS size_bytes,
+                pg_get_indexdef(i.oid) AS definition,
+                i.reloptions AS options
+            FROM pg_index ix
+            JOIN pg_class i ON i.oid = ix.indexrelid
+            JOIN pg_class t ON t.oid = ix.indrelid
+            JOIN pg_am am ON am.oid = i.relam
+            WHERE t.relname = 'chunks'
+              AND am.amname IN ('hnsw', 'ivfflat')
+            ORDER BY i.relname
+        """)).fetchall()
+
+        indexes = [
+            {
+                "name": row.index_name,
+                "method": row.method,
+                "valid": bool(row.is_valid),
+                "size_mb": round((row.size_bytes or 0) / 1024 / 1024, 2),
+                "options": list(row.options or []),
+                "definition": row.definition,
+            }
+            for row in rows
+        ]
+
+        embedded_chunks = EmbeddingStatsService(self.db).get_embedded_count()
+
+        return {
+            "index_name": INDEX_NAME,
+            "exists": any(idx["name"] == INDEX_NAME and idx["valid"] for idx in indexes),
+            "indexes": indexes,
+            "embedded_chunks": embedded_chunks,
+            "config": self.get_config(),
+            "plan": self.get_index_plan(),
+            "active_plan": self.get_active_plan(),
+        }
+
+    def _get_active_method(self) -> Optional[str]:
+        """返回当前生效索引的类型（hnsw / ivfflat），没有索引时返回 None"""
+        row = self.db.execute(text("""
+            SELECT am.amname
+            FROM pg_class i
+            JOIN pg_index ix ON ix.indexrelid = i.oid
+            JOIN pg_am am ON am.oid = i.relam
+            WHERE i.relname = :name AND ix.indisvalid
+        """), {"name": INDEX_NAME}).first()
+        return row[0] if row else None
+
+    # ------------------------------------------------------------------
+    # 索引构建
+    # ------------------------------------------------------------------
+
+    def _suggest_lists(self, row_count: int) -> int:
+        """IVFFlat lists 推荐值：100 万行以内 rows/1000，以上 sqrt(rows)"""
+        if row_count <= 1_000_000:
+            return max(1, row_count // 1000)
+        return max(1, int(math.sqrt(row_count)))
+
+    def _build_index_sql(self, name: str, method: str, params: Dict[str, Any], concurrently: bool,
+                         column: str = "embedding", column_dimension: Optional[int] = None) -> str:
+        """生成 CREATE INDEX 语句（按 VECTOR_INDEX_STORAGE / VECTOR_INDEX_DIMENSIONS 建在压缩后的表达式上）"""
+        plan = self.get_index_plan(column_dimension)
+        if plan["compressed"] and not plan["dimension"]:
+            raise ValueError(f"{column} has no declared dimension; set VECTOR_INDEX_DIMENSIONS")
+        if plan["dimension"] and plan["dimension"] > plan["max_dimension"]:
+            raise ValueError(
+                f"{plan['storage']} index supports at most {plan['max_dimension']} dimensions, got {plan['dimension']}"
+            )
+        indexed = f"({vector_expression(column, plan)})" if plan["compressed"] else column
+
+        if method == "hnsw":
+            with_clause = f"m = {int(params['m'])}, ef_construction = {int(params['ef_construction'])}"
+        else:
+            with_clause = f"lists = {int(params['lists'])}"
+
+        return (
+            f"CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}{name} "
+            f"ON chunks USING {method} ({indexed} {plan['opclass']}) "
+            f"WITH ({with_clause})"
+        )
+
+    def build_index(
+        self,
+        method: Optional[str] = None,
+        m: Optional[int] = None,
+        ef_construction: Optional[int] = None,
+        lists: Optional[int] = None,
+        concurrently: bool = True,
+    ) -> Dict[str, Any]:
+        """
+        构建或重建 ANN 索引
+
+        先以临时名称构建新索引，成功后删除旧索引并重命名，
+        重建期间旧索引仍然可用，搜索不会退化为顺序扫描。
+
+        Args:
+            method: 索引类型 ("hnsw" / "ivfflat")，默认读取 VECTOR_INDEX_METHOD
+            m: HNSW 每层最大连接数
+            ef_construction: HNSW 构建时候选列表大小
+            lists: IVFFlat 聚类中心数量，默认按数据量自动计算
+            concurrently: 是否使用 CONCURRENTLY 构建（不阻塞写入）
+
+        Returns:
+            构建结果
+        """
+        config = self.get_config()
+        method = (method or config["method"]).lower()
+        if method not in self.SUPPORTED_METHODS:
+            return {"success": False, "error": f"Unsupported index method: {method}"}
+
+        embedded_chunks = EmbeddingStatsService(self.db).get_embedded_count()
+
+        params = {
+            "m": m or config["m"],
+            "ef_construction": ef_construction or config["ef_construction"],
+            "lists": lists or config["lists"] or self._suggest_lists(embedded_chunks),
+        }
+
+        if method == "ivfflat" and embedded_chunks == 0:
+            # IVFFlat 的聚类中心来自现有数据，空表上构建的索引召回率很差
+            return {
+                "success": False,
+                "error": "IVFFlat index requires existing embeddings; build it after backfill",
+            }
+
+        plan = self.get_index_plan()
+
+        # 结束当前会话中的事务，避免持有 chunks 上的锁
+        self.db.commit()
+
+        start_time = time.time()
+        try:
+            # CREATE INDEX CONCURRENTLY 不能在事务块内执行，使用独立的自动提交连接
+            with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                # 多个进程同时启动时只允许一个进程构建索引
+                locked = conn.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": INDEX_LOCK_KEY}).scalar()
+                if not locked:
+                    return {"success": False, "error": "Another vector index build is in progress"}
+
+                try:
+                    if config["maintenance_work_mem"]:
+                        conn.execute(
+                            text("SELECT set_config('maintenance_work_mem', :mem, false)"),
+                            {"mem": config["maintenance_work_mem"]}
+                        )
+
+                    # 清理上次失败遗留的临时索引
+                    conn.execute(text(f"DROP INDEX {'CONCURRENTLY ' if concurrently else ''}IF EXISTS {BUILD_INDEX_NAME}"))
+
+                    logger.info(f"Building {method} index on chunks.embedding with params {params}, "
+                                f"storage {plan['storage']} ({plan['dimension']} dims)")
+                    conn.execute(text(self._build_index_sql(BUILD_INDEX_NAME, method, params, concurrently)))
+
+                    # 新索引就绪后替换旧索引
+                    conn.execute(text(f"DROP INDEX {'CONCURRENTLY ' if concurrently else ''}IF EXISTS {INDEX_NAME}"))
+                    conn.execute(text(f"ALTER INDEX {BUILD_INDEX_NAME} RENAME TO {INDEX_NAME}"))
+                finally:
+                    conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": INDEX_LOCK_KEY})
+                    self.clear_cache()
+
+            build_time = time.time() - start_time
+            logger.info(f"Vector index {INDEX_NAME} ({method}) built in {build_time:.1f}s")
+
+            return {
+                "success": True,
+                "index_name": INDEX_NAME,
+                "method": method,
+                "params": {k: params[k] for k in self.SUPPORTED_METHODS[method]["build_params"]},
+                "storage": plan["storage"],
+                "dimension": plan["dimension"],
+                "embedded_chunks": embedded_chunks,
+                "build_time": build_time,
+            }
+
+        except Exception as e:
+            logger.error(f"Error building vector index: {e}")
+            return {"success": False, "error": str(e)}
+
+    def ensure_index(self) -> Dict[str, Any]:
+        """
+        确保 ANN 索引存在且与配置的存储方式/维度一致（应用启动时调用）
+
+        已存在且一致时不做任何操作；不一致时重建（重建期间查询继续使用旧索引及其方案）
+        """
+        config = self.get_config()
+        if config["method"] == "none":
+            return {"success": True, "skipped": True, "reason": "VECTOR_INDEX_METHOD=none"}
+
+        active_method = self._get_active_method()
+        if active_method:
+            active_plan, plan = self.get_active_plan(), self.get_index_plan()
+            if self._same_plan(active_plan, plan):
+                return {"success": True, "skipped": True, "method": active_method}
+            logger.info(
+                f"Vector index {INDEX_NAME} uses {active_plan['storage']} ({active_plan['dimension']} dims), "
+                f"configured {plan['storage']} ({plan['dimension']} dims); rebuilding"
+            )
+            return self.build_index(method=config["method"])
+
+        return self.build_index(method=config["method"])
+
+    def drop_index(self) -> Dict[str, Any]:
+        """删除 ANN 索引"""
+        self.db.commit()
+        try:
+            with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {BUILD_INDEX_NAME}"))
+                conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {INDEX_NAME}"))
+            self.clear_cache()
+            return {"success": True, "index_name": INDEX_NAME}
+        except Exception as e:
+            logger.error(f"Error dropping vector index: {e}")
+            return {"success": False, "error": str(e)}
+
+    # ------------------------------------------------------------------
+    # 查询参数
+    # ------------------------------------------------------------------
+
+    def apply_search_params(self, ef_search: Optional[int] = None, probes: Optional[int] = None) -> Dict[str, int]:
+        """
+        为当前事务设置 ANN 搜索参数（SET LOCAL，仅对当前事务生效）
+
+        Args:
+            ef_search: HNSW 搜索候选列表大小，越大召回越高、延迟越高
+            probes: IVFFlat 搜索的聚类数量
+
+        Returns:
+            实际生效的参数
+        """
+        config = self.get_config()
+        applied = {
+            "ef_search": int(ef_search or config["ef_search"]),
+            "probes": int(probes or config["probes"]),
+        }
+        # SET 不支持绑定参数，这里的值已强制转换为整数
+        self.db.execute(text(f"SET LOCAL hnsw.ef_search = {applied['ef_search']}"))
+        self.db.execute(text(f"SET LOCAL ivfflat.probes = {applied['probes']}"))
+        return applied
+
+    # ------------------------------------------------------------------
+    # 召回率 / 延迟评估
+    # ------------------------------------------------------------------
+
+    def _sample_query_vectors(self, sample_size: int) -> List[str]:
+        """从已有 chunk 中随机抽取向量作为查询样本"""
+        rows = self.db.execute(text("""
+            SELECT embedding::text AS embedding
+            FROM chunks
+            WHERE embedding IS NOT NULL
+            ORDER BY random()
+            LIMIT :limit
+        """), {"limit": sample_size}).fetchall()
+        return [row.embedding for row in rows]
+
+    def _run_knn(self, query_vector: str, top_k: int, exact: bool, ef_search: Optional[int] = None,
+                 probes: Optional[int] = None, rerank_factor: Optional[int] = None,
+                 plan: Optional[Dict[str, Any]] = None) -> Tuple[List[str], float]:
+        """在单独事务中执行一次 KNN 查询，返回 (chunk_id 列表, 耗时毫秒)"""
+        query_sql = "CAST(:query_vector AS vector)"
+        if exact or not plan or not plan["compressed"]:
+            sql = f"""
+                SELECT id
+                FROM chunks
+                WHERE embedding IS NOT NULL
+                ORDER BY embedding <=> {query_sql}
+                LIMIT :top_k
+            """
+        else:
+            # 在压缩索引上取 top_k * rerank_factor 个候选，再按完整向量精确重排
+            sql = f"""
+                SELECT id FROM (
+                    SELECT id, embedding <=> {query_sql} AS distance
+                    FROM chunks
+                    WHERE embedding IS NOT NULL
+                    ORDER BY {vector_expression("embedding", plan)} {plan["operator"]} {vector_expression(query_sql, plan)}
+                    LIMIT :top_k * {int(rerank_factor or plan["rerank_factor"])}
+                ) candidates
+                ORDER BY distance
+                LIMIT :top_k
+            """
+
+        with engine.connect() as conn:
+            with conn.begin():
+                if exact:
+                    # 关闭索引扫描，强制精确搜索作为基准
+                    conn.execute(text("SET LOCAL enable_indexscan = off"))
+                    conn.execute(text("SET LOCAL enable_bitmapscan = off"))
+                else:
+                    if ef_search:
+                        conn.execute(text(f"SET LOCAL hnsw.ef_search = {int(ef_search)}"))
+                    if probes:
+                        conn.execute(text(f"SET LOCAL ivfflat.probes = {int(probes)}"))
+
+                start = time.perf_counter()
+                rows = conn.execute(text(sql), {"query_vector": query_vector, "top_k": top_k}).fetchall()
+                elapsed_ms = (time.perf_counter() - start) * 1000
+
+        return [str(row.id) for row in rows], elapsed_ms
+
+    @staticmethod
+    def _percentile(values: List[float], pct: float) -> float:
+        """计算百分位延迟"""
+        if not values:
+            return 0.0
+        ordered = sorted(values)
+        idx = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+        return round(ordered[idx], 2)
+
+    def evaluate_recall(
+        self,
+        sample_size: int = 20,
+        top_k: int = 10,
+        ef_search_values: Optional[List[int]] = None,
+        probes_values: Optional[List[int]] = None,
+        rerank_factors: Optional[List[int]] = None,
+    ) -> Dict[str, Any]:
+        """
+        对比 ANN 搜索与精确搜索的召回率和延迟
+
+        使用语料中随机抽取的向量作为查询，精确搜索结果作为基准，
+        对每个候选参数计算 recall@k 以及 p50/p95 延迟，用于数据驱动地选择参数。
+
+        Args:
+            sample_size: 查询样本数量
+            top_k: 评估的 k 值
+            ef_search_values: 待评估的 HNSW ef_search 取值
+            probes_values: 待评估的 IVFFlat probes 取值
+            rerank_factors: 压缩索引下待评估的重排候选倍数（候选数 = top_k * 倍数）
+
+        Returns:
+            召回率/延迟报告
+        """
+        method = self._get_active_method()
+        if not method:
+            return {"success": False, "error": "No valid ANN index on chunks.embedding"}
+
+        query_vectors = self._sample_query_vectors(sample_size)
+        if not query_vectors:
+            return {"success": False, "error": "No chunks with embeddings found"}
+
+        # 结束当前会话中的读事务，评估查询在独立连接上执行
+        self.db.commit()
+
+        if method == "hnsw":
+            candidates = [{"ef_search": v} for v in (ef_search_values or [20, 40, 80, 160, 320])]
+        else:
+            candidates = [{"probes": v} for v in (probes_values or [1, 5, 10, 20, 50])]
+
+        plan = self.get_active_plan()
+        if plan["compressed"]:
+            candidates = [
+                {**params, "rerank_factor": factor}
+                for params in candidates
+                for factor in (rerank_factors or [plan["rerank_factor"]])
+            ]
+
+        # 精确搜索基准
+        ground_truth = []
+        exact_latencies = []
+        for vector in query_vectors:
+            ids, elapsed = self._run_knn(vector, top_k, exact=True)
+            ground_truth.append(set(ids))
+            exact_latencies.append(elapsed)
+
+        report = []
+        for params in candidates:
+            recalls = []
+            latencies = []
+            for vector, truth in zip(query_vectors, ground_truth):
+                ids, elapsed = self._run_knn(vector, top_k, exact=False, plan=plan, **params)
+                latencies.append(elapsed)
+                if truth:
+                    recalls.append(len(truth.intersection(ids)) / len(truth))
+
+            report.append({
+                **params,
+                "recall": round(sum(recalls) / len(recalls), 4) if recalls else None,
+                "latency_p50_ms": self._percentile(latencies, 50),
+                "latency_p95_ms": self._percentile(latencies, 95),
+            })
+
+        return {
+            "success": True,
+            "method": method,
+            "plan": plan,
+            "sample_size": len(query_vectors),
+            "top_k": top_k,
+            "exact": {
+                "latency_p50_ms": self._percentile(exact_latencies, 50),
+                "latency_p95_ms": self._percentile(exact_latencies, 95),
+            },
+            "results": report,
+        }
+
+
+def ensure_vector_index() -> None:
+    """应用启动时确保 ANN 索引存在，失败时仅记录日志，不影响启动"""
+    from app.db import SessionLocal
+
+    db = SessionLocal()
+    try:
+        result = VectorIndexService(db).ensure_index()
+        if not result.get("success"):
+            logger.warning(f"Vector index not created: {result.get('error')}")
+    except Exception as e:
+        logger.warning(f"Failed to ensure vector index: {e}")
+    finally:
+        db.close()
@@ -0,0 +1,330 @@
+"""
+向量查询层
+查询向量只绑定一次（作为 vector 类型参数），距离只计算一次，
+并按过滤条件组合复用服务端预编译语句（PREPARE / EXECUTE），减少每次语义搜索的解析/规划开销和传输字节数。
+ANN 索引建在截断/量化向量上时，先按索引表达式取放大后的候选，再按完整精度向量精确重排
+"""
+import os
+import hashlib
+import logging
+from typing import Dict, List, Optional, Any, Tuple
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from app.services.vector_index_service import VectorIndexService, vector_expression
+
+logger = logging.getLogger(__name__)
+
+# 预编译语句在数据库连接上的缓存键（存放于 DBAPI 连接的 info 字典中，随连接池连接存活）
+PREPARED_CACHE_KEY = "pkb_prepared_vector_statements"
+
+# 语义搜索返回的列（分类取置信度最高的一条，避免多分类文档产生重复行）
+SELECT_COLUMNS = """
+    chunks.id AS chunk_id,
+    chunks.text,
+    chunks.chunk_type,
+    contents.id AS content_id,
+    contents.title,
+    contents.source_uri,
+    contents.modality,
+    contents.category,
+    contents.tags,
+    contents.created_at,
+    best_category.name AS category_name,
+    best_category.color AS category_color,
+    best_category.confidence AS category_confidence
+"""
+
+# 过滤条件较严格时逐轮扩大候选集（limit 与 ef_search 按倍数增长），轮数和上限保证单次查询工作量有界
+VECTOR_FILTER_MAX_ROUNDS = int(os.getenv("VECTOR_FILTER_MAX_ROUNDS", "3"))
+VECTOR_FILTER_GROWTH = int(os.getenv("VECTOR_FILTER_GROWTH", "4"))
+VECTOR_FILTER_MAX_CANDIDATES = int(os.getenv("VECTOR_FILTER_MAX_CANDIDATES", "1000"))
+# pgvector 允许的 hnsw.ef_search 上限
+MAX_EF_SEARCH = 1000
+
+
+def to_vector_literal(embedding: List[float]) -> str:
+    """将向量转换为 pgvector 文本格式，9 位有效数字足以无损表示 float32"""
+    return "[" + ",".join("%.9g" % v for v in embedding) + "]"
+
+
+class VectorQuery:
+    """参数化、可复用预编译语句的向量检索"""
+
+    def __init__(self, db: Session):
+        self.db = db
+
+    def _compile_filters(
+        self,
+        filters: Optional[Dict],
+        expected_modality: Optional[str] = None,
+        cross_modality_distance: Optional[float] = None,
+    ) -> Tuple[List[str], List[str], List[Any]]:
+        """
+        将过滤条件编译为 SQL 片段（在向量检索内部生效，而不是取回后再过滤）
+
+        Args:
+            filters: 过滤条件 {"modality", "category", "collection_id", "created_by", "date_from", "date_to"}
+            expected_modality: 查询意图推断出的文件类型，不匹配的文档需要距离小于 cross_modality_distance
+            cross_modality_distance: 跨类型匹配允许的最大距离
+
+        Returns:
+            (where 条件列表, 参数类型列表, 参数值列表)，参数编号从 $5 开始
+        """
+        conditions, param_types, values = [], [], []
+
+        def add(condition: str, *params: Tuple[str, Any]):
+            placeholders = []
+            for param_type, value in params:
+                placeholders.append(f"${5 + len(values)}")  # $1 向量, $2 limit, $3 距离阈值, $4 附带 chunk 数
+                param_types.append(param_type)
+                values.append(value)
+            conditions.append(condition.format(*placeholders))
+
+        filters = filters or {}
+
+        if filters.get("modality"):
+            add("contents.modality = {0}", ("text", filters["modality"]))
+
+        if filters.get("category"):
+            # 支持按分类ID或分类名称筛选
+            category_value = filters["category"]
+            if isinstance(category_value, str) and len(category_value) == 36:  # UUID格式
+                add("""EXISTS (SELECT 1 FROM content_categories cc
+                        WHERE cc.content_id = contents.id AND cc.category_id = {0})""", ("uuid", category_value))
+            else:
+                add("""EXISTS (SELECT 1 FROM content_categories cc JOIN categories c ON c.id = cc.category_id
+                        WHERE cc.content_id = contents.id AND c.name = {0})""", ("text", category_value))
+
+        if filters.get("collection_id"):
+            # 合集通过其关联的分类筛选文档
+            add("""EXISTS (SELECT 1 FROM content_categories cc JOIN collections col ON col.category_id = cc.category_id
+                    WHERE cc.content_id = contents.id AND col.id = {0})""", ("uuid", str(filters["collection_id"])))
+
+        if filters.get("created_by"):
+            add("contents.created_by = {0}", ("text", filters["created_by"]))
+
+        if filters.get("date_from"):
+            add("contents.created_at >= {0}", ("timestamp", str(filters["date_from"])))
+
+        if filters.get("date_to"):
+            add("contents.created_at <= {0}", ("timestamp", str(filters["date_to"])))
+
+        if expected_modality and cross_modality_distance is not None:
+            add("(contents.modality = {0} OR chunks.embedding <=> $1 < {1})",
+                ("text", expected_modality), ("float8", float(cross_modality_distance)))
+
+        return conditions, param_types, values
+
+    def _candidate_sql(self, conditions: List[str], plan: Optional[Dict[str, Any]]) -> str:
+        """
+        候选 chunk 子查询，返回 (id, content_id, distance)，distance 始终为完整向量的余弦距离
+
+        完整向量索引：按距离顺序扫描索引，距离阈值和过滤条件在扫描内生效；
+        压缩索引：按索引表达式取 $2 * rerank_factor 个候选，再按完整向量距离过滤阈值并重排取前 $2 个
+        """
+        if not plan or not plan["compressed"] or not plan["dimension"]:
+            where_sql = "chunks.embedding IS NOT NULL AND chunks.embedding <=> $1 < $3"
+            if conditions:
+                where_sql += " AND " + " AND ".join(conditions)
+            return f"""
+                SELECT chunks.id, chunks.content_id, chunks.embedding <=> $1 AS distance
+                FROM chunks
+                JOIN contents ON chunks.content_id = contents.id
+                WHERE {where_sql}
+                ORDER BY distance
+                LIMIT $2
+            """
+
+        where_sql = "chunks.embedding IS NOT NULL"
+        if conditions:
+            where_sql += " AND " + " AND ".join(conditions)
+        approx_order = (
+            f"{vector_expression('chunks.embedding', plan)} {plan['operator']} {vector_expression('$1', plan)}"
+        )
+        return f"""
+                SELECT approx.id, approx.content_id, approx.distance
+                FROM (
+                    SELECT chunks.id, chunks.content_id, chunks.embedding <=> $1 AS distance
+                    FROM chunks
+                    JOIN contents ON chunks.content_id = contents.id
+                    WHERE {where_sql}
+                    ORDER BY {approx_order}
+                    LIMIT $2 * {int(plan['rerank_factor'])}
+                ) approx
+                WHERE approx.distance < $3
+                ORDER BY approx.distance
+                LIMIT $2
+            """
+
+    def _build_statement(self, conditions: List[str], plan: Optional[Dict[str, Any]] = None) -> str:
+        """
+        构建预编译语句主体（按文档分组）
+
+        内层只按向量索引顺序取 chunk id、文档 id 与距离（过滤条件和距离阈值都在索引扫描内生效，见 _candidate_sql），
+        再用 DISTINCT ON 每个文档保留距离最近的 chunk，并附带其余候选 chunk 的 ID（最多 $4 个）；
+        最后只为保留下来的 chunk 读取正文、文档和分类信息，分类使用 LATERAL 只取置信度最高的一条
+        """
+        return f"""
+            SELECT {SELECT_COLUMNS}, best.distance, best.supporting_chunk_ids, best.candidate_chunks
+            FROM (
+                SELECT DISTINCT ON (candidates.content_id)
+                    candidates.id, candidates.distance,
+                    (array_agg(candidates.id) OVER (
+                        PARTITION BY candidates.content_id ORDER BY candidates.distance
+                        ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING
+                    ))[2:1 + $4] AS supporting_chunk_ids,
+                    count(*) OVER (PARTITION BY candidates.content_id) AS candidate_chunks
+                FROM ({self._candidate_sql(conditions, plan)}) candidates
+                ORDER BY candidates.content_id, candidates.distance
+            ) best
+            JOIN chunks ON chunks.id = best.id
+            JOIN contents ON chunks.content_id = contents.id
+            LEFT JOIN LATERAL (
+                SELECT categories.name, categories.color, content_categories.confidence
+                FROM content_categories
+                JOIN categories ON content_categories.category_id = categories.id
+                WHERE content_categories.content_id = contents.id
+                ORDER BY content_categories.confidence DESC NULLS LAST
+                LIMIT 1
+            ) best_category ON true
+            ORDER BY best.distance
+        """
+
+    def _ensure_prepared(self, name: str, param_types: List[str], body: str) -> None:
+        """确保当前连接上已存在指定的预编译语句"""
+        connection = self.db.connection()
+        prepared = connection.connection.info.setdefault(PREPARED_CACHE_KEY, set())
+        if name in prepared:
+            return
+
+        exists = connection.execute(
+            text("SELECT 1 FROM pg_prepared_statements WHERE name = :name"), {"name": name}
+        ).first()
+        if not exists:
+            types_sql = ", ".join(["vector", "int", "float8", "int"] + param_types)
+            connection.exec_driver_sql(f"PREPARE {name} ({types_sql}) AS {body}")
+            logger.debug(f"Prepared vector statement {name}")
+
+        prepared.add(name)
+
+    def _forget_prepared(self) -> None:
+        """执行失败时清空连接上的预编译缓存，下次重新检查"""
+        try:
+            self.db.connection().connection.info.pop(PREPARED_CACHE_KEY, None)
+        except Exception:
+            pass
+
+    def search(
+        self,
+        query_embedding: List[float],
+        limit: int,
+        filters: Optional[Dict] = None,
+        max_distance: float = 0.8,
+        expected_modality: Optional[str] = None,
+        cross_modality_distance: Optional[float] = None,
+        supporting_chunks: int = 0,
+        plan: Optional[Dict[str, Any]] = None,
+    ) -> List[Any]:
+        """
+        执行一次向量检索（每个文档返回一行）
+
+        Args:
+            query_embedding: 查询向量
+            limit: 返回的候选 chunk 数量
+            filters: 过滤条件，见 _compile_filters
+            max_distance: 余弦距离阈值
+            expected_modality: 查询意图推断出的文件类型
+            cross_modality_distance: 跨类型匹配允许的最大距离
+            supporting_chunks: 每个文档附带的其余候选 chunk ID 数量
+            plan: ANN 索引方案（VectorIndexService.get_active_plan），压缩索引时启用重排
+
+        Returns:
+            结果行列表（包含 distance、supporting_chunk_ids、candidate_chunks 列）
+        """
+        conditions, param_types, values = self._compile_filters(
+            filters, expected_modality, cross_modality_distance
+        )
+        body = self._build_statement(conditions, plan)
+
+        # 语句名由语句内容决定：每种过滤组合一个语句，语句变化时自动使用新名称
+        signature = hashlib.md5((body + ",".join(param_types)).encode()).hexdigest()[:16]
+        name = f"pkb_vq_{signature}"
+
+        # 参数绑定：向量只传输一次
+        params = {
+            "p1": to_vector_literal(query_embedding), "p2": int(limit),
+            "p3": float(max_distance), "p4": int(supporting_chunks),
+        }
+        placeholders = ["CAST(:p1 AS vector)", ":p2", ":p3", ":p4"]
+        for i, value in enumerate(values, start=5):
+            params[f"p{i}"] = value
+            placeholders.append(f":p{i}")
+
+        try:
+            self._ensure_prepared(name, param_types, body)
+            return self.db.execute(
+                text(f"EXECUTE {name}({', '.join(placeholders)})"), params
+            ).fetchall()
+        except Exception:
+            self._forget_prepared()
+            raise
+
+    def search_documents(
+        self,
+        query_embedding: List[float],
+        top_k: int,
+        filters: Optional[Dict] = None,
+        max_distance: float = 0.8,
+        expected_modality: Optional[str] = None,
+        cross_modality_distance: Optional[float] = None,
+    ) -> Tuple[List[Any], Dict[str, Any]]:
+        """
+        带迭代加深的过滤向量检索：尽量返回 top_k 个不同文档
+
+        首轮取 top_k * 2 个候选；不同文档数不足且候选可能被过滤条件截断时，
+        按 VECTOR_FILTER_GROWTH 倍扩大 limit 与 ef_search 重新检索，最多 VECTOR_FILTER_MAX_ROUNDS 轮
+
+        Returns:
+            (结果行列表, 执行计划统计)
+        """
+        filters = filters or {}
+        index_service = VectorIndexService(self.db)
+        config = index_service.get_config()
+        plan = index_service.get_active_plan()
+        # 压缩索引需要 top_k * rerank_factor 个索引候选，ef_search 不能小于候选数
+        rerank_factor = plan["rerank_factor"] if plan["compressed"] else 1
+
+        limit = max(top_k * 2, 1)
+        ef_search = int(filters.get("ef_search") or config["ef_search"])
+        # 除距离阈值外还有其他过滤条件时，ANN 索引返回的候选可能被过滤掉一部分
+        selective = bool(self._compile_filters(filters, expected_modality, cross_modality_distance)[0])
+
+        rows: List[Any] = []
+        rounds = []
+        for round_no in range(1, VECTOR_FILTER_MAX_ROUNDS + 1):
+            applied = index_service.apply_search_params(
+                ef_search=max(min(max(ef_search, limit * rerank_factor), MAX_EF_SEARCH), 1),
+                probes=filters.get("probes")
+            )
+            rows = self.search(
+                query_embedding, limit=limit, filters=filters, max_distance=max_distance,
+                expected_modality=expected_modality, cross_modality_distance=cross_modality_distance,
+                supporting_chunks=int(filters.get("supporting_chunks") or 0), plan=plan
+            )
+            # 每个文档一行，candidate_chunks 为该文档占用的候选 chunk 数
+            documents = len(rows)
+            candidates = sum(row.candidate_chunks for row in rows)
+            rounds.append({"limit": limit, "ef_search": applied["ef_search"], "documents": documents})
+
+            if documents >= top_k:
+                break
+            # 候选未取满：无过滤条件时说明阈值内已无更多结果；有过滤条件时 ef_search 已到上限也无法再扩大
+            if candidates < limit and (not selective or applied["ef_search"] >= MAX_EF_SEARCH):
+                break
+            if limit >= VECTOR_FILTER_MAX_CANDIDATES and applied["ef_search"] >= MAX_EF_SEARCH:
+                break
+
+            limit = min(limit * VECTOR_FILTER_GROWTH, VECTOR_FILTER_MAX_CANDIDATES)
+            ef_search = max(ef_search * VECTOR_FILTER_GROWTH, limit)
+
+        return rows, {"rounds": rounds, "selective": selective, "reranked": plan["compressed"]}
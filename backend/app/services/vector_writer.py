@@ -0,0 +1,125 @@
+"""
+批量向量写入
+生成向量时只读取 (id, text)，向量经 COPY（驱动不支持时退回 executemany）写入临时暂存表，
+再用一条 UPDATE ... FROM 回写 chunks，取代逐行加载 ORM 对象、逐行 UPDATE 的工作单元写法
+"""
+import io
+import os
+import logging
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from app.models import Chunk
+from app.services.vector_query import to_vector_literal
+
+logger = logging.getLogger(__name__)
+
+# 每批加载、生成并写回的 chunk 数量，每批单独提交
+VECTOR_WRITE_BATCH_SIZE = int(os.getenv("VECTOR_WRITE_BATCH_SIZE", "1000"))
+
+STAGING_TABLE = "embedding_write_staging"
+
+
+def estimate_token_count(content: str) -> int:
+    """与入库时一致的简单 token 估算"""
+    return int(len(content.split()) * 1.3)
+
+
+class BulkVectorWriter:
+    """经暂存表批量回写 chunks 的向量列，与调用方共用数据库会话（调用方负责提交）"""
+
+    def __init__(self, db: Session, column: str = "embedding"):
+        """
+        Args:
+            db: 数据库会话
+            column: 目标向量列（向量模型迁移时写入影子列）
+        """
+        self.db = db
+        self.column = column
+
+    def iter_texts(self, chunk_ids: Sequence[Any],
+                   batch_size: int = VECTOR_WRITE_BATCH_SIZE) -> Iterator[List[Tuple[Any, str]]]:
+        """按批读取 (id, text)，不加载 meta 等其余列，也不进入 ORM 标识映射"""
+        ids = list(chunk_ids)
+        for start in range(0, len(ids), batch_size):
+            rows = self.db.query(Chunk.id, Chunk.text).filter(
+                Chunk.id.in_(ids[start:start + batch_size])
+            ).all()
+            if rows:
+                yield [(row.id, row.text) for row in rows]
+
+    def write(self, rows: List[Tuple[Any, str, Optional[List[float]]]],
+              model: Optional[str] = None) -> Dict[str, int]:
+        """
+        写回一批向量
+
+        Args:
+            rows: (chunk_id, text, embedding) 列表，embedding 为 None 的条目跳过
+            model: 生成这批向量的模型；写入 embedding 列时在同一事务中校验它仍是生效模型，
+                   模型已切换时抛出 EmbeddingModelChangedError
+
+        Returns:
+            {"written": 写入行数, "newly_embedded": 从无到有生成向量的行数}
+        """
+        rows = [r for r in rows if r[2]]
+        if not rows:
+            return {"written": 0, "newly_embedded": 0}
+
+        if model and self.column == "embedding":
+            from app.services.embedding_migration import verify_active_model
+            verify_active_model(self.db, model)
+
+        self.db.execute(text(f"""
+            CREATE TEMP TABLE IF NOT EXISTS {STAGING_TABLE} (
+                id uuid PRIMARY KEY,
+                embedding vector,
+                char_count integer,
+                token_count integer
+            ) ON COMMIT DELETE ROWS
+        """))
+        self.db.execute(text(f"TRUNCATE {STAGING_TABLE}"))
+        self._load_staging(rows)
+
+        newly_embedded = self.db.execute(text(f"""
+            SELECT COUNT(*) FROM chunks c JOIN {STAGING_TABLE} s ON s.id = c.id
+            WHERE c.{self.column} IS NULL
+        """)).scalar() or 0
+        assignments = f"{self.column} = s.embedding"
+        if self.column == "embedding":
+            assignments += ", char_count = s.char_count, token_count = s.token_count"
+        written = self.db.execute(text(f"""
+            UPDATE chunks
+            SET {assignments}
+            FROM {STAGING_TABLE} s
+            WHERE chunks.id = s.id
+        """)).rowcount
+        return {"written": written, "newly_embedded": newly_embedded}
+
+    def _load_staging(self, rows: List[Tuple[Any, str, List[float]]]) -> None:
+        records = [
+            (str(chunk_id), to_vector_literal(embedding), len(content), estimate_token_count(content))
+            for chunk_id, content, embedding in rows
+        ]
+        cursor = self.db.connection().connection.cursor()
+        try:
+            if hasattr(cursor, "copy_expert"):
+                # 向量文本与 UUID 中不含制表符、换行或反斜杠，可直接按 COPY 文本格式拼接
+                buffer = io.StringIO("".join("\t".join(map(str, record)) + "\n" for record in records))
+                cursor.copy_expert(
+                    f"COPY {STAGING_TABLE} (id, embedding, char_count, token_count) FROM STDIN", buffer
+                )
+            else:
+                cursor.executemany(
+                    f"INSERT INTO {STAGING_TABLE} (id, embedding, char_count, token_count) "
+                    f"VALUES (%s, %s::vector, %s, %s)",
+                    records
+                )
+        finally:
+            cursor.close()
+
+
+def rows_per_second(rows: int, seconds: float) -> float:
+    """吞吐（行/秒）"""
+    return round(rows / seconds, 1) if seconds > 0 else 0.0
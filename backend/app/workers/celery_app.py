@@ -1,5 +1,6 @@
 import os
 from celery import Celery
+from celery.signals import worker_init
 
 REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
 celery_app = Celery("pkb", broker=REDIS_URL, backend=REDIS_URL, include=["app.workers.tasks", "app.workers.quick_tasks"],)
@@ -11,7 +12,11 @@ celery_app.conf.update(
         'app.workers.tasks.classify_content': {'queue': 'classify'},
         'app.workers.tasks.batch_classify_contents': {'queue': 'classify'},
         'app.workers.tasks.generate_embeddings': {'queue': 'heavy'},
+        'app.workers.tasks.drain_pending_embeddings': {'queue': 'heavy'},
+        'app.workers.tasks.run_embedding_migration': {'queue': 'heavy'},
         'app.workers.tasks.ingest_file': {'queue': 'ingest'},
+        'app.workers.tasks.process_uploaded_file': {'queue': 'ingest'},
+        'app.workers.tasks.process_uploaded_batch': {'queue': 'ingest'},
         'app.workers.tasks.process_document': {'queue': 'heavy'},
         'app.workers.tasks.process_image_content': {'queue': 'heavy'},
     },
@@ -25,3 +30,8 @@ celery_app.conf.update(
 
 celery_app.autodiscover_tasks(["app.workers"])
 
+@worker_init.connect
+def ensure_schema(**kwargs):
+    # worker 可能先于 API 启动：ORM 映射的新列需要在处理任务之前存在
+    from app.services.keyword_index import ensure_keyword_columns
+    ensure_keyword_columns()
@@ -113,3 +113,39 @@ def match_document_to_collections(content_id: str):
         return {"success": False, "error": str(e)}
     finally:
         db.close()
+
+@celery_app.task(name="app.workers.quick_tasks.batch_match_documents_to_collections", queue="quick", priority=8)
+def batch_match_documents_to_collections(content_ids: list):
+    """
+    批量将文档匹配到用户合集（单个文档匹配失败不影响其他文档）
+    
+    Args:
+        content_ids: 内容ID列表
+        
+    Returns:
+        批量匹配结果
+    """
+    db = SessionLocal()
+    try:
+        logger.info(f"Starting batch collection matching for {len(content_ids)} contents")
+        
+        matching_service = CollectionMatchingService(db)
+        matched, failed = 0, 0
+        for content_id in content_ids:
+            try:
+                if matching_service.match_document_to_collections(content_id):
+                    matched += 1
+            except Exception as e:
+                db.rollback()
+                failed += 1
+                logger.error(f"Error matching content {content_id} to collections: {e}")
+        
+        logger.info(f"Batch collection matching completed: {matched} matched, {failed} failed")
+        
+        return {"success": True, "total": len(content_ids), "matched": matched, "failed": failed}
+        
+    except Exception as e:
+        logger.error(f"Error in batch_match_documents_to_collections task: {e}")
+        return {"success": False, "error": str(e)}
+    finally:
+        db.close()
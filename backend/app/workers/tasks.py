@@ -3,15 +3,30 @@ from app.db import SessionLocal
 from app.models import Chunk, Content
 from app.services.embedding_service import EmbeddingService
 from app.services.category_service import CategoryService
+from app.services.embedding_stats_service import EmbeddingStatsService
+from app.services.embedding_store import EmbeddingStore
+from app.services.vector_writer import BulkVectorWriter, rows_per_second
+from app.services.chunk_store import ChunkStore
+from app.services.chunking import chunk_text
+from app.services.embedding_migration import EmbeddingMigrationService, EmbeddingModelChangedError
+from app.services import embedding_scheduler
+from app.services.embedding_guard import embedding_guard, EmbeddingUnavailableError
+from app.services.search_cache import bump_corpus_version
+import app.services.keyword_index  # noqa: F401  注册 tsvector 维护事件
 from app.parsers.document_processor import DocumentProcessor
 import logging
 import os
+import time
 from pathlib import Path
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger(__name__)
 
-# 文档分块函数
+# 多文件上传批量解析时的并发线程数
+UPLOAD_BATCH_PARSE_WORKERS = int(os.getenv("UPLOAD_BATCH_PARSE_WORKERS", "4"))
+
+# 旧版按行分块（保留作为 chunking.benchmark 的对照基线，入库路径已改用 chunk_text）
 def simple_chunk(text: str, max_len: int = 700):
     """
     简单的文本分块函数
@@ -105,45 +120,32 @@ def ingest_file(path: str):
         )
         
         db.add(content)
-        db.commit()
-        db.refresh(content)
-        
-        # 文本分块
-        chunks = simple_chunk(text_content)
-        chunk_ids = []
-        
-        for seq, chunk_text in enumerate(chunks):
-            chunk = Chunk(
-                content_id=content.id,
-                seq=seq,
-                text=chunk_text,
-                meta={
-                    "source_uri": content.source_uri,
-                    "chunk_index": seq,
-                    "total_chunks": len(chunks)
-                }
-            )
-            db.add(chunk)
-            chunk_ids.append(chunk.id)
+        db.flush()
+        content_id = str(content.id)
         
+        # 文本分块并批量入库，与 content 同一事务提交
+        chunks = chunk_text(text_content, parse_result.get('metadata'))
+        chunk_ids = ChunkStore(db).insert(
+            content.id, chunks, meta={"source_uri": content.source_uri}, with_position=True
+        )
         db.commit()
+        bump_corpus_version()
         
         # 立即进行快速分类（高优先级）
         from app.workers.quick_tasks import quick_classify_content
         quick_classify_content.apply_async(
-            args=[str(content.id)], 
+            args=[content_id], 
             queue="quick", 
             priority=9
         )
         
         # 异步生成 embeddings
         if chunk_ids:
-            chunk_ids_str = [str(cid) for cid in chunk_ids]
-            generate_embeddings.delay(chunk_ids_str)
+            embedding_scheduler.schedule_embeddings(chunk_ids)
         
         # 异步进行精确AI分类（较低优先级，会覆盖快速分类）
         classify_content.apply_async(
-            args=[str(content.id)], 
+            args=[content_id], 
             queue="classify", 
             priority=5,
             countdown=30  # 延迟30秒执行，让用户先看到快速分类结果
@@ -151,7 +153,7 @@ def ingest_file(path: str):
         
         result = {
             "ok": True,
-            "content_id": str(content.id),
+            "content_id": content_id,
             "chunks_created": len(chunks),
             "title": title,
             "text_length": len(text_content),
@@ -168,6 +170,50 @@ def ingest_file(path: str):
     finally:
         db.close()
 
+def _embed_chunks(db, embedding_service: EmbeddingService, chunk_ids: list) -> dict:
+    """为指定的 chunks 生成并写入 embedding（调用方负责异常处理和会话关闭）"""
+    writer = BulkVectorWriter(db)
+    store = EmbeddingStore(db)
+    started = time.perf_counter()
+    write_seconds = 0.0
+    processed_count = 0
+    store_stats = {"reused": 0, "computed": 0, "failed": 0}
+    
+    # 按批只加载 (id, text)，每批生成向量后经暂存表一次性回写并提交
+    for batch in writer.iter_texts(chunk_ids):
+        # 相同文本复用去重存储中的向量，只为新文本调用 API
+        embeddings, batch_stats = store.embed_texts(embedding_service, [t for _, t in batch])
+        if embedding_guard.is_open() and any(e is None for e in embeddings):
+            # 熔断期间缺失的向量不写入，由调用方延后重试整批
+            raise EmbeddingUnavailableError("Embedding circuit breaker opened during batch")
+        for key, value in batch_stats.items():
+            store_stats[key] += value
+        
+        write_started = time.perf_counter()
+        # 写入前在同一事务中确认模型未被切换，避免两种模型的向量混在 embedding 列中
+        result = writer.write([(cid, t, e) for (cid, t), e in zip(batch, embeddings)],
+                              model=embedding_service.current_model)
+        # 增量更新向量覆盖率统计，与向量写入同一事务提交
+        EmbeddingStatsService(db).record_embedded(result["newly_embedded"])
+        db.commit()
+        write_seconds += time.perf_counter() - write_started
+        processed_count += result["written"]
+    
+    if processed_count:
+        bump_corpus_version()
+    
+    total_seconds = time.perf_counter() - started
+    throughput = {
+        "rows_per_sec": rows_per_second(processed_count, total_seconds),
+        "write_rows_per_sec": rows_per_second(processed_count, write_seconds),
+        "seconds": round(total_seconds, 3),
+    }
+    logger.info(
+        f"Generated embeddings for {processed_count} chunks in {total_seconds:.2f}s "
+        f"({throughput['rows_per_sec']} rows/sec, write {throughput['write_rows_per_sec']} rows/sec)"
+    )
+    return {"ok": True, "processed": processed_count, **store_stats, **throughput}
+
 # 生成 embedding 的后台任务
 @celery_app.task(name="app.workers.tasks.generate_embeddings", queue="heavy")
 def generate_embeddings(chunk_ids: list):
@@ -182,30 +228,24 @@ def generate_embeddings(chunk_ids: list):
             logger.warning("Embedding service not available")
             return {"ok": False, "error": "Embedding service not configured"}
         
-        # 获取需要处理的 chunks
-        chunks = db.query(Chunk).filter(Chunk.id.in_(chunk_ids)).all()
-        
-        if not chunks:
-            return {"ok": True, "processed": 0}
+        # 熔断打开时不逐条请求后失败，整批延后到冷却结束
+        if embedding_guard.is_open():
+            raise EmbeddingUnavailableError("Embedding circuit breaker is open")
         
-        # 批量生成 embeddings
-        texts = [chunk.text for chunk in chunks]
-        embeddings = embedding_service.batch_get_embeddings(texts)
-        
-        # 更新数据库
-        processed_count = 0
-        for chunk, embedding in zip(chunks, embeddings):
-            if embedding:
-                chunk.embedding = embedding
-                chunk.char_count = len(chunk.text)
-                chunk.token_count = int(len(chunk.text.split()) * 1.3)  # 简单估算
-                processed_count += 1
-        
-        db.commit()
-        
-        logger.info(f"Generated embeddings for {processed_count} chunks")
-        return {"ok": True, "processed": processed_count}
+        return _embed_chunks(db, embedding_service, chunk_ids)
         
+    except EmbeddingUnavailableError as e:
+        db.rollback()
+        delay = max(embedding_guard.retry_in(), 1.0)
+        logger.warning(f"{e}, deferring {len(chunk_ids)} chunks for {delay:.0f}s")
+        embedding_scheduler.defer_embeddings(chunk_ids, countdown=delay)
+        return {"ok": False, "deferred": len(chunk_ids), "retry_in": delay}
+    except EmbeddingModelChangedError as e:
+        # 新任务会用切换后的模型重新生成（已提交的批次已通过校验）
+        db.rollback()
+        logger.warning(f"{e}, rescheduling {len(chunk_ids)} chunks")
+        embedding_scheduler.schedule_embeddings(chunk_ids)
+        return {"ok": False, "rescheduled": len(chunk_ids), "error": str(e)}
     except Exception as e:
         logger.error(f"Error generating embeddings: {e}")
         db.rollback()
@@ -213,6 +253,86 @@ def generate_embeddings(chunk_ids: list):
     finally:
         db.close()
 
+@celery_app.task(name="app.workers.tasks.drain_pending_embeddings", queue="heavy")
+def drain_pending_embeddings():
+    """
+    批量处理合并调度登记的待生成向量 chunk（见 embedding_scheduler）
+    """
+    embedding_scheduler.clear_drain_marker()
+    embedding_service = EmbeddingService()
+    if not embedding_service.is_enabled():
+        logger.warning("Embedding service not available")
+        return {"ok": False, "error": "Embedding service not configured"}
+    
+    # 熔断打开时不取出待处理 chunk，冷却结束后再处理
+    if embedding_guard.is_open():
+        delay = max(embedding_guard.retry_in(), 1.0)
+        embedding_scheduler.defer_embeddings([], countdown=delay)
+        return {"ok": False, "deferred": True, "retry_in": delay}
+    
+    batches = 0
+    processed = 0
+    deferred = False
+    try:
+        while batches < embedding_scheduler.EMBEDDING_DRAIN_MAX_BATCHES:
+            chunk_ids = embedding_scheduler.claim_pending()
+            if not chunk_ids:
+                break
+            batches += 1
+            
+            db = SessionLocal()
+            try:
+                result = _embed_chunks(db, embedding_service, chunk_ids)
+                processed += result.get("processed", 0)
+                # 向量已提交，释放租约（进程在此之前崩溃时，租约到期后 chunk 会被重新处理）
+                embedding_scheduler.ack(chunk_ids)
+            except EmbeddingUnavailableError as e:
+                db.rollback()
+                delay = max(embedding_guard.retry_in(), 1.0)
+                logger.warning(f"{e}, deferring pending embeddings for {delay:.0f}s")
+                embedding_scheduler.defer_embeddings(chunk_ids, countdown=delay)
+                deferred = True
+                break
+            except EmbeddingModelChangedError as e:
+                # 放回待处理集合，由新的 drain 任务用切换后的模型处理
+                db.rollback()
+                logger.warning(f"{e}, requeueing {len(chunk_ids)} chunks")
+                embedding_scheduler.requeue(chunk_ids)
+                break
+            except Exception as e:
+                # 计一次失败并按退避放回（多次失败后移入死信集合），不立即重试同一批
+                logger.error(f"Error draining pending embeddings: {e}")
+                db.rollback()
+                embedding_scheduler.fail(chunk_ids, e)
+                break
+            finally:
+                db.close()
+            
+            if len(chunk_ids) < embedding_scheduler.EMBEDDING_COALESCE_MAX_CHUNKS:
+                break
+    finally:
+        if not deferred:
+            embedding_scheduler.reschedule_if_pending()
+    
+    logger.info(f"Drained {batches} embedding batches ({processed} chunks)")
+    return {"ok": True, "batches": batches, "processed": processed}
+
+@celery_app.task(name="app.workers.tasks.run_embedding_migration", queue="heavy", bind=True)
+def run_embedding_migration(self, migration_id: str):
+    """
+    向量模型迁移回填：每次执行若干批后重新投递自身，直至回填完成、暂停或取消
+    """
+    db = SessionLocal()
+    try:
+        # 以任务 ID 作为租约持有者，worker 崩溃后重新投递的同一消息可以直接接续
+        result = EmbeddingMigrationService(db).run_batches(migration_id, owner=self.request.id)
+    finally:
+        db.close()
+    
+    if result.get("continue"):
+        run_embedding_migration.delay(migration_id)
+    return result
+
 # 可以添加其他处理任务，如文档解析、OCR等
 @celery_app.task(name="app.workers.tasks.process_document", queue="heavy")
 def process_document(content_id: str, doc_type: str = "text"):
@@ -344,50 +464,40 @@ def process_image_content(content_id: str):
             content.meta["processing_status"] = "completed"
             content.updated_at = datetime.utcnow()
             
-            # 重新分块
-            # 删除旧的chunks
-            db.query(Chunk).filter(Chunk.content_id == content.id).delete()
-            
-            # 创建新的chunks
-            seq = 0
-            chunk_ids = []
-            for t in simple_chunk(parse_result['text']):
-                chunk = Chunk(
-                    content_id=content.id,
-                    seq=seq,
-                    text=t,
-                    meta={"source_uri": content.source_uri}
-                )
-                db.add(chunk)
-                seq += 1
+            # 重新分块：与已有 chunks 比对，未变化的 chunk 连同向量保留，只写入新增或修改的 chunk
+            sync = ChunkStore(db).sync(
+                content.id, chunk_text(parse_result['text'], parse_result.get('metadata')), meta={"source_uri": content.source_uri}
+            )
+            chunk_ids = sync["chunk_ids"]
+            title = content.title
             
             db.commit()
+            bump_corpus_version()
+            logger.info(
+                f"Re-chunked {title}: {sync['inserted']} inserted, {sync['kept']} kept, {sync['deleted']} deleted"
+            )
             
-            # 获取新的chunk IDs
-            db.refresh(content)
-            chunk_ids = [str(chunk.id) for chunk in content.chunks]
-            
-            # 异步生成embeddings
-            if chunk_ids:
-                generate_embeddings.delay(chunk_ids)
+            # 异步生成embeddings（仅新增、修改或尚无向量的 chunk）
+            if sync["embed_ids"]:
+                embedding_scheduler.schedule_embeddings(sync["embed_ids"])
             
             # 触发分类
             from app.workers.quick_tasks import quick_classify_content
             quick_classify_content.apply_async(
-                args=[str(content.id)], 
+                args=[content_id], 
                 queue="quick", 
                 priority=9
             )
             
             classify_content.apply_async(
-                args=[str(content.id)], 
+                args=[content_id], 
                 queue="classify", 
                 priority=5,
                 countdown=30
             )
             
-            logger.info(f"Successfully processed image content: {content.title}")
-            return {"success": True, "chunks": seq}
+            logger.info(f"Successfully processed image content: {title}")
+            return {"success": True, "chunks": len(chunk_ids)}
         else:
             # 处理失败
             content.meta["processing_status"] = "failed"
@@ -402,3 +512,208 @@ def process_image_content(content_id: str):
         return {"success": False, "error": str(e)}
     finally:
         db.close()
+
+
+def _parse_upload_file(title: str, file_path: str):
+    """为上传文件预生成缩略图并解析文本，解析失败时返回空文本和 parse_error（不访问数据库，可并发调用）"""
+    try:
+        from app.api.files import pregenerate_thumbnail_if_image
+        if pregenerate_thumbnail_if_image(Path(file_path)):
+            logger.info(f"Pre-generated thumbnail for uploaded image: {title}")
+    except Exception as e:
+        logger.warning(f"Failed to pre-generate thumbnail for {title}: {e}")
+    
+    try:
+        parsed_result = DocumentProcessor().process_file(file_path)
+        return parsed_result.get("text", ""), parsed_result.get("metadata", {})
+    except Exception as e:
+        logger.error(f"Failed to parse uploaded file {title}: {e}")
+        return "", {"parse_error": str(e)}
+
+
+def _apply_parse_result(content: Content, file_text: str, file_metadata: dict) -> None:
+    """写入解析结果，上传时记录的元数据（文件路径、大小、哈希、处理状态）优先"""
+    content.text = file_text
+    content.modality = 'image' if file_metadata.get('detected_type') == 'image' else 'text'
+    content.meta = {**file_metadata, **(content.meta or {})}
+    content.updated_at = datetime.utcnow()
+
+
+def _mark_upload_failed(db, content_ids: list, error: str) -> None:
+    try:
+        for content in db.query(Content).filter(Content.id.in_(content_ids)):
+            content.meta = {**(content.meta or {}), "processing_status": "failed", "error": error}
+        db.commit()
+    except Exception:
+        db.rollback()
+
+
+def parse_uploaded_content(content_id: str) -> dict:
+    """
+    解析已落盘的上传文件并完成入库（分块、向量与分类任务投递）
+
+    上传接口只负责流式保存文件和创建 Content 记录，解析在这里执行：
+    默认由 process_uploaded_file 任务（ingest 队列）调用，UPLOAD_PARSE_EXECUTOR=thread 时在 API 进程的线程池中调用
+    """
+    db = SessionLocal()
+    try:
+        content = db.query(Content).filter(Content.id == content_id).first()
+        if not content:
+            logger.error(f"Content not found: {content_id}")
+            return {"success": False, "error": "Content not found"}
+        
+        # 解析失败时保留空文本，仍然进入分类流程
+        file_text, file_metadata = _parse_upload_file(content.title, (content.meta or {}).get("file_path"))
+        _apply_parse_result(content, file_text, file_metadata)
+        
+        # 分块入库；任务重试时与已写入的 chunks 比对，不会重复写入
+        sync = ChunkStore(db).sync(
+            content.id, chunk_text(file_text, file_metadata), meta={"source_uri": content.source_uri}
+        )
+        db.commit()
+        bump_corpus_version()
+        
+        if sync["embed_ids"]:
+            embedding_scheduler.schedule_embeddings(sync["embed_ids"])
+        
+        # 快速分类（最高优先级）
+        from app.workers.quick_tasks import quick_classify_content, match_document_to_collections
+        quick_classify_content.apply_async(
+            args=[content_id],
+            queue="quick",
+            priority=10,
+            countdown=1
+        )
+        
+        # 智能合集匹配（在快速分类之后执行）
+        match_document_to_collections.apply_async(
+            args=[content_id],
+            queue="quick",
+            priority=9,
+            countdown=3
+        )
+        
+        # AI精确分类（最后执行，覆盖快速分类）
+        classify_content.apply_async(
+            args=[content_id],
+            queue="classify",
+            priority=7,
+            countdown=5
+        )
+        
+        logger.info(f"Processed uploaded file: {content.title} ({len(sync['chunk_ids'])} chunks)")
+        return {"success": True, "content_id": content_id, "chunks": len(sync["chunk_ids"])}
+        
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Error processing uploaded content {content_id}: {e}")
+        _mark_upload_failed(db, [content_id], str(e))
+        return {"success": False, "error": str(e)}
+    finally:
+        db.close()
+
+
+def _write_upload_batch(db, parsed: list) -> list:
+    """写入一组上传文件的解析结果与 chunk 行（调用方负责保存点/事务），返回写入的行"""
+    content_ids = [content.id for content, _, _ in parsed]
+    # 任务重试时先清除已写入的 chunks
+    EmbeddingStatsService(db).delete_chunks(Chunk.content_id.in_(content_ids))
+    
+    store = ChunkStore(db)
+    rows = []
+    for content, file_text, file_metadata in parsed:
+        _apply_parse_result(content, file_text, file_metadata)
+        rows.extend(store.build_rows(
+            content.id, chunk_text(file_text, file_metadata), meta={"source_uri": content.source_uri}
+        ))
+    # 在保存点内写出 content 的更新，出错时随保存点一起回滚
+    db.flush()
+    store.insert_rows(rows)
+    return rows
+
+
+def parse_uploaded_batch(content_ids: list) -> dict:
+    """
+    批量解析一次多文件上传的所有文件
+
+    文件在有界线程池中并发解析，单个文件解析或写入失败不影响其他文件；
+    所有 content 的文本与 chunk 行在同一事务中批量写入，之后一次性投递向量生成，
+    快速分类、合集匹配和 AI 分类各投递一个批量任务
+    """
+    db = SessionLocal()
+    try:
+        contents = db.query(Content).filter(Content.id.in_(content_ids)).all()
+        if not contents:
+            return {"success": False, "error": "Content not found"}
+        
+        workers = max(1, min(UPLOAD_BATCH_PARSE_WORKERS, len(contents)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="upload-batch") as pool:
+            futures = [
+                (content, pool.submit(_parse_upload_file, content.title, (content.meta or {}).get("file_path")))
+                for content in contents
+            ]
+            parsed = []
+            for content, future in futures:
+                try:
+                    parsed.append((content, *future.result()))
+                except Exception as e:
+                    logger.error(f"Failed to process uploaded file {content.title}: {e}")
+                    parsed.append((content, "", {"parse_error": str(e)}))
+        
+        # 整批在一个保存点中写入；失败时（如 PDF 文本中的 NUL 字节）逐个文件在各自的保存点中重试，
+        # 只有出错的文件被标记为失败
+        try:
+            with db.begin_nested():
+                rows = _write_upload_batch(db, parsed)
+        except Exception as e:
+            logger.warning(f"Batch write failed, retrying uploaded files individually: {e}")
+            rows = []
+            for item in list(parsed):
+                content = item[0]
+                try:
+                    with db.begin_nested():
+                        rows.extend(_write_upload_batch(db, [item]))
+                except Exception as file_error:
+                    logger.error(f"Failed to store uploaded file {content.title}: {file_error}")
+                    parsed.remove(item)
+                    content.meta = {**(content.meta or {}), "processing_status": "failed", "error": str(file_error)}
+        ids = [str(content.id) for content, _, _ in parsed]
+        db.commit()
+        bump_corpus_version()
+        
+        if rows:
+            embedding_scheduler.schedule_embeddings([row["id"] for row in rows])
+        
+        if ids:
+            from app.workers.quick_tasks import batch_quick_classify, batch_match_documents_to_collections
+            batch_quick_classify.apply_async(args=[ids], queue="quick", priority=10, countdown=1)
+            batch_match_documents_to_collections.apply_async(args=[ids], queue="quick", priority=9, countdown=3)
+            batch_classify_contents.apply_async(args=[ids, True], queue="classify", priority=7, countdown=5)
+        
+        failed = len(contents) - len(ids)
+        logger.info(f"Processed {len(ids)} uploaded files in batch ({len(rows)} chunks, {failed} failed)")
+        return {"success": True, "contents": len(ids), "failed": failed, "chunks": len(rows)}
+        
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Error processing uploaded batch: {e}")
+        _mark_upload_failed(db, content_ids, str(e))
+        return {"success": False, "error": str(e)}
+    finally:
+        db.close()
+
+
+@celery_app.task(name="app.workers.tasks.process_uploaded_file", queue="ingest")
+def process_uploaded_file(content_id: str):
+    """
+    解析上传文件（UPLOAD_PARSE_EXECUTOR=celery，默认；需要 worker 与 API 共享 /app/uploads）
+    """
+    return parse_uploaded_content(content_id)
+
+
+@celery_app.task(name="app.workers.tasks.process_uploaded_batch", queue="ingest")
+def process_uploaded_batch(content_ids: list):
+    """
+    批量解析一次多文件上传（UPLOAD_PARSE_EXECUTOR=celery 时使用）
+    """
+    return parse_uploaded_batch(content_ids)